@@ -0,0 +1,128 @@
+'''
+background writer for the blocked domains log. the server only puts (time, domain, client) on a bounded queue,
+a thread formats the events and writes them in batches, flushing every batch_size events or flush_interval
+seconds, and rotates the file once it grows past max_bytes. several processes can append to the same file:
+a batch is written with one call, only one of them should rotate (max_bytes=None for the others) and the
+others reopen the file once it was moved away
+'''
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+except ImportError:  # python < 3.9
+    ZoneInfo = None
+
+
+LOG_FORMATS = ('markdown', 'jsonl')
+
+
+def bucharest_timezone():
+    if ZoneInfo is not None:
+        try:
+            return ZoneInfo('Europe/Bucharest')
+        except ZoneInfoNotFoundError:
+            pass
+    return timezone(timedelta(hours=3))  # no tz database, keep the old fixed offset
+
+
+class BlockEventLogger:
+    def __init__(self, path="blocked_domains.md", log_format="markdown", queue_size=10000, batch_size=256,
+                 flush_interval=1.0, max_bytes=10 * 1024 * 1024, backup_count=3):
+        if log_format not in LOG_FORMATS:
+            raise ValueError(f"log format must be one of {LOG_FORMATS}")
+        self.path = path
+        self.log_format = log_format
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes  # None disables rotation
+        self.backup_count = backup_count
+        self.timezone = bucharest_timezone()
+        self.dropped = 0  # events lost because the queue was full
+        self.file = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    '''
+    called on the hot path: never blocks and never touches the disk
+    '''
+    def log(self, domain_name, client_address):
+        try:
+            self.queue.put_nowait((time.time(), domain_name, client_address))
+        except queue.Full:
+            self.dropped += 1
+
+    '''
+    writes what is still queued and stops the writer thread
+    '''
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def format_event(self, timestamp, domain_name, client_address):
+        now = datetime.fromtimestamp(timestamp, self.timezone)
+        domain_output = domain_name[:-1]
+        if self.log_format == 'jsonl':
+            return json.dumps({"time": now.isoformat(timespec='seconds'), "domain": domain_output,
+                               "client": f"{client_address[0]}:{client_address[1]}"}) + "\n"
+        return f"{domain_output:<49} has been blocked at {now.strftime('%Y-%m-%d %H:%M:%S')}. Requested by {client_address}\n"
+
+    def run(self):
+        self.file = open(self.path, 'a')
+        running = True
+        while running:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    event = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if event is None:
+                    running = False
+                    break
+                batch.append(event)
+
+            if batch:
+                self.file.write(''.join(self.format_event(*event) for event in batch))
+                self.file.flush()
+                self.reopen_if_moved()
+                self.rotate_if_needed()
+        self.file.close()
+
+    '''
+    another process rotated the file: continue in the new one
+    '''
+    def reopen_if_moved(self):
+        try:
+            moved = os.stat(self.path).st_ino != os.fstat(self.file.fileno()).st_ino
+        except FileNotFoundError:
+            moved = True
+        if moved:
+            self.file.close()
+            self.file = open(self.path, 'a')
+
+    def rotate_if_needed(self):
+        if self.max_bytes is None or self.file.tell() < self.max_bytes or not os.path.isfile(self.path):
+            return
+
+        self.file.close()
+        # blocked_domains.md.2 -> .3, .1 -> .2, blocked_domains.md -> .1, the oldest one is overwritten
+        for index in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, 'a')
@@ -0,0 +1,200 @@
+'''
+compiled binary blocklist. the compile step turns dns_records.json (or a hosts file) into a file with the
+64 bit hashes of all names sorted, so the server can mmap it and binary search it without parsing anything
+or materializing a python object per record. the pages are shared by every process that maps the file
+
+layout (little endian):
+    header   magic, entry count, suffix rule count, rdata count, offsets of the sections below
+    hashes   entry count x u64, sorted
+    entries  entry count x (name offset u32, name length u16, rdata index | SUFFIX_FLAG u16), same order
+    rdata    rdata count x (length u8, ascii)
+    names    lowercase names without the "*." prefix, to confirm a hash match
+'''
+import argparse
+import bisect
+import hashlib
+import ipaddress
+import json
+import mmap
+import struct
+import sys
+
+from domain_trie import WILDCARD_PREFIX, normalize
+
+
+MAGIC = b'DNSBL\x00\x00\x01'
+COMPILED_EXTENSION = '.dnsbl'
+HEADER = struct.Struct('<8sIIIIII')  # magic, entries, suffix rules, rdata count, hashes, entries, names offsets
+ENTRY = struct.Struct('<IHH')
+SUFFIX_FLAG = 0x8000
+# names every hosts file maps to itself (the standard header), never blocklist entries
+HOSTS_FILE_LOCAL_NAMES = {'localhost', 'localhost.localdomain', 'local', 'broadcasthost', 'ip6-localhost',
+                          'ip6-loopback', 'ip6-localnet', 'ip6-mcastprefix', 'ip6-allnodes', 'ip6-allrouters',
+                          'ip6-allhosts'}
+
+
+def name_hash(name):
+    return int.from_bytes(hashlib.blake2b(name.encode('latin-1'), digest_size=8).digest(), 'little')
+
+
+'''
+the address as the server writes it in answers, ValueError if it is not a plain ipv4 or ipv6 address
+(ex: fe80::1%lo0, a scoped address from a hosts file header)
+'''
+def validate_rdata(rdata):
+    if '%' in rdata:
+        raise ValueError(f"scoped address {rdata!r}")
+    return str(ipaddress.ip_address(rdata))
+
+
+def is_address(name):
+    try:
+        ipaddress.ip_address(name)
+        return True
+    except ValueError:
+        return False
+
+
+'''
+reads a hosts file ("0.0.0.0 ads.example.com" per line, # for comments) into a records dict. the standard
+header (localhost, broadcasthost, "0.0.0.0 0.0.0.0" ...) and lines without a usable address are skipped
+'''
+def load_hosts_file(path):
+    records = {}
+    with open(path, 'r') as file:
+        for line in file:
+            fields = line.split('#', 1)[0].split()
+            if len(fields) < 2:
+                continue
+            try:
+                rdata = validate_rdata(fields[0])
+            except ValueError:
+                continue
+            for name in fields[1:]:
+                if name.lower().rstrip('.') in HOSTS_FILE_LOCAL_NAMES or is_address(name):
+                    continue
+                records[normalize(name)] = rdata
+    return records
+
+
+def compile_records(records, output_path):
+    for name, rdata in records.items():
+        try:
+            validate_rdata(rdata)
+        except ValueError as e:
+            raise ValueError(f"record {name}: {e}") from None
+    rdata_values = sorted(set(records.values()))
+    if len(rdata_values) >= SUFFIX_FLAG:
+        raise ValueError("too many distinct rdata values")
+    rdata_index = {rdata: index for index, rdata in enumerate(rdata_values)}
+
+    entries = []
+    for name, rdata in records.items():
+        name = normalize(name)
+        flags = 0
+        if name.startswith(WILDCARD_PREFIX):
+            name = name[len(WILDCARD_PREFIX):]
+            flags = SUFFIX_FLAG
+        entries.append((name_hash(name), name, rdata_index[rdata] | flags))
+    entries.sort()
+
+    names = bytearray()
+    entry_table = bytearray()
+    for _, name, value in entries:
+        encoded = name.encode('latin-1')
+        entry_table += ENTRY.pack(len(names), len(encoded), value)
+        names += encoded
+    hashes = b''.join(entry_hash.to_bytes(8, 'little') for entry_hash, _, _ in entries)
+    rdata_table = b''.join(bytes([len(rdata)]) + rdata.encode('ascii') for rdata in rdata_values)
+
+    hashes_offset = HEADER.size + (-HEADER.size % 8)  # aligned so the section can be cast to u64
+    entries_offset = hashes_offset + len(hashes)
+    rdata_offset = entries_offset + len(entry_table)
+    names_offset = rdata_offset + len(rdata_table)
+    suffix_count = sum(1 for _, _, value in entries if value & SUFFIX_FLAG)
+
+    with open(output_path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, len(entries), suffix_count, len(rdata_values),
+                               hashes_offset, entries_offset, names_offset))
+        file.write(b'\x00' * (hashes_offset - HEADER.size))
+        file.write(hashes)
+        file.write(entry_table)
+        file.write(rdata_table)
+        file.write(names)
+
+
+class CompiledRecordIndex:
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.map) < HEADER.size or self.map[:len(MAGIC)] != MAGIC:
+            self.map.close()
+            raise ValueError(f"{path} is not a compiled blocklist")
+        _, self.count, self.suffix_count, rdata_count, hashes_offset, self.entries_offset, self.names_offset = \
+            HEADER.unpack_from(self.map)
+        if sys.byteorder != 'little':
+            raise ValueError("compiled blocklists can only be mapped on little endian hosts")
+
+        self.view = memoryview(self.map)
+        self.hashes = self.view[hashes_offset:hashes_offset + 8 * self.count].cast('Q')
+
+        # the handful of distinct rdata strings is the only thing decoded up front
+        self.rdata = []
+        offset = self.entries_offset + ENTRY.size * self.count
+        for _ in range(rdata_count):
+            length = self.map[offset]
+            self.rdata.append(self.map[offset + 1:offset + 1 + length].decode('ascii'))
+            offset += 1 + length
+
+    def find(self, name, suffix):
+        wanted = name.encode('latin-1')
+        target = name_hash(name)
+        index = bisect.bisect_left(self.hashes, target)
+        while index < self.count and self.hashes[index] == target:
+            name_offset, name_length, value = ENTRY.unpack_from(self.map, self.entries_offset + ENTRY.size * index)
+            if bool(value & SUFFIX_FLAG) == suffix and name_length == len(wanted):
+                start = self.names_offset + name_offset
+                if self.map[start:start + name_length] == wanted:
+                    return self.rdata[value & ~SUFFIX_FLAG]
+            index += 1
+        return None
+
+    '''
+    same contract as RecordIndex.lookup: exact names first, then the longest matching suffix rule
+    '''
+    def lookup(self, domain):
+        rdata = self.find(domain, suffix=False)
+        if rdata is not None or not self.suffix_count:
+            return rdata
+
+        suffix = domain
+        while suffix and suffix != '.':
+            rdata = self.find(suffix, suffix=True)
+            if rdata is not None:
+                return rdata
+            suffix = suffix.split('.', 1)[1]
+        return None
+
+    def close(self):
+        self.hashes.release()
+        self.view.release()
+        self.map.close()
+
+    def __len__(self):
+        return self.count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compile a records json or hosts file into a binary blocklist")
+    parser.add_argument("input", help="ex: dns_records.json or a hosts file")
+    parser.add_argument("output", help=f"ex: dns_records{COMPILED_EXTENSION}")
+    args = parser.parse_args()
+
+    if args.input.endswith('.json'):
+        with open(args.input, 'r') as file:
+            records = json.load(file)
+    else:
+        records = load_hosts_file(args.input)
+    compile_records(records, args.output)
+    print(f"Compiled {len(records)} records into {args.output}")
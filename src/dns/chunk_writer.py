@@ -0,0 +1,187 @@
+'''
+writes tunnel chunks to disk as they arrive. every chunk is decoded and written at its own offset in
+<output>.part, and the indexes received so far are kept in the <output>.part.json manifest, so a restarted
+download only asks for the missing chunks. memory use does not depend on the file size
+
+for a compressed download the part file holds the compressed bytes; they are fed to a streaming decompressor
+as soon as a contiguous prefix is on disk, and the output is written to <output>.decoded
+'''
+import base64
+import json
+import lzma
+import os
+import time
+import zlib
+
+
+RAW_CHUNK_SIZE = 150  # bytes in one 200 character base64 chunk
+DECOMPRESSORS = {
+    'zlib': zlib.decompressobj,
+    'lzma': lzma.LZMADecompressor,
+}
+
+
+'''
+[0, 1, 2, 5, 6] -> [[0, 2], [5, 6]]
+'''
+def to_ranges(indexes):
+    ranges = []
+    for index in sorted(indexes):
+        if ranges and ranges[-1][1] == index - 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ranges
+
+
+class ChunkWriter:
+    def __init__(self, output_path, total_chunks=None, save_every=64, save_interval=1.0, codec=None):
+        if codec is not None and codec not in DECOMPRESSORS:
+            raise ValueError(f"codec must be one of {tuple(DECOMPRESSORS)}")
+        self.output_path = output_path
+        self.part_path = output_path + ".part"
+        self.manifest_path = output_path + ".part.json"
+        self.decoded_path = output_path + ".decoded"
+        self.total_chunks = total_chunks
+        self.codec = codec
+        self.save_every = save_every  # chunks between manifest saves
+        self.save_interval = save_interval  # seconds between manifest saves
+        self.received = set()
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+        self.file = None
+        self.decompressor = None
+        self.decoded_file = None
+        self.decoded_chunks = 0  # chunks already fed to the decompressor
+        self.damaged = False  # the decompressor rejected the data
+
+    '''
+    opens the part file, resuming from the manifest if it belongs to the same download. returns the number of
+    chunks that do not have to be downloaded again
+    '''
+    def open(self):
+        manifest = None
+        if os.path.exists(self.part_path) and os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r') as file:
+                    manifest = json.load(file)
+            except (OSError, ValueError):
+                manifest = None
+
+        if manifest is not None and manifest.get("codec") == self.codec and (
+                manifest.get("chunks") is None or self.total_chunks is None or manifest["chunks"] == self.total_chunks):
+            if self.total_chunks is None:
+                self.total_chunks = manifest.get("chunks")
+            for first_index, last_index in manifest["received"]:
+                self.received.update(range(first_index, last_index + 1))
+            self.file = open(self.part_path, 'r+b')
+        else:
+            os.makedirs(os.path.dirname(self.output_path) or '.', exist_ok=True)
+            self.file = open(self.part_path, 'w+b')
+
+        if self.codec is not None:
+            # decompressor state is not saved, the prefix already on disk is decoded again
+            self.decompressor = DECOMPRESSORS[self.codec]()
+            self.decoded_file = open(self.decoded_path, 'wb')
+            self.decode_available()
+        return len(self.received)
+
+    def has(self, chunk_index):
+        return chunk_index in self.received
+
+    '''
+    first chunk index that was not received yet
+    '''
+    def first_missing(self):
+        index = 0
+        while index in self.received:
+            index += 1
+        return index
+
+    def write(self, chunk_index, chunk_data):
+        if chunk_index in self.received:
+            return
+        self.file.seek(chunk_index * RAW_CHUNK_SIZE)
+        self.file.write(base64.b64decode(chunk_data))
+        self.received.add(chunk_index)
+        self.unsaved += 1
+        if self.decompressor is not None and chunk_index == self.decoded_chunks:
+            self.decode_available()
+        if self.unsaved >= self.save_every or time.monotonic() - self.saved_at >= self.save_interval:
+            self.save_manifest()
+
+    '''
+    feeds the chunks that extend the contiguous prefix to the decompressor
+    '''
+    def decode_available(self):
+        if self.damaged:
+            return
+        first_chunk = self.decoded_chunks
+        while self.decoded_chunks in self.received:
+            self.decoded_chunks += 1
+        if self.decoded_chunks == first_chunk:
+            return
+        self.file.seek(first_chunk * RAW_CHUNK_SIZE)
+        data = self.file.read((self.decoded_chunks - first_chunk) * RAW_CHUNK_SIZE)
+        try:
+            self.decoded_file.write(self.decompressor.decompress(data))
+        except (zlib.error, lzma.LZMAError):
+            self.damaged = True  # a chunk was corrupted on the way, reported by finish()
+
+    '''
+    the data is flushed before the manifest is replaced, so the manifest never lists a chunk that is not on disk
+    '''
+    def save_manifest(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        manifest = {"file": os.path.basename(self.output_path), "chunks": self.total_chunks, "codec": self.codec,
+                    "received": to_ranges(self.received)}
+        with open(self.manifest_path + ".tmp", 'w') as file:
+            json.dump(manifest, file)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+
+    '''
+    called once every chunk is on disk: the part file (or the decompressed data) becomes the output file
+    '''
+    def finish(self):
+        if self.decompressor is not None:
+            self.decode_available()
+            if hasattr(self.decompressor, 'flush') and not self.damaged:
+                self.decoded_file.write(self.decompressor.flush())
+            self.decoded_file.close()
+            self.decoded_file = None
+        self.file.close()
+        self.file = None
+
+        if self.decompressor is None:
+            os.replace(self.part_path, self.output_path)
+        elif self.decompressor.eof:
+            os.replace(self.decoded_path, self.output_path)
+            os.remove(self.part_path)
+        else:
+            # which chunk is bad is unknown, nothing is kept for a resume
+            for path in (self.decoded_path, self.part_path, self.manifest_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise ValueError(f"{self.codec} data of {self.output_path} is damaged, download it again")
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+
+    '''
+    keeps the part file and the manifest for a later resume, or removes them if no chunk was received
+    '''
+    def close(self):
+        if self.file is not None:
+            if self.received:
+                self.save_manifest()
+            self.file.close()
+            self.file = None
+        if self.decoded_file is not None:
+            self.decoded_file.close()
+            self.decoded_file = None
+        if not self.received:
+            for path in (self.part_path, self.manifest_path, self.decoded_path):
+                if os.path.exists(path):
+                    os.remove(path)
@@ -0,0 +1,296 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import select
+import signal
+import socket
+import tempfile
+import time
+
+import dns_wire
+from dns_server import DNSPiHole, stop_on_signal
+
+
+'''
+fake upstream resolver on localhost. answers every query with an A record for 1.2.3.4 after a fixed delay, the
+delays are timers of one event loop instead of a thread per query
+'''
+class StubUpstream(asyncio.DatagramProtocol):
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.answer = dns_wire.address_record("1.2.3.4", 60)
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, client_address):
+        try:
+            query = dns_wire.parse_query(data)
+        except ValueError:
+            return
+        response = dns_wire.build_response(query, answers=self.answer, ancount=1)
+        asyncio.get_running_loop().call_later(self.latency, self.transport.sendto, response, client_address)
+
+
+def run_stub_upstream(port, latency, ready):
+    async def serve():
+        await asyncio.get_running_loop().create_datagram_endpoint(lambda: StubUpstream(latency),
+                                                                  local_addr=('127.0.0.1', port))
+        ready.set()
+        await asyncio.Future()  # serve until terminated
+
+    signal.signal(signal.SIGTERM, stop_on_signal)
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+QUERY_KINDS = ('blocked', 'forwarded', 'tunnel', 'malformed')
+
+
+'''
+"blocked=0.5,forwarded=0.5" -> {'blocked': 0.5, 'forwarded': 0.5}
+'''
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        kind, _, share = part.partition('=')
+        if kind not in QUERY_KINDS:
+            raise argparse.ArgumentTypeError(f"query kind must be one of {QUERY_KINDS}")
+        mix[kind] = float(share)
+    return mix
+
+
+def malformed_packet(query):
+    variant = random.randrange(3)
+    if variant == 0:
+        return query[:random.randrange(2, len(query))]  # truncated
+    if variant == 1:
+        return bytes(random.getrandbits(8) for _ in range(random.randrange(1, 64)))  # noise
+    # a valid header followed by a label that runs past the end of the packet
+    return query[:12] + bytes([63]) + b'x' * 10
+
+
+'''
+returns a list of (kind, packet) with the kinds drawn from mix, ex: {'blocked': 0.5, 'forwarded': 0.5}
+'''
+def build_queries(count, mix, records_file_path, tunnel_file="luceafarul"):
+    with open(records_file_path, 'r') as file:
+        blocked_names = list(json.load(file).keys())
+    tunnel_chunks = 1
+    if os.path.exists(f"tunnel_files/{tunnel_file}.txt"):
+        tunnel_chunks = max(1, (os.path.getsize(f"tunnel_files/{tunnel_file}.txt") + 149) // 150)
+
+    kinds = random.choices(list(mix), weights=list(mix.values()), k=count)
+    queries = []
+    for i, kind in enumerate(kinds):
+        if kind == 'blocked':
+            packet = dns_wire.build_query(i % 65536, random.choice(blocked_names), dns_wire.TYPE_A)
+        elif kind == 'tunnel':
+            name = f"chunk{random.randrange(tunnel_chunks)}.{tunnel_file}.tunnel.broski.software."
+            packet = dns_wire.build_query(i % 65536, name, dns_wire.TYPE_TXT)
+        else:
+            packet = dns_wire.build_query(i % 65536, f"host{i}.forwarded.example.", dns_wire.TYPE_A)
+            if kind == 'malformed':
+                packet = malformed_packet(packet)
+        queries.append((kind, packet))
+    return queries
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+'''
+sends the queries from socket_count sockets, either keeping at most concurrency of them outstanding or, when a
+rate is given, at that many queries per second whatever the answers (open loop, so a slow server shows up as
+latency and drops instead of a lower send rate). returns the stats per query kind and in total
+'''
+def run_load(server_address, queries, concurrency, timeout, rate=None, socket_count=1):
+    sockets = []
+    for _ in range(socket_count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sockets.append(sock)
+    socket_index = {sock: index for index, sock in enumerate(sockets)}
+
+    outstanding = {}  # (socket index, dns id) -> (kind, send time)
+    latencies = {kind: [] for kind in QUERY_KINDS}
+    sent = {kind: 0 for kind in QUERY_KINDS}
+    answered = {kind: 0 for kind in QUERY_KINDS}
+    next_query = 0
+    start = time.perf_counter()
+
+    while next_query < len(queries) or outstanding:
+        now = time.perf_counter()
+        while next_query < len(queries):
+            if rate is not None:
+                if now < start + next_query / rate:
+                    break
+            elif len(outstanding) >= concurrency:
+                break
+            kind, packet = queries[next_query]
+            index = next_query % socket_count
+            sockets[index].sendto(packet, server_address)
+            sent[kind] += 1
+            if kind != 'malformed':  # the server drops these, nothing to wait for
+                outstanding[(index, int.from_bytes(packet[:2], 'big'))] = (kind, now)
+            next_query += 1
+
+        wait = 0.05
+        if rate is not None and next_query < len(queries):
+            wait = max(0, min(wait, start + next_query / rate - time.perf_counter()))
+        readable, _, _ = select.select(sockets, [], [], wait)
+        for sock in readable:
+            while True:
+                try:
+                    data, _ = sock.recvfrom(4096)
+                except BlockingIOError:
+                    break
+                entry = outstanding.pop((socket_index[sock], int.from_bytes(data[:2], 'big')), None)
+                if entry is not None:
+                    kind, sent_at = entry
+                    answered[kind] += 1
+                    latencies[kind].append(time.perf_counter() - sent_at)
+
+        # forget the queries that were never answered
+        now = time.perf_counter()
+        for key in [key for key, (_, sent_at) in outstanding.items() if now - sent_at > timeout]:
+            del outstanding[key]
+
+    elapsed = time.perf_counter() - start
+    for sock in sockets:
+        sock.close()
+
+    def summary(kinds):
+        values = sorted(latency for kind in kinds for latency in latencies[kind])
+        expected = sum(sent[kind] for kind in kinds if kind != 'malformed')
+        result = {"sent": sum(sent[kind] for kind in kinds), "answered": sum(answered[kind] for kind in kinds),
+                  "drop_rate": round(1 - len(values) / expected, 4) if expected else None}
+        for name, fraction in (("p50_ms", 0.5), ("p99_ms", 0.99), ("p999_ms", 0.999)):
+            value = percentile(values, fraction)
+            result[name] = round(value * 1000, 3) if value is not None else None
+        return result
+
+    total = summary(QUERY_KINDS)
+    total["elapsed"] = round(elapsed, 3)
+    total["qps"] = round(total["answered"] / elapsed, 1)
+    return {"total": total, "kinds": {kind: summary([kind]) for kind in QUERY_KINDS if sent[kind]}}
+
+
+'''
+the server under test, run in its own process so it does not share an interpreter with the load generator
+'''
+def run_server(mode, port, upstream_address, records_file_path, max_inflight, workers):
+    signal.signal(signal.SIGTERM, stop_on_signal)
+    with DNSPiHole(records_file_path=records_file_path,
+                   pid_file_path=os.path.join(tempfile.gettempdir(), f"dns_benchmark_{port}.pid"),
+                   max_inflight_upstream=max_inflight, blocked_log_path=os.devnull,
+                   upstream_servers=[upstream_address]) as server:
+        if mode == 'blocking':
+            server.start_blocking(host='127.0.0.1', port=port)
+        elif workers == 1:
+            server.start(host='127.0.0.1', port=port)
+        else:
+            server.start_workers(host='127.0.0.1', port=port, workers=workers or None)
+
+
+'''
+True once the server answers a query for the root, False if it does not within timeout seconds
+'''
+def wait_until_answering(server_address, timeout=10):
+    probe = dns_wire.build_query(0, '.', dns_wire.TYPE_A)
+    deadline = time.monotonic() + timeout
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(0.1)
+        while time.monotonic() < deadline:
+            sock.sendto(probe, server_address)
+            try:
+                sock.recvfrom(4096)
+                return True
+            except (socket.timeout, ConnectionRefusedError):
+                continue
+    return False
+
+
+def start_stub_upstream(port, latency):
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=run_stub_upstream, args=(port, latency, ready), daemon=True)
+    process.start()
+    if not ready.wait(10):
+        stop_process(process)
+        raise RuntimeError(f"the stub upstream did not start on port {port}")
+    return process
+
+
+def start_server(mode, port, upstream_address, records_file_path, max_inflight, workers=1):
+    process = multiprocessing.Process(target=run_server, daemon=True,
+                                      args=(mode, port, upstream_address, records_file_path, max_inflight, workers))
+    process.start()
+    if not wait_until_answering(('127.0.0.1', port)):
+        stop_process(process)
+        raise RuntimeError(f"the {mode} server did not answer on port {port}")
+    return process
+
+
+def stop_process(process):
+    process.terminate()
+    process.join(10)
+    if process.is_alive():
+        process.kill()
+        process.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="throughput and latency of DNSPiHole under a mix of queries")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--mix", type=parse_mix, default={'blocked': 0.5, 'forwarded': 0.5},
+                        help="share of each query kind, ex: blocked=0.4,forwarded=0.4,tunnel=0.1,malformed=0.1")
+    parser.add_argument("--concurrency", type=int, default=50, help="queries kept outstanding by the client")
+    parser.add_argument("--rate", type=float, help="queries/sec sent regardless of the answers, instead of --concurrency")
+    parser.add_argument("--sockets", type=int, default=1, help="client sockets the queries are spread over")
+    parser.add_argument("--upstream-latency", type=float, default=0.05, help="seconds")
+    parser.add_argument("--max-inflight", type=int, default=64, help="upstream cap of the async server")
+    parser.add_argument("--workers", type=int, default=1, help="processes of the async server, 0 = one per core")
+    parser.add_argument("--upstream-port", type=int, default=15300, help="port of the stub upstream")
+    parser.add_argument("--records", default="dns_records.json")
+    parser.add_argument("--tunnel-file", default="luceafarul", help="file the tunnel queries ask chunks of")
+    parser.add_argument("--modes", nargs="+", default=["blocking", "async"], choices=["blocking", "async"])
+    parser.add_argument("--json", help="write the results to this file, - for stdout")
+    args = parser.parse_args()
+
+    # the stub upstream, the server and this load generator each run in their own process
+    upstream = start_stub_upstream(args.upstream_port, args.upstream_latency)
+    queries = build_queries(args.queries, args.mix, args.records, args.tunnel_file)
+
+    results = {}
+    for port, mode in enumerate(args.modes, start=15353):
+        server = start_server(mode, port, ('127.0.0.1', args.upstream_port), args.records, args.max_inflight,
+                              args.workers)
+        try:
+            results[mode] = run_load(('127.0.0.1', port), queries, args.concurrency, timeout=5, rate=args.rate,
+                                     socket_count=args.sockets)
+        finally:
+            stop_process(server)
+        total = results[mode]["total"]
+        print(f"{mode:<9} {total['answered']}/{total['sent']} answered in {total['elapsed']:.2f}s -> "
+              f"{total['qps']:.0f} queries/sec, p50 {total['p50_ms']} ms, p99 {total['p99_ms']} ms, "
+              f"p999 {total['p999_ms']} ms, drop rate {total['drop_rate']}")
+
+    if args.json:
+        output = json.dumps({"queries": args.queries, "mix": args.mix, "rate": args.rate, "sockets": args.sockets,
+                             "upstream_latency": args.upstream_latency, "workers": args.workers,
+                             "results": results}, indent=2)
+        if args.json == '-':
+            print(output)
+        else:
+            with open(args.json, 'w') as file:
+                file.write(output)
+    stop_process(upstream)
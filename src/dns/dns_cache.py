@@ -0,0 +1,160 @@
+'''
+in-memory cache of upstream answers keyed by (qname, qtype, qclass) and the EDNS0 of the query: no OPT
+record, OPT, or OPT with the DO bit. an answer carries an OPT record (and DNSSEC records) only if its query
+asked for them, so it is only reused for clients that asked the same way (rfc 6891, rfc 3225). entries live
+for the minimum ttl of the answer (or the SOA negative ttl for NXDOMAIN/NODATA) and are evicted least
+recently used first once the memory budget is exceeded
+
+every entry counts its hits. a popular entry (prefetch_hits hits) that is hit in the last prefetch_fraction of
+its ttl is claimed for a refresh in the background, so its clients do not wait for the upstream when it
+expires. expired entries are kept for max_stale seconds more and served (with a short ttl) when the upstream
+does not answer (serve-stale, rfc 8767)
+'''
+import time
+from collections import OrderedDict
+
+import dns_wire
+
+
+ENTRY_OVERHEAD = 200  # rough size in bytes of the python objects kept around every cached answer
+
+
+class CacheEntry:
+    def __init__(self, response, question_end, ttl_offsets, stored_at, ttl, hits=0):
+        self.response = response
+        self.question_end = question_end
+        self.ttl_offsets = ttl_offsets
+        self.stored_at = stored_at
+        self.ttl = ttl
+        self.expires_at = stored_at + ttl
+        self.size = len(response) + ENTRY_OVERHEAD
+        self.hits = hits  # carried over from the entry it replaced, a popular name stays popular
+        self.prefetching = False  # a refresh was started
+
+
+class DNSAnswerCache:
+    def __init__(self, max_bytes=16 * 1024 * 1024, max_ttl=86400, max_negative_ttl=900, prefetch_hits=3,
+                 prefetch_fraction=0.1, max_stale=86400, stale_ttl=30):
+        self.entries = OrderedDict()  # least recently used first
+        self.max_bytes = max_bytes
+        self.max_ttl = max_ttl
+        self.max_negative_ttl = max_negative_ttl
+        self.prefetch_hits = prefetch_hits  # hits that make an entry worth refreshing before it expires
+        self.prefetch_fraction = prefetch_fraction  # refreshed when it is hit in this last share of its ttl
+        self.max_stale = max_stale  # seconds an expired answer may still be served, 0 disables serve-stale
+        self.stale_ttl = stale_ttl  # ttl of a stale answer, rfc 8767 recommends 30 seconds
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.prefetches = 0
+        self.stale_hits = 0
+
+    '''
+    the EDNS0 part is None without an OPT record, otherwise the DO bit. the udp size is not part of it, an
+    answer too big for a client is truncated when it is sent
+    '''
+    @staticmethod
+    def key(query):
+        edns = dns_wire.edns_options(query)
+        return query.qname.lower(), query.qtype, query.qclass, edns and edns[1]
+
+    '''
+    returns the cached answer for query with its transaction id and question copied in and the ttls
+    counted down, or None on a miss
+    '''
+    def get(self, query):
+        key = self.key(query)
+        entry = self.entries.get(key)
+        now = time.monotonic()
+        if entry is None or entry.expires_at <= now:
+            if entry is not None and entry.expires_at + self.max_stale <= now:
+                self.remove(key)
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        entry.hits += 1
+        elapsed = int(now - entry.stored_at)
+        return self.answer(entry, query, [(offset, max(ttl - elapsed, 0)) for offset, ttl in entry.ttl_offsets])
+
+    '''
+    the stored response with the question copied from the query, so the client sees its own id and letter case
+    '''
+    @staticmethod
+    def answer(entry, query, ttls):
+        response = bytearray(entry.response)
+        response[0:2] = query.data[0:2]
+        if entry.question_end == query.question_end:
+            response[dns_wire.HEADER.size:entry.question_end] = query.data[dns_wire.HEADER.size:query.question_end]
+        for offset, ttl in ttls:
+            dns_wire.TTL.pack_into(response, offset, ttl)
+        return bytes(response)
+
+    '''
+    True once for a popular entry that is about to expire, the caller refreshes it from the upstream
+    '''
+    def claim_prefetch(self, query):
+        entry = self.entries.get(self.key(query))
+        if entry is None or entry.prefetching or entry.hits < self.prefetch_hits:
+            return False
+        if entry.expires_at - time.monotonic() > entry.ttl * self.prefetch_fraction:
+            return False
+        entry.prefetching = True
+        self.prefetches += 1
+        return True
+
+    '''
+    an expired answer for query that is at most max_stale seconds old, with every ttl set to stale_ttl.
+    only used when the upstream did not answer
+    '''
+    def get_stale(self, query):
+        entry = self.entries.get(self.key(query))
+        if entry is None or entry.expires_at + self.max_stale <= time.monotonic():
+            return None
+        self.stale_hits += 1
+        return self.answer(entry, query, [(offset, self.stale_ttl) for offset, _ in entry.ttl_offsets])
+
+    '''
+    stores an upstream response for query. responses that do not match the question, truncated
+    responses and server failures are not cached
+    '''
+    def put(self, query, response_data):
+        try:
+            response = dns_wire.parse_response(response_data)
+        except (ValueError, IndexError):
+            return
+
+        question = response.query
+        key = self.key(query)
+        if (question.qname.lower(), question.qtype, question.qclass) != key[:3] or question.flags & dns_wire.TC:
+            return
+
+        if response.rcode == dns_wire.NOERROR and response.ancount > 0:
+            ttl = min(response.min_answer_ttl, self.max_ttl)
+        elif response.rcode in (dns_wire.NOERROR, dns_wire.NXDOMAIN) and response.negative_ttl is not None:
+            ttl = min(response.negative_ttl, self.max_negative_ttl)  # NODATA / NXDOMAIN
+        else:
+            return
+        if ttl <= 0:
+            return
+
+        hits = 0
+        if key in self.entries:
+            hits = self.entries[key].hits
+            self.remove(key)
+        entry = CacheEntry(response_data, response.query.question_end, response.ttl_offsets, time.monotonic(), ttl,
+                           hits)
+        self.entries[key] = entry
+        self.size += entry.size
+
+        while self.size > self.max_bytes:
+            oldest_key = next(iter(self.entries))
+            self.remove(oldest_key)
+
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= entry.size
+
+    def __len__(self):
+        return len(self.entries)
@@ -1,36 +1,111 @@
+import argparse
+import asyncio
 import json
 import socket
 import os
+import signal
 import sys
-from datetime import datetime, timedelta
-import base64
+import threading
+import time
 
-from scapy.layers.dns import DNS, DNSRR
+import dns_wire
+from block_logger import BlockEventLogger
+from dns_cache import DNSAnswerCache
+from domain_trie import RecordIndex
+import metrics
+from blocklist_index import COMPILED_EXTENSION, CompiledRecordIndex
+from rate_limit import ALLOW, SLIP, RateLimiter
+from upstream_pool import UpstreamPool
+from tunnel_store import TunnelFileStore
 
 
 class DNSPiHole:
-    def __init__(self, records_file_path="dns_records.json", pid_file_path="dns_server.pid"):
+    def __init__(self, records_file_path="dns_records.json", pid_file_path="dns_server.pid", max_inflight_upstream=64,
+                 max_queued_upstream=256, cache_max_bytes=16 * 1024 * 1024, upstream_pool_size=4, reload_interval=2,
+                 blocked_log_path="blocked_domains.md", blocked_log_format="markdown", upstream_servers=None,
+                 upstream_hedging=True, rate_limiter=None, tcp_idle_timeout=10, max_tcp_connections=256,
+                 max_tcp_pipeline=32, metrics_host='127.0.0.1', metrics_port=None):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, proto=socket.IPPROTO_UDP)  # simple udp sock
         self.records_file_path = records_file_path
-        self.records = self.load_records(records_file_path)
+        self.records_signature = self.file_signature(records_file_path)
+        self.records = self.load_index(records_file_path)  # exact names + "*." suffix rules
+        self.reload_interval = reload_interval  # seconds between checks of the records file, None to disable
+        self.reload_requested = threading.Event()  # set by SIGHUP
         self.ttl = 300
         self.upstream_dns = "8.8.8.8"  # google dns
+        self.upstream_port = 53
+        self.upstream_servers = upstream_servers  # [(ip, port), ...], None for upstream_dns only
+        self.upstream_hedging = upstream_hedging  # race a second upstream when the first is slower than usual
+        self.upstream_timeout = 3  # seconds
+        self.max_inflight_upstream = max_inflight_upstream  # cap on concurrent forwards in async mode
+        self.max_queued_upstream = max_queued_upstream  # forwards that may wait for a slot, the others are dropped
+        self.upstream_waiting = 0
+        self.upstream_shed = 0  # forwards dropped because no slot was free in time
+        self.upstream_pool_size = upstream_pool_size  # long-lived upstream sockets in async mode
+        self.upstream_pool = None
+        self.cache = DNSAnswerCache(max_bytes=cache_max_bytes)  # upstream answers, lru with a memory budget
         self.pid_file_path = pid_file_path
+        self.block_logger = BlockEventLogger(blocked_log_path, log_format=blocked_log_format)  # markdown or jsonl
+        self.block_logger.start()
+        self.tunnel_files = TunnelFileStore("tunnel_files")  # tunnel files read once, chunks served by offset
+        self.max_udp_payload = 1232  # upper bound for the EDNS0 size advertised by tunnel clients
+        self.answer_templates = {}  # (rdata, qtype) -> serialized answer section for local records
+        self.rate_limiter = rate_limiter  # RateLimiter for queries per client and identical responses, None = off
+        self.tcp_idle_timeout = tcp_idle_timeout  # seconds a tcp connection may stay open without queries
+        self.max_tcp_connections = max_tcp_connections
+        self.max_tcp_pipeline = max_tcp_pipeline  # queries of one tcp connection answered at the same time
+        self.tcp_connections = 0
+        self.reuse_port = False  # set in the workers of start_workers
+        self.metrics = metrics.ResolverMetrics()  # query counters and latency histograms by outcome
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port  # prometheus text on http://metrics_host:metrics_port/metrics, None = off
+        self.pending_tasks = set()  # references to the running forward tasks so they are not garbage collected
+        self.inflight_forwards = {}  # (qname, qtype, qclass) -> shared upstream forward
+        self.worker_pids = {}  # worker process id -> worker index, in supervisor mode
+        self.stopping = False
 
     def __enter__(self):
         if os.path.exists(self.pid_file_path):
-            print(f"PID file {self.pid_file_path} already exists. Another instance may be running.")
-            sys.exit(1)
-        with open(self.pid_file_path, 'w') as file:
-            file.write(str(os.getpid()))
+            # the file lists the supervisor and its workers, it is stale if none of them is running
+            if any(self.pid_running(pid) for pid in self.read_pid_file()):
+                print(f"PID file {self.pid_file_path} already exists. Another instance may be running.")
+                sys.exit(1)
+            print(f"Removing stale PID file {self.pid_file_path}")
+        self.write_pid_file()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        self.stop_workers()
         if os.path.exists(self.pid_file_path):
             os.remove(self.pid_file_path)
         self.sock.close()
+        self.block_logger.close()
         print("Server stopped.")
 
+    '''
+    first line: this process, then one line per worker process
+    '''
+    def write_pid_file(self):
+        with open(self.pid_file_path, 'w') as file:
+            file.write('\n'.join(str(pid) for pid in [os.getpid(), *self.worker_pids]) + '\n')
+
+    def read_pid_file(self):
+        try:
+            with open(self.pid_file_path, 'r') as file:
+                return [int(line) for line in file.read().split() if line.isdigit()]
+        except OSError:
+            return []
+
+    @staticmethod
+    def pid_running(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:  # exists, owned by another user
+            return True
+        return True
+
     '''
     loads the records from disk. returns a default record if the file path is not found
     '''
@@ -48,7 +123,65 @@ class DNSPiHole:
             return default_records
 
     '''
-    checks if a given domain exists in the records, and returns its ip address
+    builds the lookup structure for the records. compiled blocklists are mmapped instead of parsed
+    '''
+    def load_index(self, records_file_path):
+        if records_file_path.endswith(COMPILED_EXTENSION):
+            return CompiledRecordIndex(records_file_path)
+        return RecordIndex(self.load_records(records_file_path))
+
+    @staticmethod
+    def file_signature(path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    '''
+    rebuilds the lookup structure from the records file and swaps it in with a single assignment, so queries
+    keep using the old index until the new one is complete. replace compiled blocklists with a rename,
+    the new file is mapped and the old mapping is released once no lookup uses it anymore
+    '''
+    def reload_records(self):
+        signature = self.file_signature(self.records_file_path)
+        try:
+            if self.records_file_path.endswith(COMPILED_EXTENSION):
+                new_records = CompiledRecordIndex(self.records_file_path)
+                summary = f"{len(new_records)} records"
+            else:
+                with open(self.records_file_path, 'r') as file:
+                    new_records = RecordIndex(json.load(file), previous=self.records)
+                changed, removed = new_records.diff(self.records)
+                summary = f"{len(new_records)} records, {changed} added or changed, {removed} removed"
+        except (OSError, ValueError) as e:  # ex: the file is being written, retry on the next change
+            print(f"Error reloading {self.records_file_path}: {e}")
+            return False
+
+        self.records = new_records
+        self.records_signature = signature
+        print(f"Reloaded {self.records_file_path}: {summary}")
+        return True
+
+    '''
+    background thread: reloads the records when the file changes (checked every reload_interval seconds)
+    or when SIGHUP is received
+    '''
+    def watch_records(self):
+        while True:
+            requested = self.reload_requested.wait(timeout=self.reload_interval)
+            self.reload_requested.clear()
+            if requested or (self.reload_interval is not None and
+                             self.file_signature(self.records_file_path) != self.records_signature):
+                self.reload_records()
+
+    def start_reload_watcher(self):
+        if threading.current_thread() is threading.main_thread() and hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.reload_requested.set())
+        threading.Thread(target=self.watch_records, daemon=True).start()
+
+    '''
+    checks if a given domain exists in the records (exactly or under a "*." suffix rule), and returns its ip address
     '''
     def get_record(self, domain):
         # check if the domain has the default character at the end
@@ -56,173 +189,639 @@ class DNSPiHole:
             domain += '.'
 
         # check if the record exists and return it
-        if domain in self.records:
-            return self.records[domain]
-        else:
-            return None
+        return self.records.lookup(domain)
+
+    def upstream_addresses(self):
+        return self.upstream_servers or [(self.upstream_dns, self.upstream_port)]
 
     '''
     sends a dns request to the upstream dns server and returns the response or None if it times out (withing 3 seconds)
     '''
     def dns_upstream_request(self, request):
         upstream_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        upstream_sock.settimeout(3)  # request timeout 3 seconds
+        upstream_sock.settimeout(self.upstream_timeout)  # request timeout 3 seconds
+        upstream_address = self.upstream_addresses()[0]  # the blocking loop only uses the first upstream
 
         try:
-            upstream_sock.sendto(request, (self.upstream_dns, 53))
+            upstream_sock.sendto(request, upstream_address)
             response, _ = upstream_sock.recvfrom(4096)
             return response
         except socket.timeout:
-            print(f"Sent request to upstream DNS server but no response received within {3} seconds.")
+            print(f"Sent request to upstream DNS server but no response received within {self.upstream_timeout} seconds.")
             return None
         finally:
             upstream_sock.close()
 
     '''
-    create a dns packet response based on the original request using the data from the records
+    async version of dns_upstream_request, multiplexed over the long-lived sockets of the upstream pool.
+    at most max_inflight_upstream forwards are in flight at the same time, the others wait for a free slot.
+    returns None if no response is received within the upstream timeout or the forward is shed
+    '''
+    async def dns_upstream_request_async(self, query):
+        if not await self.acquire_upstream_slot():
+            return None
+        try:
+            return await self.upstream_pool.query(query)
+        finally:
+            self.upstream_slots.release()
+
+    '''
+    takes one of the max_inflight_upstream slots. a forward waits at most upstream_timeout for it (its client
+    has given up by then) and at most max_queued_upstream forwards wait, so a flood of unique names cannot
+    build a queue that every later client waits behind. returns False if the forward is shed
+    '''
+    async def acquire_upstream_slot(self):
+        if not self.upstream_slots.locked():
+            return await self.upstream_slots.acquire()  # a free slot, taken without suspending
+        if self.upstream_waiting >= self.max_queued_upstream:
+            self.upstream_shed += 1
+            return False
+
+        # not wait_for: before python 3.12 it can lose a slot acquired right as the wait times out
+        acquire = asyncio.ensure_future(self.upstream_slots.acquire())
+        acquired = False
+        self.upstream_waiting += 1
+        try:
+            await asyncio.wait({acquire}, timeout=self.upstream_timeout)
+            acquired = acquire.done()
+        finally:
+            self.upstream_waiting -= 1
+            if not acquired:
+                if acquire.done():
+                    self.upstream_slots.release()  # acquired just as this forward was cancelled
+                else:
+                    acquire.cancel()
+        if not acquired:
+            self.upstream_shed += 1
+        return acquired
+
     '''
-    def create_response(self, query_packet, domain_name, record_type, rdata):
+    create a dns response based on the original request using the data from the records
+    '''
+    def create_response(self, query, domain_name, record_type, rdata):
         if rdata is None:  # return non existent domain
-            return DNS(
-                id=query_packet[DNS].id,  # dns replies must have the same id as the request
-                qr=1,  # 1 for response
-                aa=0,  # non-authoritative answer
-                rcode=3,  # error code 3 means non existent domain
-                qd=query_packet[DNS].qd  # original request
-            )
-
-        # to convert back to numeric type for the scapy constructor
-        record_type_codes = {
-            'A': 1,
-            'NS': 2,
-            'CNAME': 5,
-            'SOA': 6,
-            'PTR': 12,
-            'MX': 15,
-            'TXT': 16,
-            'AAAA': 28,
-            'HTTPS': 65
-        }
-        
-        return DNS(
-            id=query_packet[DNS].id,  # dns replies must have the same id as the request
-            qr=1,  # 1 for response
-            aa=1,  # authoritative answer
-            rcode=0,  # no error
-            qd=query_packet[DNS].qd,  # original request
-            an=DNSRR(  # dns resource record
-                rrname=domain_name,  # domain name
-                ttl=self.ttl,
-                type=record_type_codes.get(record_type, 1),  # type of record
-                rclass='IN',  # internet class
-                rdata=rdata  # use value as is
-            )
-        )
-
-    def tunnel_response(self, query_packet, domain_name):
+            return dns_wire.build_response(query, rcode=dns_wire.NXDOMAIN)
+
+        # the answer section only depends on the address and the query type, so it is serialized once
+        # (with a compression pointer to the question name) and only the header and question are per query
+        template = self.answer_templates.get((rdata, record_type))
+        if template is None:
+            if len(self.answer_templates) >= 4096:  # a records file with many distinct addresses
+                self.answer_templates.clear()
+            template = dns_wire.address_answer(rdata, record_type, self.ttl)
+            self.answer_templates[(rdata, record_type)] = template
+        answers, ancount = template
+        return dns_wire.build_response(query, aa=True, answers=answers, ancount=ancount)
+
+    '''
+    answers a tunnel query with one TXT record per chunk. ex: chunk0.example.tunnel.broski.software asks for
+    chunk 0, chunk10-17.example.tunnel.broski.software asks for chunks 10 to 17. a range is answered with as
+    many chunks as fit in the udp payload size the client advertised with EDNS0 (512 bytes without EDNS0, up
+    to 64 KiB over tcp), in order, so the client knows which chunks it got. an empty record marks the end of the file.
+    info.example.tunnel.broski.software returns "chunks=<count> size=<bytes>" so clients can pipeline requests
+    without probing for the end of the file. over udp the chunks count against the client's tunnel budget.
+    returns (outcome, response)
+    '''
+    def tunnel_response(self, query, domain_name, client_address, tcp=False):
         # ex: chunk0.example.tunnel.broski.software -> chunk0
+        # chunk0.example.zlib.tunnel.broski.software asks for the zlib compressed file
         parts = domain_name.split('.')
         chunk_part = parts[0]
         file_name = parts[1]
+        codec = parts[2] if len(parts) > 2 and parts[2] != 'tunnel' else None
 
         # not requesting any chunk
-        if not chunk_part.startswith("chunk"):
-            return DNS(
-                id=query_packet[DNS].id,  # dns replies must have the same id as the request
-                qr=1,  # 1 for response
-                aa=0,  # non-authoritative answer
-                rcode=3,  # error code 3 means non existent domain
-                qd=query_packet[DNS].qd  # original request
-            )
-
-        # extracting the index
-        chunk_index = int(chunk_part[5:])
-
-        # reading the binary file
-        with open(f"tunnel_files/{file_name}.txt", "rb") as file:
-            binary_data = file.read()
-        
-        # encode the binary data to base64
-        encoded_data = base64.b64encode(binary_data).decode('utf-8')
-
-        # split the encoded data into chunks of 200 characters - leaving space for overhead
-        chunk_size = 200
-        chunks = [encoded_data[i : i + chunk_size]
-                for i in range(0, len(encoded_data), chunk_size)]
-
-        # getting the encoded binary chunk
-        chunk_data = "" if chunk_index >= len(chunks) else chunks[chunk_index]
-        formatted_chunk = [chunk_data.encode('utf-8')]
+        if not chunk_part.startswith("chunk") and chunk_part != "info":
+            return metrics.TUNNEL, dns_wire.build_response(query, rcode=dns_wire.NXDOMAIN)
+
+        if chunk_part == "info":
+            tunnel_file = self.tunnel_files.get(file_name, codec)
+            if tunnel_file is None:
+                return metrics.TUNNEL, dns_wire.build_response(query, rcode=dns_wire.NXDOMAIN)
+            info = f"chunks={tunnel_file.chunk_count} size={len(tunnel_file.data)}".encode('ascii')
+            return metrics.TUNNEL, dns_wire.build_response(query, aa=True, answers=dns_wire.txt_record([info], 0),
+                                                           ancount=1)
+
+        # extracting the index or the range of indexes
+        first_index, _, last_index = chunk_part[5:].partition('-')
+        first_index = int(first_index)
+        last_index = int(last_index) if last_index else first_index
+
+        # the file is read (and compressed) once, later chunks are sliced from the cached copy
+        tunnel_file = self.tunnel_files.get(file_name, codec)
+        if tunnel_file is None:
+            return metrics.TUNNEL, dns_wire.build_response(query, rcode=dns_wire.NXDOMAIN)
+
+        udp_size = dns_wire.edns_udp_size(query)
+        additional = dns_wire.opt_record(self.max_udp_payload) if udp_size is not None else b''
+        payload_limit = min(udp_size or dns_wire.MIN_UDP_PAYLOAD, self.max_udp_payload)
+        if tcp:
+            payload_limit = dns_wire.MAX_TCP_MESSAGE
+        response_size = query.question_end + len(additional)
+
+        answers = []
+        for chunk_index in range(first_index, last_index + 1):
+            # getting the encoded binary chunk (200 base64 characters, empty past the end of the file)
+            chunk_data = tunnel_file.chunk(chunk_index)
+            answer = dns_wire.txt_record([chunk_data], self.ttl)
+            if answers and response_size + len(answer) > payload_limit:
+                break
+            answers.append(answer)
+            response_size += len(answer)
+            if not chunk_data:
+                break
+
+        # every chunk has its own name, response rate limiting never sees two identical answers
+        if not tcp and self.rate_limiter is not None:
+            granted = self.rate_limiter.check_tunnel(client_address[0], len(answers))
+            if not granted:
+                return metrics.LIMITED, dns_wire.build_response(query, tc=True)  # no bigger than the query
+            del answers[granted:]
 
         # create a DNS response with the chunks as TXT records
-        return DNS(
-            id=query_packet[DNS].id,  # dns replies must have the same id as the request
-            qr=1,  # 1 for response
-            aa=1,  # authoritative answer
-            rcode=0,  # no error
-            qd=query_packet[DNS].qd,  # original request
-            an=DNSRR(  # dns resource record
-                rrname=domain_name,  # domain name
-                ttl=self.ttl,
-                type='TXT',  # type of record
-                rclass='IN',  # internet class
-                rdata=formatted_chunk  # chunks of base32 encoded data
-            )
-        )
+        return metrics.TUNNEL, dns_wire.build_response(query, aa=True, answers=b''.join(answers), ancount=len(answers),
+                                       additional=additional, arcount=1 if additional else 0)
+
+    '''
+    reads the header and the question from the payload. returns None if it is not a standard query
+    '''
+    def parse_request(self, request_data):
+        query = dns_wire.parse_query(request_data)
+
+        if query.flags & dns_wire.QR or query.opcode != 0: # opcode 0 means standard query
+            print("Invalid DNS request")
+            return None
+        return query
+
+    '''
+    answers the query from local data (root, tunnel files, records, cached upstream answers).
+    returns (outcome, response), the response is None if it has to be forwarded upstream
+    '''
+    def local_response(self, query, client_address, tcp=False):
+        # get the domain name from the query
+        domain_name = query.qname.lower()
+        # if we dig without an explicit domain name
+        if domain_name == '.':
+            return metrics.LOCAL, dns_wire.build_response(query)  # non-authoritative, no error
+
+        if domain_name.endswith('tunnel.broski.software.'):
+            return self.tunnel_response(query, domain_name, client_address, tcp)
+
+        # get record type code
+        record_type = query.qtype
+
+        # get the record from the local records if it exists
+        rdata = self.get_record(domain_name)
+
+        # if the record exists, respond with it
+        if rdata is not None:
+            # log the blocked domain (written in batches by the logger thread)
+            self.block_logger.log(domain_name, client_address)
+            return metrics.BLOCKED, self.create_response(query, domain_name, record_type, rdata)
+
+        response = self.cache.get(query)
+        if response is None:
+            return metrics.FORWARDED, None
+        if self.upstream_pool is not None and self.cache.claim_prefetch(query):
+            self.prefetch(query)  # popular and about to expire, refreshed before the next client has to wait
+        return metrics.CACHED, response
+
+    '''
+    refreshes the cached answer of query in the background (async mode only)
+    '''
+    def prefetch(self, query):
+        task = asyncio.ensure_future(self.coalesced_upstream_request(query))
+        self.pending_tasks.add(task)
+        task.add_done_callback(self.pending_tasks.discard)
+
+    '''
+    None if the client is within its query rate, otherwise what to send instead: a truncated empty answer
+    (the client should retry over tcp) or b'' to drop the query
+    '''
+    def limit_query(self, query, client_address):
+        if self.rate_limiter is None:
+            return None
+        action = self.rate_limiter.check_query(client_address[0])
+        if action == ALLOW:
+            return None
+        return dns_wire.build_response(query, tc=True) if action == SLIP else b''
+
+    '''
+    response rate limiting: the response to send, a truncated empty answer instead of it, or None to drop it
+    '''
+    def limit_response(self, query, response, client_address):
+        if self.rate_limiter is None:
+            return response
+        action = self.rate_limiter.check_response(client_address[0], query, dns_wire.response_rcode(response))
+        if action == ALLOW:
+            return response
+        return dns_wire.build_response(query, tc=True) if action == SLIP else None
+
+    '''
+    a cached or shared answer may come from a query that advertised a bigger udp payload than this client.
+    if it is bigger than the client accepts (512 bytes without EDNS0) it is replaced by an empty truncated
+    answer and the client asks again over tcp (rfc 1035, rfc 6891)
+    '''
+    def fit_udp(self, query, response):
+        if len(response) <= dns_wire.MIN_UDP_PAYLOAD:
+            return response
+        edns = dns_wire.edns_options(query)
+        if edns is not None and len(response) <= edns[0]:
+            return response
+        additional = dns_wire.opt_record(self.max_udp_payload) if edns is not None else b''
+        return dns_wire.build_response(query, rcode=dns_wire.response_rcode(response), tc=True,
+                                       additional=additional, arcount=1 if additional else 0)
 
     def handle_dns_request(self, request_data, client_address):
         try:
-            # convert payload to scapy packet
-            dns_packet = DNS(request_data)
-            dns_layer = dns_packet.getlayer(DNS)
-            query_section = dns_layer.qd
-
-            if dns_layer is None or dns_layer.opcode != 0 or query_section is None: # opcode 0 means standard query
-                print("Invalid DNS request")
+            query = self.parse_request(request_data)
+            if query is None:
                 return None
 
-            # get the domain name from the query
-            domain_name = query_section.qname.decode() if hasattr(query_section.qname, 'decode') else str(query_section.qname)
-            # if we dig without an explicit domain name
-            if domain_name == '.':
-                return DNS(
-                    id=dns_packet.id,
-                    qr=1,  # 1 for response
-                    aa=0,  # non-authoritative answer for root
-                    rcode=0,  # no error
-                    qd=dns_packet.qd
-                )
-
-            if domain_name.endswith('tunnel.broski.software.'):
-                return self.tunnel_response(dns_packet, domain_name)
-            
-            # get record type code
-            record_type = query_section.qtype 
-
-            # get the record from the local records if it exists
-            rdata = self.get_record(domain_name)
-
-            # if the record exists, respond with it
-            if rdata is not None:
-                # log the blocked domain
-                with open("blocked_domains.md", "a") as file:
-                    now = datetime.now() + timedelta(hours=3)  # add 3 hours to adapt to Bucharest timezone
-                    domain_output = f"{domain_name[:-1]}" 
-                    file.write(f"{domain_output:<49} has been blocked at {now.strftime('%Y-%m-%d %H:%M:%S')}. Requested by {client_address}\n")
-                return self.create_response(dns_packet, domain_name, record_type, rdata)
-            
+            limited = self.limit_query(query, client_address)
+            if limited is not None:
+                return limited or None
+
+            _, response = self.local_response(query, client_address)
+            if response is not None:
+                return self.limit_response(query, self.fit_udp(query, response), client_address)
+
             # if the record does not exist, send a request to the upstream DNS server
-            upstream_response = self.dns_upstream_request(bytes(dns_packet))
+            # and relay its answer unchanged
+            upstream_response = self.dns_upstream_request(request_data)
             if upstream_response is None:
-                print("No response from upstream DNS server")
-                return None
-            return DNS(upstream_response)
-            
+                stale_response = self.cache.get_stale(query)
+                if stale_response is None:
+                    print("No response from upstream DNS server")
+                    return None
+                return self.limit_response(query, self.fit_udp(query, stale_response), client_address)
+            self.cache.put(query, upstream_response)
+            return self.limit_response(query, self.fit_udp(query, upstream_response), client_address)
+
         except Exception as e:
             print(f"Error handling DNS request: {e}")
             return None
 
+    '''
+    called by the asyncio protocol for every datagram. local answers are sent back right away,
+    upstream forwards are scheduled as tasks so a slow upstream does not block the other clients
+    '''
+    def datagram_received(self, transport, request_data, client_address):
+        started = time.perf_counter()
+        try:
+            query = self.parse_request(request_data)
+            if query is None:
+                self.metrics.observe('udp', metrics.ERROR, started)
+                return
+
+            limited = self.limit_query(query, client_address)
+            if limited is not None:
+                if limited:
+                    transport.sendto(limited, client_address)
+                self.metrics.observe('udp', metrics.LIMITED, started, limited or None)
+                return
+
+            outcome, response = self.local_response(query, client_address)
+            if response is not None:
+                self.send_limited(transport, query, response, client_address, outcome, started)
+                return
+
+            task = asyncio.ensure_future(self.forward_request(transport, query, client_address, started))
+            self.pending_tasks.add(task)
+            task.add_done_callback(self.pending_tasks.discard)
+        except Exception as e:
+            print(f"Error handling DNS request: {e}")
+            self.metrics.observe('udp', metrics.ERROR, started)
+
+    '''
+    sends response over udp unless the response rate limit drops it, and records the query
+    '''
+    def send_limited(self, transport, query, response, client_address, outcome, started):
+        response = self.fit_udp(query, response)
+        sent = self.limit_response(query, response, client_address)
+        if sent is not None:
+            transport.sendto(sent, client_address)
+        self.metrics.observe('udp', outcome if sent is response else metrics.LIMITED, started, sent)
+
+    async def forward_request(self, transport, query, client_address, started):
+        try:
+            upstream_response = await self.coalesced_upstream_request(query)
+            outcome = metrics.FORWARDED
+            if upstream_response is None:
+                # serve-stale: a recently expired answer is better than none while the upstream is unreachable
+                upstream_response, outcome = self.cache.get_stale(query), metrics.STALE
+                if upstream_response is None:
+                    print("No response from upstream DNS server")
+                    self.metrics.observe('udp', metrics.ERROR, started)
+                    return
+            self.send_limited(transport, query, upstream_response, client_address, outcome, started)
+        except Exception as e:
+            print(f"Error forwarding DNS request: {e}")
+            self.metrics.observe('udp', metrics.ERROR, started)
+
+    '''
+    identical (qname, qtype, qclass) misses that arrive while a forward for them is in flight wait for that
+    forward instead of sending their own. every waiter gets the answer with its own transaction id
+    '''
+    async def coalesced_upstream_request(self, query):
+        key = self.cache.key(query)
+        shared = self.inflight_forwards.get(key)
+        if shared is None:
+            shared = asyncio.ensure_future(self.forward_and_cache(query))
+            self.inflight_forwards[key] = shared
+            shared.add_done_callback(lambda _: self.inflight_forwards.pop(key, None))
+
+        # shield so a cancelled waiter does not cancel the forward the others are waiting on
+        upstream_response = await asyncio.shield(shared)
+        if upstream_response is None:
+            return None
+        return dns_wire.copy_question(upstream_response, query)
+
+    async def forward_and_cache(self, query):
+        upstream_response = await self.dns_upstream_request_async(query)
+        if upstream_response is not None:
+            self.cache.put(query, upstream_response)
+        return upstream_response
+
+    async def serve(self, host, port):
+        loop = asyncio.get_running_loop()
+        self.upstream_slots = asyncio.Semaphore(self.max_inflight_upstream)
+        self.upstream_pool = UpstreamPool(self.upstream_addresses(), size=self.upstream_pool_size,
+                                          timeout=self.upstream_timeout, hedge=self.upstream_hedging)
+        self.upstream_pool.open()
+
+        self.sock.bind((host, port))  # listening on port 53
+        self.sock.setblocking(False)
+        transport, _ = await loop.create_datagram_endpoint(lambda: DNSServerProtocol(self), sock=self.sock)
+        # same port over tcp, for answers that do not fit in a udp payload
+        tcp_server = await asyncio.start_server(self.serve_tcp_connection, host, port,
+                                                reuse_address=True, reuse_port=self.reuse_port or None)
+        metrics_server = None
+        if self.metrics_port is not None:
+            metrics_server = await metrics.start_metrics_server(self.metrics_lines, self.metrics_host,
+                                                                self.metrics_port)
+            print(f"Metrics on http://{self.metrics_host}:{self.metrics_port}/metrics")
+        print(f"DNS server started on {host}:{port} (async, max {self.max_inflight_upstream} upstream requests in flight, "
+              f"{self.max_queued_upstream} waiting)")
+
+        try:
+            await asyncio.Future()  # serve until cancelled
+        finally:
+            if metrics_server is not None:
+                metrics_server.close()
+            tcp_server.close()
+            transport.close()
+            self.upstream_pool.close()
+
+    '''
+    prometheus text for the metrics endpoint: the query counters and histograms plus the state of the cache,
+    the upstream servers, the rate limiter and the tcp listener, read when the endpoint is scraped
+    '''
+    def metrics_lines(self):
+        lines = self.metrics.render()
+        lines += metrics.metric_lines("dns_cache_entries", "gauge", "Answers in the cache.", [({}, len(self.cache))])
+        lines += metrics.metric_lines("dns_cache_bytes", "gauge", "Estimated memory used by the cache.",
+                                      [({}, self.cache.size)])
+        lines += metrics.metric_lines("dns_cache_lookups_total", "counter", "Cache lookups by result.",
+                                      [({"result": "hit"}, self.cache.hits), ({"result": "miss"}, self.cache.misses)])
+        lines += metrics.metric_lines("dns_cache_prefetches_total", "counter",
+                                      "Popular answers refreshed before they expired.", [({}, self.cache.prefetches)])
+        lines += metrics.metric_lines("dns_tcp_connections", "gauge", "Open tcp connections.",
+                                      [({}, self.tcp_connections)])
+        lines += metrics.metric_lines("dns_forwards_in_progress", "gauge", "Queries waiting for an upstream answer.",
+                                      [({}, len(self.pending_tasks))])
+        lines += metrics.metric_lines("dns_upstream_queued", "gauge", "Forwards waiting for an upstream slot.",
+                                      [({}, self.upstream_waiting)])
+        lines += metrics.metric_lines("dns_upstream_shed_total", "counter",
+                                      "Forwards dropped because no upstream slot was free in time.",
+                                      [({}, self.upstream_shed)])
+        if self.rate_limiter is not None:
+            lines += metrics.metric_lines("dns_rate_limited_total", "counter", "Queries and responses over a rate limit.",
+                                          [({"action": "slip"}, self.rate_limiter.slipped),
+                                           ({"action": "drop"}, self.rate_limiter.dropped),
+                                           ({"action": "refuse"}, self.rate_limiter.refused)])
+            lines += metrics.metric_lines("dns_tunnel_chunks_cut_total", "counter",
+                                          "Tunnel chunks left out of udp answers by the per client budget.",
+                                          [({}, self.rate_limiter.chunks_cut)])
+
+        upstreams = self.upstream_pool.upstreams if self.upstream_pool is not None else []
+        now = time.monotonic()
+        labels = [{"upstream": f"{upstream.address[0]}:{upstream.address[1]}"} for upstream in upstreams]
+        lines += metrics.metric_lines("dns_upstream_up", "gauge", "1 unless the upstream is skipped after timeouts.",
+                                      [(label, int(upstream.healthy(now))) for label, upstream in zip(labels, upstreams)])
+        lines += metrics.metric_lines("dns_upstream_queries_total", "counter", "Queries sent to the upstream.",
+                                      [(label, upstream.queries) for label, upstream in zip(labels, upstreams)])
+        lines += metrics.metric_lines("dns_upstream_timeouts_total", "counter", "Queries the upstream did not answer.",
+                                      [(label, upstream.timeouts) for label, upstream in zip(labels, upstreams)])
+        lines += metrics.metric_lines("dns_upstream_srtt_seconds", "gauge", "Smoothed response time of the upstream.",
+                                      [(label, f"{upstream.srtt:.6f}") for label, upstream in zip(labels, upstreams)
+                                       if upstream.srtt is not None])
+        lines += metrics.histogram_lines("dns_upstream_duration_seconds", "Response times of the upstream.",
+                                         [(label, upstream.latency) for label, upstream in zip(labels, upstreams)])
+        return lines
+
+    '''
+    one tcp connection (rfc 7766): queries are read as they come and answered concurrently, every answer is
+    written as soon as it is ready, so a slow forward does not hold back the queries behind it. the connection
+    is closed after tcp_idle_timeout seconds without queries or answers in progress. a client that closes its
+    side after the last query still gets the answers in progress, for at most tcp_idle_timeout seconds
+    '''
+    async def serve_tcp_connection(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+        if self.tcp_connections >= self.max_tcp_connections:
+            writer.close()
+            return
+
+        self.tcp_connections += 1
+        pipeline = asyncio.Semaphore(self.max_tcp_pipeline)
+        write_lock = asyncio.Lock()  # one answer at a time, drain() waits for a slow reader
+        answering = set()
+        try:
+            while True:
+                try:
+                    prefix = await asyncio.wait_for(reader.readexactly(dns_wire.TCP_LENGTH.size), self.tcp_idle_timeout)
+                except asyncio.TimeoutError:
+                    if answering:
+                        continue  # the client is waiting for answers, not idle
+                    break
+                (length,) = dns_wire.TCP_LENGTH.unpack(prefix)
+                request_data = await asyncio.wait_for(reader.readexactly(length), self.tcp_idle_timeout)
+
+                await pipeline.acquire()
+                task = asyncio.ensure_future(self.answer_tcp_query(request_data, client_address, writer, write_lock))
+                answering.add(task)
+                task.add_done_callback(answering.discard)
+                task.add_done_callback(lambda _: pipeline.release())
+        except asyncio.IncompleteReadError:
+            # end of the queries (the client may have closed only its sending side), finish the answers
+            if answering:
+                await asyncio.wait(answering, timeout=self.tcp_idle_timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass  # the client stopped in the middle of a message or reset the connection
+        finally:
+            self.tcp_connections -= 1
+            for task in answering:
+                task.cancel()
+            writer.close()
+
+    async def answer_tcp_query(self, request_data, client_address, writer, write_lock):
+        started = time.perf_counter()
+        try:
+            query = self.parse_request(request_data)
+            if query is None:
+                self.metrics.observe('tcp', metrics.ERROR, started)
+                return
+
+            # tcp sources cannot be spoofed, so only the per client bucket applies. it still has to, udp clients
+            # over their limit are told to come back over tcp
+            if self.rate_limiter is not None and not self.rate_limiter.check_client(client_address[0]):
+                outcome, response = metrics.LIMITED, dns_wire.build_response(query, rcode=dns_wire.REFUSED)
+            else:
+                outcome, response = self.local_response(query, client_address, tcp=True)
+            if response is None:
+                response = await self.coalesced_upstream_request(query)
+                if response is not None and dns_wire.parse_query(response).flags & dns_wire.TC:
+                    # did not fit in the upstream's udp answer, the tcp client can take all of it
+                    response = await self.tcp_upstream_request(query)
+                if response is None:
+                    response, outcome = self.cache.get_stale(query), metrics.STALE
+            if response is None:
+                print("No response from upstream DNS server")
+                self.metrics.observe('tcp', metrics.ERROR, started)
+                return
+            async with write_lock:
+                if writer.is_closing():
+                    return
+                writer.write(dns_wire.TCP_LENGTH.pack(len(response)) + response)
+                await writer.drain()
+            self.metrics.observe('tcp', outcome, started, response)
+        except Exception as e:
+            print(f"Error handling DNS request over tcp: {e}")
+            self.metrics.observe('tcp', metrics.ERROR, started)
+
+    '''
+    forwards query to the fastest upstream over tcp. used when its udp answer was truncated
+    '''
+    async def tcp_upstream_request(self, query):
+        upstream_address = self.upstream_pool.ranked()[0].address
+        writer = None
+        if not await self.acquire_upstream_slot():
+            return None
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*upstream_address), self.upstream_timeout)
+            writer.write(dns_wire.TCP_LENGTH.pack(len(query.data)) + query.data)
+            prefix = await asyncio.wait_for(reader.readexactly(dns_wire.TCP_LENGTH.size), self.upstream_timeout)
+            (length,) = dns_wire.TCP_LENGTH.unpack(prefix)
+            return await asyncio.wait_for(reader.readexactly(length), self.upstream_timeout)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            print(f"Error forwarding DNS request over tcp to {upstream_address[0]}: {e}")
+            return None
+        finally:
+            self.upstream_slots.release()
+            if writer is not None:
+                writer.close()
+
     def start(self, host='127.0.0.1', port=53):
+        self.start_reload_watcher()
+        try:
+            asyncio.run(self.serve(host, port))
+        except Exception as e:
+            print(f"Error starting server: {e}")
+        except KeyboardInterrupt:
+            print("Server stopped by KeyboardInterrupt")
+
+    '''
+    supervisor mode: forks workers that each run the async server on their own socket bound to host:port with
+    SO_REUSEPORT, the kernel spreads the clients over them. the records are loaded before the fork and compiled
+    blocklists and tunnel files are mmapped, so the workers share those pages. a worker that dies is replaced,
+    SIGHUP is passed on to the workers and SIGTERM / ctrl+c stops all of them
+    '''
+    def start_workers(self, host='127.0.0.1', port=53, workers=None):
+        workers = workers or os.cpu_count() or 1
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            print("SO_REUSEPORT is not available, serving from a single process")
+            return self.start(host, port)
+
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.signal_workers(signal.SIGHUP))
+        signal.signal(signal.SIGTERM, stop_on_signal)
+        try:
+            for index in range(workers):
+                self.spawn_worker(index, host, port)
+            print(f"DNS server supervisor {os.getpid()} started {workers} workers on {host}:{port}")
+
+            while True:
+                pid, status = os.wait()
+                index = self.worker_pids.pop(pid, None)
+                if index is None or self.stopping:
+                    continue
+                print(f"Worker {index} (pid {pid}) exited with status {status}, restarting it")
+                time.sleep(1)  # do not spin if the workers keep failing
+                self.spawn_worker(index, host, port)
+        except KeyboardInterrupt:
+            print("Server stopped by KeyboardInterrupt")
+        except ChildProcessError:
+            pass
+        finally:
+            self.stop_workers()
+
+    def spawn_worker(self, index, host, port):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                self.run_worker(index, host, port)
+            except BaseException as e:
+                print(f"Worker {index} failed: {e}")
+                status = 1
+            finally:
+                os._exit(status)  # never run the supervisor's cleanup in a worker
+        self.worker_pids[pid] = index
+        self.write_pid_file()
+
+    def run_worker(self, index, host, port):
+        signal.signal(signal.SIGTERM, stop_on_signal)
+        self.worker_pids = {}
+        self.reuse_port = True
+        if self.metrics_port is not None:
+            self.metrics_port += index  # one endpoint per worker, every worker counts its own queries
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, proto=socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        # threads do not survive the fork, every worker gets its own writer for the shared log.
+        # only the first worker rotates it, the others follow the rename
+        self.block_logger = BlockEventLogger(self.block_logger.path, log_format=self.block_logger.log_format,
+                                             max_bytes=self.block_logger.max_bytes if index == 0 else None)
+        self.block_logger.start()
+        try:
+            self.start(host, port)
+        finally:
+            self.block_logger.close()
+
+    def signal_workers(self, signum):
+        for pid in list(self.worker_pids):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop_workers(self):
+        if not self.worker_pids:
+            return
+        self.stopping = True
+        self.signal_workers(signal.SIGTERM)
+        for pid in list(self.worker_pids):
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+            self.worker_pids.pop(pid, None)
+
+    '''
+    the original serving loop: one request at a time, forwards block until the upstream answers
+    '''
+    def start_blocking(self, host='127.0.0.1', port=53):
+        self.start_reload_watcher()
         try:
             self.sock.bind((host, port))  # listening on port 53
             print(f"DNS server started on {host}:{port}")
@@ -232,7 +831,7 @@ class DNSPiHole:
                     data, client_address = self.sock.recvfrom(65535)  # buffer size 65535 bytes
                     response = self.handle_dns_request(data, client_address)
                     if response is not None:
-                        self.sock.sendto(bytes(response), client_address)
+                        self.sock.sendto(response, client_address)
                 except Exception as e:
                     print(f"Error handling request: {e}")
 
@@ -242,6 +841,49 @@ class DNSPiHole:
             print("Server stopped by KeyboardInterrupt")
 
 
+def stop_on_signal(signum, frame):
+    raise KeyboardInterrupt
+
+
+class DNSServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.server.datagram_received(self.transport, data, addr)
+
+
 if __name__ == "__main__":
-    with DNSPiHole() as server:
-        server.start(host='64.226.94.247') # address of vps
+    parser = argparse.ArgumentParser(description="DNS Pi-hole server and tunnel endpoint")
+    parser.add_argument("--host", default='64.226.94.247')  # address of vps
+    parser.add_argument("--port", type=int, default=53)
+    parser.add_argument("--records", default="dns_records.json",
+                        help=f"records json or compiled blocklist, ex: dns_records{COMPILED_EXTENSION} (shared by the workers)")
+    parser.add_argument("--upstream", action="append", dest="upstreams",
+                        help="upstream resolver ip or ip:port, repeat for several (default 8.8.8.8 and 1.1.1.1)")
+    parser.add_argument("--no-rate-limit", action="store_true", help="disable the per client and response rate limits")
+    parser.add_argument("--workers", type=int, default=1, help="processes sharing the port with SO_REUSEPORT, 0 = one per core")
+    parser.add_argument("--metrics-port", type=int, default=9153,
+                        help="prometheus metrics on http://127.0.0.1:<port>/metrics, worker i uses port + i")
+    parser.add_argument("--no-metrics", action="store_true", help="do not start the metrics endpoint")
+    args = parser.parse_args()
+
+    upstreams = []
+    for upstream in args.upstreams or ["8.8.8.8", "1.1.1.1"]:
+        upstream_host, _, upstream_port = upstream.partition(':')
+        upstreams.append((upstream_host, int(upstream_port or 53)))
+
+    if args.workers != 1 and not args.records.endswith(COMPILED_EXTENSION):
+        # a dict is copied into every worker as soon as it is touched, a compiled blocklist stays shared
+        print(f"Hint: compile {args.records} with blocklist_index.py to share it between the workers")
+
+    with DNSPiHole(records_file_path=args.records, upstream_servers=upstreams, rate_limiter=None if args.no_rate_limit else RateLimiter(),
+                   metrics_port=None if args.no_metrics else args.metrics_port) as server:
+        if args.workers == 1:
+            server.start(host=args.host, port=args.port)
+        else:
+            server.start_workers(host=args.host, port=args.port, workers=args.workers or None)
@@ -0,0 +1,308 @@
+'''
+minimal dns wire format encoder/decoder (rfc 1035). reads the header and the question straight from the
+byte buffer and writes answers straight into bytes, without building scapy packets
+'''
+import socket
+import struct
+
+HEADER = struct.Struct('!HHHHHH')  # id, flags, qdcount, ancount, nscount, arcount
+QUESTION_TAIL = struct.Struct('!HH')  # qtype, qclass
+RR_HEADER = struct.Struct('!HHIH')  # type, class, ttl, rdlength
+TTL = struct.Struct('!I')
+OPT_RECORD = struct.Struct('!BHHIH')  # root name, type OPT, udp payload size, extended rcode and flags, rdlength
+
+# flag bits
+QR = 0x8000
+AA = 0x0400
+TC = 0x0200
+RD = 0x0100
+RA = 0x0080
+DO = 0x8000  # dnssec ok, in the flags half of the OPT record ttl field (rfc 3225)
+
+# response codes
+NOERROR = 0
+FORMERR = 1
+SERVFAIL = 2
+NXDOMAIN = 3
+REFUSED = 5
+
+# record types
+TYPE_A = 1
+TYPE_SOA = 6
+TYPE_TXT = 16
+TYPE_AAAA = 28
+TYPE_OPT = 41
+TYPE_ANY = 255
+CLASS_IN = 1
+
+NAME_POINTER = b'\xc0\x0c'  # compression pointer to the question name, which always starts at offset 12
+MIN_UDP_PAYLOAD = 512  # what every client accepts without EDNS0 (rfc 1035)
+MAX_TCP_MESSAGE = 65535  # tcp messages carry a 16 bit length prefix
+TCP_LENGTH = struct.Struct('!H')
+
+
+class DNSQuery:
+    def __init__(self, data, query_id, flags, qname, qtype, qclass, question_end):
+        self.data = data
+        self.id = query_id
+        self.flags = flags
+        self.opcode = (flags >> 11) & 0xF
+        self.qname = qname  # text form with the trailing dot, ex: "example.com."
+        self.qtype = qtype
+        self.qclass = qclass
+        self.question_end = question_end  # offset of the first byte after the question
+
+
+class DNSResponse:
+    def __init__(self, query, rcode, ancount, ttl_offsets, min_answer_ttl, negative_ttl):
+        self.query = query  # header and question of the response, parsed like a query
+        self.rcode = rcode
+        self.ancount = ancount
+        self.ttl_offsets = ttl_offsets  # [(offset of the ttl field, ttl)] for every record except OPT
+        self.min_answer_ttl = min_answer_ttl  # None if there are no answers
+        self.negative_ttl = negative_ttl  # min(SOA ttl, SOA minimum) from the authority section, None without SOA
+
+
+'''
+reads a (possibly compressed) domain name starting at offset. returns (name, offset after the name)
+'''
+def read_name(data, offset):
+    labels = []
+    end = None  # offset after the name, fixed by the first compression pointer
+    jumps = 0
+
+    while True:
+        if offset >= len(data):
+            raise ValueError("name runs past the end of the packet")
+        length = data[offset]
+        if length == 0:
+            offset += 1
+            break
+        if length & 0xC0 == 0xC0:  # compression pointer
+            if offset + 1 >= len(data):
+                raise ValueError("truncated compression pointer")
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+            jumps += 1
+            if jumps > 64:
+                raise ValueError("compression pointer loop")
+            continue
+        if length & 0xC0:
+            raise ValueError("unsupported label type")
+        if offset + 1 + length > len(data):
+            raise ValueError("name runs past the end of the packet")
+        labels.append(data[offset + 1: offset + 1 + length].decode('latin-1'))
+        offset += 1 + length
+
+    name = '.'.join(labels) + '.' if labels else '.'
+    return name, end if end is not None else offset
+
+
+'''
+encodes a domain name as labels, ex: "example.com." -> b'\x07example\x03com\x00'
+'''
+def encode_name(name):
+    encoded = bytearray()
+    for label in name.rstrip('.').split('.') if name.rstrip('.') else []:
+        if not 0 < len(label) < 64:
+            raise ValueError(f"label {label!r} of {name} is empty or longer than 63 bytes")
+        encoded += bytes([len(label)]) + label.encode('latin-1')
+    return bytes(encoded) + b'\x00'
+
+
+'''
+returns the offset after the (possibly compressed) domain name starting at offset, without decoding it
+'''
+def skip_name(data, offset):
+    while True:
+        if offset >= len(data):
+            raise ValueError("name runs past the end of the packet")
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:  # a pointer always ends the name
+            return offset + 2
+        offset += 1 + length
+
+
+'''
+parses the header and the first question of a query. raises ValueError for truncated or malformed packets
+'''
+def parse_query(data):
+    if len(data) < HEADER.size:
+        raise ValueError("packet shorter than a dns header")
+    query_id, flags, qdcount, _, _, _ = HEADER.unpack_from(data)
+    if qdcount == 0:
+        raise ValueError("query without a question")
+
+    qname, offset = read_name(data, HEADER.size)
+    if offset + QUESTION_TAIL.size > len(data):
+        raise ValueError("truncated question")
+    qtype, qclass = QUESTION_TAIL.unpack_from(data, offset)
+    return DNSQuery(data, query_id, flags, qname, qtype, qclass, offset + QUESTION_TAIL.size)
+
+
+'''
+walks all the resource records of a response and collects what the cache needs: the rcode,
+where every ttl is stored and the ttls used for positive and negative caching (rfc 2308)
+'''
+def parse_response(data):
+    query = parse_query(data)
+    _, _, _, ancount, nscount, arcount = HEADER.unpack_from(data)
+
+    ttl_offsets = []
+    min_answer_ttl = None
+    negative_ttl = None
+    offset = query.question_end
+    for index in range(ancount + nscount + arcount):
+        offset = skip_name(data, offset)
+        if offset + RR_HEADER.size > len(data):
+            raise ValueError("truncated resource record")
+        record_type, _, ttl, rdlength = RR_HEADER.unpack_from(data, offset)
+        rdata_end = offset + RR_HEADER.size + rdlength
+        if rdata_end > len(data):
+            raise ValueError("truncated resource record")
+
+        if record_type != TYPE_OPT:  # the ttl field of OPT holds the extended rcode and flags
+            ttl_offsets.append((offset + 4, ttl))
+            if index < ancount:
+                min_answer_ttl = ttl if min_answer_ttl is None else min(min_answer_ttl, ttl)
+            elif index < ancount + nscount and record_type == TYPE_SOA:
+                soa_minimum, = TTL.unpack_from(data, rdata_end - 4)  # last field of the SOA rdata
+                negative_ttl = min(ttl, soa_minimum)
+        offset = rdata_end
+
+    return DNSResponse(query, query.flags & 0xF, ancount, ttl_offsets, min_answer_ttl, negative_ttl)
+
+
+'''
+builds a response to query: copies the id, the rd flag and the question, then appends the answer records
+'''
+def build_response(query, rcode=NOERROR, aa=False, answers=b'', ancount=0, additional=b'', arcount=0, tc=False):
+    flags = QR | (query.opcode << 11) | (query.flags & RD) | rcode
+    if aa:
+        flags |= AA
+    if tc:
+        flags |= TC
+    header = HEADER.pack(query.id, flags, 1, ancount, 0, arcount)
+    return header + query.data[HEADER.size:query.question_end] + answers + additional
+
+
+'''
+returns (udp payload size, dnssec ok) from the EDNS0 OPT record of a query (rfc 6891), or None without EDNS0
+'''
+def edns_options(query):
+    data = query.data
+    _, _, _, ancount, nscount, arcount = HEADER.unpack_from(data)
+    offset = query.question_end
+    for index in range(ancount + nscount + arcount):
+        offset = skip_name(data, offset)
+        if offset + RR_HEADER.size > len(data):
+            return None
+        record_type, udp_size, flags, rdlength = RR_HEADER.unpack_from(data, offset)
+        if record_type == TYPE_OPT and index >= ancount + nscount:
+            return max(udp_size, MIN_UDP_PAYLOAD), bool(flags & DO)
+        offset += RR_HEADER.size + rdlength
+    return None
+
+
+'''
+returns the udp payload size advertised in the EDNS0 OPT record of a query, or None without EDNS0
+'''
+def edns_udp_size(query):
+    options = edns_options(query)
+    return options[0] if options is not None else None
+
+
+def opt_record(udp_size):
+    return OPT_RECORD.pack(0, TYPE_OPT, udp_size, 0, 0)
+
+
+'''
+a standard query (RD set) for name, with an EDNS0 OPT record if udp_size is given
+'''
+def build_query(query_id, name, qtype, udp_size=None):
+    additional = opt_record(udp_size) if udp_size is not None else b''
+    header = HEADER.pack(query_id, RD, 1, 0, 0, 1 if additional else 0)
+    return header + encode_name(name) + QUESTION_TAIL.pack(qtype, CLASS_IN) + additional
+
+
+'''
+answer record for an ip address (A for ipv4, AAAA for ipv6), named with a pointer to the question
+'''
+def address_record(address, ttl):
+    if ':' in address:
+        rdata = socket.inet_pton(socket.AF_INET6, address)
+        record_type = TYPE_AAAA
+    else:
+        rdata = socket.inet_aton(address)
+        record_type = TYPE_A
+    return NAME_POINTER + RR_HEADER.pack(record_type, CLASS_IN, ttl, len(rdata)) + rdata
+
+
+'''
+answer section (bytes, record count) for a qtype query of a name mapped to address: the address record for
+A / AAAA queries of the same family and ANY queries, the unspecified address of the other family for a name
+sinkholed to 0.0.0.0 or ::, and no records (NODATA) for every other type
+'''
+def address_answer(address, qtype, ttl):
+    is_ipv6 = ':' in address
+    if qtype == TYPE_ANY or qtype == (TYPE_AAAA if is_ipv6 else TYPE_A):
+        return address_record(address, ttl), 1
+    if address in ('0.0.0.0', '::') and qtype in (TYPE_A, TYPE_AAAA):
+        return address_record('::' if qtype == TYPE_AAAA else '0.0.0.0', ttl), 1
+    return b'', 0
+
+
+'''
+TXT answer record holding the given byte strings, each one at most 255 bytes long
+'''
+def txt_record(strings, ttl):
+    rdata = b''.join(bytes([len(string)]) + string for string in strings)
+    return NAME_POINTER + RR_HEADER.pack(TYPE_TXT, CLASS_IN, ttl, len(rdata)) + rdata
+
+
+'''
+returns the rdata of every TXT answer of a response, the character-strings of each record joined together
+'''
+def parse_txt_answers(data):
+    query = parse_query(data)
+    ancount = HEADER.unpack_from(data)[3]
+    answers = []
+    offset = query.question_end
+    for _ in range(ancount):
+        offset = skip_name(data, offset)
+        record_type, _, _, rdlength = RR_HEADER.unpack_from(data, offset)
+        offset += RR_HEADER.size
+        rdata_end = offset + rdlength
+        if rdata_end > len(data):
+            raise ValueError("truncated resource record")
+        if record_type == TYPE_TXT:
+            strings = []
+            position = offset
+            while position < rdata_end:
+                length = data[position]
+                strings.append(data[position + 1:position + 1 + length])
+                position += 1 + length
+            answers.append(b''.join(strings))
+        offset = rdata_end
+    return answers
+
+
+def response_rcode(data):
+    return data[3] & 0x0F
+
+
+def set_id(data, query_id):
+    return query_id.to_bytes(2, 'big') + data[2:]
+
+
+'''
+returns response with the transaction id and the question (letter case included) of query
+'''
+def copy_question(response, query):
+    question_end = skip_name(response, HEADER.size) + QUESTION_TAIL.size
+    if question_end != query.question_end:
+        return set_id(response, query.id)
+    return query.data[:2] + response[2:HEADER.size] + query.data[HEADER.size:question_end] + response[question_end:]
@@ -0,0 +1,144 @@
+'''
+lookup structures for the blocklist. exact names go in a dict, suffix rules written as "*.reporo.net." (block
+reporo.net. and everything under it) go in a trie of reversed labels, so a lookup costs O(labels)
+'''
+import argparse
+import json
+from collections import defaultdict
+
+
+WILDCARD_PREFIX = '*.'
+VALUE = ''  # key of the value stored in a trie node, labels are never empty
+
+# shared platforms where blocking every subdomain would break unrelated sites, never folded by compact_records
+NEVER_FOLD = {
+    'akamaihd.net.', 'amazonaws.com.', 'azureedge.net.', 'cloudfront.net.', 'facebook.com.', 'fbcdn.net.',
+    'github.io.', 'google.com.', 'googleapis.com.', 'microsoft.com.', 'twitter.com.', 'yahoo.com.',
+}
+
+
+def normalize(domain):
+    domain = domain.lower()
+    return domain if domain.endswith('.') else domain + '.'
+
+
+def labels_of(domain):
+    return domain.rstrip('.').split('.')
+
+
+class DomainTrie:
+    def __init__(self):
+        self.root = {}
+        self.size = 0
+
+    def add(self, suffix, value):
+        node = self.root
+        for label in reversed(labels_of(suffix)):
+            node = node.setdefault(label, {})
+        if VALUE not in node:
+            self.size += 1
+        node[VALUE] = value
+
+    '''
+    returns the value of the longest suffix rule that covers domain, or None
+    '''
+    def lookup(self, domain):
+        node = self.root
+        found = None
+        for label in reversed(labels_of(domain)):
+            node = node.get(label)
+            if node is None:
+                break
+            found = node.get(VALUE, found)
+        return found
+
+    def __len__(self):
+        return self.size
+
+
+class RecordIndex:
+    '''
+    the index is never changed after it is built. when it replaces a previous index (hot reload) the suffix trie
+    of the previous one is reused if no suffix rule changed
+    '''
+    def __init__(self, records, previous=None):
+        self.exact = {}
+        self.suffix_rules = {}
+        for name, rdata in records.items():
+            name = normalize(name)
+            if name.startswith(WILDCARD_PREFIX):
+                self.suffix_rules[name[len(WILDCARD_PREFIX):]] = rdata
+            else:
+                self.exact[name] = rdata
+
+        if previous is not None and previous.suffix_rules == self.suffix_rules:
+            self.suffixes = previous.suffixes
+        else:
+            self.suffixes = DomainTrie()
+            for suffix, rdata in self.suffix_rules.items():
+                self.suffixes.add(suffix, rdata)
+
+    '''
+    returns (added or changed, removed) name counts compared to a previous index
+    '''
+    def diff(self, previous):
+        changed = sum(1 for name, rdata in self.exact.items() if previous.exact.get(name) != rdata)
+        changed += sum(1 for name, rdata in self.suffix_rules.items() if previous.suffix_rules.get(name) != rdata)
+        removed = len(previous.exact.keys() - self.exact.keys()) + \
+            len(previous.suffix_rules.keys() - self.suffix_rules.keys())
+        return changed, removed
+
+    '''
+    returns the rdata for domain (exact names first, then suffix rules) or None if it is not in the records
+    '''
+    def lookup(self, domain):
+        rdata = self.exact.get(domain)
+        if rdata is None and self.suffixes.size:
+            rdata = self.suffixes.lookup(domain)
+        return rdata
+
+    def __len__(self):
+        return len(self.exact) + len(self.suffixes)
+
+
+'''
+folds every parent domain with at least min_subdomains listed children (all with the same rdata) into one
+"*.parent." rule and drops the names already covered by a suffix rule. top level domains and the parents in
+exclude are never folded
+'''
+def compact_records(records, min_subdomains=20, exclude=NEVER_FOLD):
+    records = {normalize(name): rdata for name, rdata in records.items()}
+
+    children = defaultdict(list)
+    for name in records:
+        if not name.startswith(WILDCARD_PREFIX) and name.count('.') > 2:  # parent has at least two labels
+            children[name.split('.', 1)[1]].append(name)
+
+    compacted = {name: rdata for name, rdata in records.items() if name.startswith(WILDCARD_PREFIX)}
+    for parent, names in children.items():
+        values = {records[name] for name in names}
+        if len(names) >= min_subdomains and len(values) == 1 and parent not in exclude:
+            compacted.setdefault(WILDCARD_PREFIX + parent, values.pop())
+
+    index = RecordIndex(compacted)
+    for name, rdata in records.items():
+        if not name.startswith(WILDCARD_PREFIX) and index.suffixes.lookup(name) != rdata:
+            compacted[name] = rdata
+    return compacted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="replace crowded subdomain lists with suffix rules")
+    parser.add_argument("input", help="records file, ex: dns_records.json")
+    parser.add_argument("output")
+    parser.add_argument("--min-subdomains", type=int, default=20)
+    parser.add_argument("--exclude", nargs="*", default=[], help="extra parent domains that must not be folded")
+    args = parser.parse_args()
+
+    with open(args.input, 'r') as file:
+        records = json.load(file)
+    compacted = compact_records(records, args.min_subdomains, NEVER_FOLD | {normalize(name) for name in args.exclude})
+    with open(args.output, 'w') as file:
+        json.dump(compacted, file, indent=4)
+    print(f"{len(records)} records -> {len(compacted)} records "
+          f"({sum(name.startswith(WILDCARD_PREFIX) for name in compacted)} suffix rules)")
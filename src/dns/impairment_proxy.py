@@ -0,0 +1,135 @@
+'''
+udp proxy that degrades the path between a client and a server on localhost, an in-process stand-in for
+alter_packages.sh (tc netem) that needs neither root nor a container. every packet, in both directions, can be
+dropped, corrupted, delayed with jitter or reordered. the random generator is seeded, so a run can be repeated
+
+each client gets its own socket towards the server (like a nat), so answers go back to the right client
+'''
+import argparse
+import heapq
+import itertools
+import random
+import select
+import socket
+import threading
+import time
+
+
+class ImpairmentProxy:
+    def __init__(self, target_address, host='127.0.0.1', port=0, delay=0.0, jitter=0.0, loss=0.0, corrupt=0.0,
+                 reorder=0.0, seed=None):
+        self.target_address = target_address
+        self.delay = delay  # seconds added to every packet
+        self.jitter = jitter  # the delay varies uniformly by +- jitter
+        self.loss = loss  # probabilities, 0.05 = 5%
+        self.corrupt = corrupt  # one bit flipped. the kernel would drop most of these on the udp checksum
+        self.reorder = reorder  # sent right away instead of after the delay, like netem reorder
+        self.random = random.Random(seed)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+        self.client_sockets = {}  # client address -> socket towards the server
+        self.client_of = {}  # socket towards the server -> client address
+        self.scheduled = []  # heap of (send time, sequence, socket, data, destination)
+        self.sequence = itertools.count()
+        self.stats = {"forwarded": 0, "dropped": 0, "corrupted": 0, "reordered": 0}
+        self.running = False
+        self.thread = None
+
+    def schedule(self, sock, data, destination):
+        if self.random.random() < self.loss:
+            self.stats["dropped"] += 1
+            return
+        if data and self.random.random() < self.corrupt:
+            data = bytearray(data)
+            data[self.random.randrange(len(data))] ^= 1 << self.random.randrange(8)
+            data = bytes(data)
+            self.stats["corrupted"] += 1
+
+        delay = self.delay + self.random.uniform(-self.jitter, self.jitter) if self.jitter else self.delay
+        if delay > 0 and self.random.random() < self.reorder:
+            delay = 0  # overtakes the packets still waiting
+            self.stats["reordered"] += 1
+        heapq.heappush(self.scheduled, (time.monotonic() + max(delay, 0), next(self.sequence), sock, data,
+                                        destination))
+
+    def socket_for(self, client_address):
+        sock = self.client_sockets.get(client_address)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            self.client_sockets[client_address] = sock
+            self.client_of[sock] = client_address
+        return sock
+
+    def receive(self, sock):
+        while True:
+            try:
+                data, address = sock.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            if sock is self.sock:
+                self.schedule(self.socket_for(address), data, self.target_address)
+            else:
+                self.schedule(self.sock, data, self.client_of[sock])
+
+    def send_due(self):
+        now = time.monotonic()
+        while self.scheduled and self.scheduled[0][0] <= now:
+            _, _, sock, data, destination = heapq.heappop(self.scheduled)
+            try:
+                sock.sendto(data, destination)
+                self.stats["forwarded"] += 1
+            except OSError:
+                self.stats["dropped"] += 1
+
+    def serve(self):
+        while self.running:
+            timeout = 0.05
+            if self.scheduled:
+                timeout = min(max(self.scheduled[0][0] - time.monotonic(), 0), timeout)
+            readable, _, _ = select.select([self.sock, *self.client_of], [], [], timeout)
+            for sock in readable:
+                self.receive(sock)
+            self.send_due()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for sock in [self.sock, *self.client_of]:
+            sock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="lossy, slow udp path in front of a local server")
+    parser.add_argument("--listen-port", type=int, default=5353)
+    parser.add_argument("--target", default="127.0.0.1:53", help="ip:port of the server")
+    parser.add_argument("--delay", type=float, default=0.1, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.01, help="seconds")
+    parser.add_argument("--loss", type=float, default=0.05)
+    parser.add_argument("--corrupt", type=float, default=0.0)
+    parser.add_argument("--reorder", type=float, default=0.25)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    target_host, _, target_port = args.target.partition(':')
+    proxy = ImpairmentProxy((target_host, int(target_port or 53)), port=args.listen_port, delay=args.delay,
+                            jitter=args.jitter, loss=args.loss, corrupt=args.corrupt, reorder=args.reorder,
+                            seed=args.seed).start()
+    print(f"Impairing 127.0.0.1:{proxy.address[1]} -> {args.target}, ctrl+c to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        proxy.close()
+        print(proxy.stats)
@@ -1,33 +1,116 @@
+import argparse
 import hashlib
-import sys
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
 
-def calculate_md5(filename):
-    md5_hash = hashlib.md5()
+from chunk_writer import RAW_CHUNK_SIZE, ChunkWriter, to_ranges
+
+MISSING_LEAF = b''  # a chunk that only exists in the longer file, never equal to a digest
+
+def chunk_hashes(filename):
+    '''One digest per tunnel chunk (150 bytes of the file), read through mmap'''
     with open(filename, 'rb') as file:
-        for chunk in iter(lambda: file.read(4096), b""):
-            md5_hash.update(chunk)
-    return md5_hash.hexdigest()
-
-def compare_files(file1, file2):
-    '''Compare two files by their MD5 hashes'''
-    try: 
-        hash1 = calculate_md5(file1)
-        hash2 = calculate_md5(file2)
-        if hash1 == hash2:
-            print("Files are identical.")
-            return True
-        else:
-            print("Files are different.")
-            return False
+        if os.fstat(file.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            view = memoryview(data)
+            try:
+                return [hashlib.blake2b(view[start:start + RAW_CHUNK_SIZE], digest_size=16).digest()
+                        for start in range(0, len(data), RAW_CHUNK_SIZE)]
+            finally:
+                view.release()
+
+def merkle_tree(leaves):
+    '''Levels of the hash tree, leaves first and the root last. An odd node is carried up unchanged.
+    With both files on one machine the tree costs about as much as comparing the leaves; it is there for two
+    sides that each have only one copy (the server and a client): they exchange the root, then the children of
+    the nodes that differ, about log2(chunks) hashes per damaged chunk instead of every leaf'''
+    levels = [leaves]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parents = [hashlib.blake2b(level[i] + level[i + 1], digest_size=16).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        levels.append(parents)
+    return levels
+
+def differing_chunks(tree1, tree2):
+    '''Leaf indexes that differ, only the subtrees whose hashes differ are visited'''
+    different = []
+    top = len(tree1) - 1
+    stack = [(top, 0)]
+    while stack:
+        depth, index = stack.pop()
+        if tree1[depth][index] == tree2[depth][index]:
+            continue
+        if depth == 0:
+            different.append(index)
+            continue
+        for child in (2 * index, 2 * index + 1):
+            if child < len(tree1[depth - 1]):
+                stack.append((depth - 1, child))
+    return sorted(different)
+
+def diff_chunks(file1, file2):
+    '''Chunk ranges ([first, last], inclusive) where file2 differs from file1, found the way a remote peer
+    would: walking down from the roots through the subtrees that differ'''
+    leaves1 = chunk_hashes(file1)
+    leaves2 = chunk_hashes(file2)
+    if not leaves1 and not leaves2:
+        return []
+    # both trees get the same shape, chunks past the end of the shorter file always differ
+    leaf_count = max(len(leaves1), len(leaves2))
+    leaves1 += [MISSING_LEAF] * (leaf_count - len(leaves1))
+    leaves2 += [MISSING_LEAF] * (leaf_count - len(leaves2))
+    return to_ranges(differing_chunks(merkle_tree(leaves1), merkle_tree(leaves2)))
+
+def format_ranges(ranges):
+    '''[[0, 2], [5, 5]] -> "0-2, 5"'''
+    return ", ".join(f"{first}-{last}" if first != last else f"{first}" for first, last in ranges)
+
+def prepare_refetch(original, received, ranges):
+    '''Turns the received file into a partial download missing only the differing chunks, the next
+    udp_client run for the same file fetches just those'''
+    total_chunks = (os.path.getsize(original) + RAW_CHUNK_SIZE - 1) // RAW_CHUNK_SIZE
+    bad_chunks = set()
+    for first, last in ranges:
+        bad_chunks.update(range(first, last + 1))
+
+    writer = ChunkWriter(received, total_chunks)
+    os.replace(received, writer.part_path)
+    writer.file = open(writer.part_path, 'r+b')
+    writer.file.truncate(min(os.path.getsize(writer.part_path), os.path.getsize(original)))
+    writer.received = set(range(total_chunks)) - bad_chunks
+    writer.close()
+    return len(bad_chunks & set(range(total_chunks)))
+
+def check(filename):
+    original, received = f'tunnel_files/{filename}.txt', f'received_files/{filename}_received.txt'
+    try:
+        return filename, diff_chunks(original, received), None
     except FileNotFoundError as e:
-        print(f"File \"{e.filename}\" not found.")
-        return False
-    
+        return filename, None, e.filename
+
 if __name__ == "__main__":
-    if len(sys.argv) == 2:
-        filename = sys.argv[1]
-        compare_files(f'tunnel_files/{filename}.txt', f'received_files/{filename}_received.txt')
-    else:
-        print("Usage: python md5check.py <filename>")
-        print("Example: python md5check.py example")
-        print("This will compare 'tunnel_files/example.txt' with 'received_files/example_received.txt'")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="compare tunnel_files/<name>.txt with received_files/<name>_received.txt",
+                                     epilog="ex: python md5check.py example luceafarul")
+    parser.add_argument("filenames", nargs="+")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="file pairs checked in parallel")
+    parser.add_argument("--refetch", action="store_true",
+                        help="keep the good chunks of a different file so udp_client downloads only the bad ones")
+    args = parser.parse_args()
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        results = list(executor.map(check, args.filenames))
+
+    for filename, ranges, missing in results:
+        if missing is not None:
+            print(f"{filename}: file \"{missing}\" not found.")
+        elif not ranges:
+            print(f"{filename}: files are identical.")
+        else:
+            print(f"{filename}: files are different in chunks {format_ranges(ranges)}.")
+            if args.refetch:
+                count = prepare_refetch(f'tunnel_files/{filename}.txt', f'received_files/{filename}_received.txt', ranges)
+                print(f"{filename}: {count} chunks will be downloaded again by \"python udp_client.py {filename}\".")
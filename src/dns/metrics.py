@@ -0,0 +1,202 @@
+'''
+counters and latency histograms of the dns server, served as prometheus text on a small local http endpoint
+
+every answered (or dropped) query is counted by transport and outcome and its latency goes into the histogram
+of its outcome. recording a query is a few dict and list updates, so the metrics can stay on under load; the
+text is only built when the endpoint is scraped
+
+the histograms are hdr style: durations are counted in microseconds, exactly below 2**precision, above that
+every power of two is split into 2**precision equal buckets. the relative error is below 1 / 2**precision
+(12.5% by default) at any scale, from microsecond cache hits to multi-second upstream timeouts, with a fixed
+~200 buckets per histogram. those fine buckets stay in the process (percentile()); prometheus gets the same
+fixed, coarse EXPORT_BOUNDS for every histogram, so the series never change and aggregate across workers
+'''
+import asyncio
+import time
+
+import dns_wire
+
+
+# outcomes of a query
+BLOCKED = 'blocked'  # answered from the blocklist
+TUNNEL = 'tunnel'  # tunnel chunks and info queries
+CACHED = 'cached'  # upstream answer served from the cache
+STALE = 'stale'  # expired answer served because the upstream did not answer
+FORWARDED = 'forwarded'  # answered by an upstream server
+NXDOMAIN = 'nxdomain'  # any of the above answered with NXDOMAIN
+LOCAL = 'local'  # other local answers, ex: a query for the root
+LIMITED = 'limited'  # dropped or truncated by the rate limiter
+ERROR = 'error'  # malformed query, no upstream answer or a failure in the server
+
+# le bounds in seconds of the exported histograms
+EXPORT_BOUNDS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                 2.5, 5, 10)
+
+RCODE_NAMES = {0: 'NOERROR', 1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN', 4: 'NOTIMP', 5: 'REFUSED'}
+
+
+class LatencyHistogram:
+    def __init__(self, precision=3, max_seconds=60):
+        self.precision = precision
+        self.sub_buckets = 1 << precision
+        self.last_index = self.index(int(max_seconds * 1000000))  # longer durations are counted in the last bucket
+        self.counts = [0] * (self.last_index + 1)
+        self.count = 0
+        self.sum = 0.0  # seconds
+
+    '''
+    bucket of a duration in microseconds
+    '''
+    def index(self, value):
+        if value < self.sub_buckets:
+            return value
+        exponent = value.bit_length() - self.precision - 1
+        return exponent * self.sub_buckets + (value >> exponent)
+
+    '''
+    microseconds, every duration in bucket index is below it
+    '''
+    def upper_bound(self, index):
+        if index < 2 * self.sub_buckets:
+            return index + 1
+        exponent = index // self.sub_buckets - 1
+        return (index - exponent * self.sub_buckets + 1) << exponent
+
+    def record(self, seconds):
+        value = int(seconds * 1000000)
+        if value < self.sub_buckets:
+            index = value
+        else:
+            exponent = value.bit_length() - self.precision - 1
+            index = min(exponent * self.sub_buckets + (value >> exponent), self.last_index)
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+
+    '''
+    upper bound in seconds of the duration below which a share q (0.99 = p99) of the recorded durations are
+    '''
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return self.upper_bound(index) / 1000000
+        return self.upper_bound(self.last_index) / 1000000
+
+    '''
+    (bound, cumulative count) for every bound (seconds, ascending). a fine bucket is counted under the first
+    bound at or above its upper bound, so a bucket that straddles a bound moves to the next one; the error is
+    the same 1 / 2**precision as the fine buckets
+    '''
+    def cumulative_counts(self, bounds):
+        buckets = []
+        seen = 0
+        index = 0
+        for bound in bounds:
+            limit = bound * 1000000
+            while index <= self.last_index and self.upper_bound(index) <= limit:
+                seen += self.counts[index]
+                index += 1
+            buckets.append((bound, seen))
+        return buckets
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+
+'''
+text exposition of one metric, samples is a list of (labels, value)
+'''
+def metric_lines(name, kind, help_text, samples):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        lines.append(f"{name}{format_labels(labels)} {value}")
+    return lines
+
+
+'''
+text exposition of a histogram, histograms is a list of (labels, LatencyHistogram). every histogram lists the
+same EXPORT_BOUNDS buckets, used or not
+'''
+def histogram_lines(name, help_text, histograms):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for labels, histogram in histograms:
+        for bound, count in histogram.cumulative_counts(EXPORT_BOUNDS):
+            lines.append(f"{name}_bucket{format_labels({**labels, 'le': f'{bound:g}'})} {count}")
+        lines.append(f"{name}_bucket{format_labels({**labels, 'le': '+Inf'})} {histogram.count}")
+        lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum:.6f}")
+        lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+    return lines
+
+
+class ResolverMetrics:
+    def __init__(self):
+        self.started = time.time()
+        self.latency = {}  # (transport, outcome) -> LatencyHistogram, its count is the number of queries
+        self.rcodes = [0] * 16  # responses sent per rcode
+
+    '''
+    records one query that arrived at started (time.perf_counter()). response is what was sent, None if nothing
+    '''
+    def observe(self, transport, outcome, started, response=None):
+        seconds = time.perf_counter() - started
+        if response is not None:
+            rcode = response[3] & 0x0F
+            self.rcodes[rcode] += 1
+            if rcode == dns_wire.NXDOMAIN and outcome != LIMITED:
+                outcome = NXDOMAIN
+        histogram = self.latency.get((transport, outcome))
+        if histogram is None:
+            histogram = self.latency[(transport, outcome)] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def render(self):
+        latency = sorted(self.latency.items())
+        lines = metric_lines("dns_queries_total", "counter", "Queries by transport and outcome.",
+                             [({"transport": transport, "outcome": outcome}, histogram.count)
+                              for (transport, outcome), histogram in latency])
+        lines += metric_lines("dns_responses_total", "counter", "Responses sent by rcode.",
+                              [({"rcode": RCODE_NAMES.get(rcode, str(rcode))}, count)
+                               for rcode, count in enumerate(self.rcodes) if count])
+        lines += histogram_lines("dns_query_duration_seconds", "Time from receiving a query to answering it.",
+                                 [({"transport": transport, "outcome": outcome}, histogram)
+                                  for (transport, outcome), histogram in latency])
+        lines += metric_lines("dns_start_time_seconds", "gauge", "Start time of the process since the epoch.",
+                              [({}, f"{self.started:.3f}")])
+        return lines
+
+
+async def serve_metrics_request(reader, writer, render):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while await asyncio.wait_for(reader.readline(), 5) not in (b'\r\n', b'\n', b''):
+            pass  # the headers are not needed
+        parts = request_line.split()
+        path = parts[1].split(b'?')[0] if len(parts) > 1 else b''
+        if parts[:1] == [b'GET'] and path in (b'/', b'/metrics'):
+            status, body = "200 OK", ('\n'.join(render()) + '\n').encode()
+        else:
+            status, body = "404 Not Found", b"not found, try /metrics\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    except Exception as e:
+        print(f"Error serving metrics: {e}")
+    finally:
+        writer.close()
+
+
+'''
+http endpoint on host:port that answers GET /metrics with the lines returned by render()
+'''
+async def start_metrics_server(render, host, port):
+    return await asyncio.start_server(lambda reader, writer: serve_metrics_request(reader, writer, render), host, port)
@@ -0,0 +1,164 @@
+'''
+rate limiting for the dns server, every decision is a dict lookup and a little arithmetic
+
+- per client ip and per client /24 (/64 for ipv6) token buckets on the queries
+- response rate limiting (rrl): a token bucket per (client /24, name, type, rcode), so a flood of identical
+  answers aimed at one network (a reflection attack with spoofed sources) is cut down
+- a budget of tunnel chunks per client ip over udp. every chunk has its own name, so rrl never matches them,
+  and a range answer is up to 1232 bytes for a ~70 byte query. a range is cut to the chunks left in the
+  budget, an empty budget gets an empty truncated answer, no bigger than the query
+
+over the limit, every slip-th query gets an empty truncated (TC=1) answer, so a real client retries over
+tcp, and the others are dropped. the buckets are kept in the order of their last use: the ones that refilled
+completely are removed a few at a time from the front, and a full table drops its least recently used bucket
+'''
+import functools
+import ipaddress
+import time
+from collections import OrderedDict
+
+
+ALLOW, SLIP, DROP = 'allow', 'slip', 'drop'
+
+
+'''
+the /24 (/64 for ipv6) network of a client address, ex: 2001:db8::1 -> 2001:db8::/64. parsing costs ~15 us,
+recent clients are remembered
+'''
+@functools.lru_cache(maxsize=65536)
+def subnet_of(ip):
+    prefix = 64 if ':' in ip else 24
+    address = ip.split('%', 1)[0]  # the scope of a link local source, ex: fe80::1%eth0
+    return str(ipaddress.ip_network(f"{address}/{prefix}", strict=False))
+
+
+class TokenBucketTable:
+    def __init__(self, rate, burst, max_entries=100000, sweep_batch=2):
+        self.rate = rate  # tokens added per second
+        self.burst = burst  # bucket size
+        self.refill_time = burst / rate  # seconds until an empty bucket is full again
+        self.max_entries = max_entries
+        self.sweep_batch = sweep_batch  # full buckets removed at most per call, more than one so the sweep keeps up
+        self.buckets = OrderedDict()  # key -> (tokens, time of the last update), least recently used first
+
+    '''
+    takes one token from the bucket of key, False if it is empty. O(1): a bounded sweep and a dict update
+    '''
+    def allow(self, key, now):
+        self.sweep(now)
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_entries:
+                self.buckets.popitem(last=False)  # the least recently used bucket
+            self.buckets[key] = (self.burst - 1, now)
+            return True
+
+        self.buckets.move_to_end(key)
+        tokens, updated = bucket
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            return False
+        self.buckets[key] = (tokens - 1, now)
+        return True
+
+    '''
+    takes up to wanted tokens from the bucket of key, returns how many it got (0 if it is empty)
+    '''
+    def take(self, key, now, wanted):
+        self.sweep(now)
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_entries:
+                self.buckets.popitem(last=False)
+            tokens = self.burst
+        else:
+            self.buckets.move_to_end(key)
+            tokens, updated = bucket
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        granted = min(wanted, int(tokens))
+        self.buckets[key] = (tokens - granted, now)
+        return granted
+
+    '''
+    removes up to sweep_batch of the least recently used buckets if they would be full by now, they behave
+    exactly like a missing one. the first bucket that is not full ends the sweep, every bucket after it was
+    used later
+    '''
+    def sweep(self, now):
+        for _ in range(self.sweep_batch):
+            if not self.buckets:
+                return
+            _, (_, updated) = next(iter(self.buckets.items()))
+            if now - updated < self.refill_time:
+                return
+            self.buckets.popitem(last=False)
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+class RateLimiter:
+    def __init__(self, client_rate=500, client_burst=1000, subnet_rate=2000, subnet_burst=4000, response_rate=50,
+                 response_burst=100, tunnel_rate=500, tunnel_burst=1000, slip=2, max_entries=100000):
+        self.clients = TokenBucketTable(client_rate, client_burst, max_entries)
+        self.subnets = TokenBucketTable(subnet_rate, subnet_burst, max_entries)
+        self.responses = TokenBucketTable(response_rate, response_burst, max_entries)
+        self.tunnel_chunks = TokenBucketTable(tunnel_rate, tunnel_burst, max_entries)  # chunks per second
+        self.slip = slip  # every slip-th limited query gets a truncated answer, 0 drops all of them
+        self.limited = 0
+        self.slipped = 0
+        self.dropped = 0
+        self.refused = 0  # tcp queries over the client limit
+        self.chunks_cut = 0  # tunnel chunks left out of udp answers
+
+    def over_limit(self):
+        self.limited += 1
+        if self.slip and self.limited % self.slip == 0:
+            self.slipped += 1
+            return SLIP
+        self.dropped += 1
+        return DROP
+
+    '''
+    called for every query before it is answered
+    '''
+    def check_query(self, client_ip, now=None):
+        now = time.monotonic() if now is None else now
+        # both buckets are charged, a client cannot hide behind its neighbours' unused budget
+        client_allowed = self.clients.allow(client_ip, now)
+        subnet_allowed = self.subnets.allow(subnet_of(client_ip), now)
+        if client_allowed and subnet_allowed:
+            return ALLOW
+        return self.over_limit()
+
+    '''
+    called for every query over tcp, where the source address is real: only the client's own bucket applies
+    '''
+    def check_client(self, client_ip, now=None):
+        now = time.monotonic() if now is None else now
+        if self.clients.allow(client_ip, now):
+            return True
+        self.refused += 1
+        return False
+
+    '''
+    called for every response before it is sent. identical responses are recognised by name, type and rcode
+    '''
+    def check_response(self, client_ip, query, rcode, now=None):
+        now = time.monotonic() if now is None else now
+        key = (subnet_of(client_ip), query.qname.lower(), query.qtype, rcode)
+        if self.responses.allow(key, now):
+            return ALLOW
+        return self.over_limit()
+
+    '''
+    called for a tunnel answer over udp with chunk_count chunks, returns how many of them may be sent
+    '''
+    def check_tunnel(self, client_ip, chunk_count, now=None):
+        now = time.monotonic() if now is None else now
+        granted = self.tunnel_chunks.take(client_ip, now, chunk_count)
+        self.chunks_cut += chunk_count - granted
+        return granted
@@ -0,0 +1,50 @@
+import os
+import struct
+import sys
+
+# the dns tools are flat scripts that import each other by module name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import dns_server
+import dns_wire
+
+
+def encode_name(name):
+    return b''.join(bytes([len(label)]) + label.encode() for label in name.rstrip('.').split('.')) + b'\x00'
+
+
+def make_query(name, qtype=dns_wire.TYPE_A, query_id=0x1234, flags=dns_wire.RD, additional=b'', arcount=0):
+    header = dns_wire.HEADER.pack(query_id, flags, 1, 0, 0, arcount)
+    return header + encode_name(name) + dns_wire.QUESTION_TAIL.pack(qtype, dns_wire.CLASS_IN) + additional
+
+
+'''
+an SOA record for the authority section, its name points at the question
+'''
+def soa_record(ttl, minimum):
+    rdata = b'\x00\x00' + struct.pack('!5I', 1, 7200, 900, 1209600, minimum)  # root mname and rname
+    return dns_wire.NAME_POINTER + dns_wire.RR_HEADER.pack(dns_wire.TYPE_SOA, dns_wire.CLASS_IN, ttl, len(rdata)) + \
+        rdata
+
+
+def make_response(name, qtype=dns_wire.TYPE_A, query_id=0x1234, rcode=dns_wire.NOERROR, answers=b'', ancount=0,
+                  authority=b'', nscount=0, tc=False):
+    query = dns_wire.parse_query(make_query(name, qtype, query_id))
+    response = bytearray(dns_wire.build_response(query, rcode, answers=answers, ancount=ancount, tc=tc) + authority)
+    struct.pack_into('!H', response, 8, nscount)
+    return bytes(response)
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "tunnel_files").mkdir()
+    (tmp_path / "tunnel_files" / "example.txt").write_bytes(bytes(range(256)) * 20)  # 5120 bytes, 35 chunks
+    (tmp_path / "records.json").write_text('{"ads.example.com.": "0.0.0.0", "*.reporo.net.": "0.0.0.0"}')
+    pihole = dns_server.DNSPiHole(records_file_path="records.json", pid_file_path="server.pid",
+                                  blocked_log_path="blocked.md", reload_interval=None)
+    yield pihole
+    pihole.sock.close()
+    pihole.block_logger.close()
@@ -0,0 +1,90 @@
+import pytest
+
+from blocklist_index import CompiledRecordIndex, compile_records, load_hosts_file
+from domain_trie import RecordIndex
+
+
+RECORDS = {
+    "ads.example.com.": "0.0.0.0",
+    "Tracker.Example.NET": "::",
+    "*.reporo.net.": "0.0.0.0",
+    "*.cdn.example.org.": "127.0.0.1",
+    "*.example.org.": "0.0.0.0",
+    "exact.example.org.": "10.0.0.1",
+    "*.b.c.": "0.0.0.0",
+}
+
+DOMAINS = [
+    "ads.example.com.", "tracker.example.net.", "reporo.net.", "x.y.reporo.net.", "notreporo.net.",
+    "cdn.example.org.", "img.cdn.example.org.", "example.org.", "www.example.org.", "exact.example.org.",
+    "a.b.c.", "b.c.", "c.", "example.com.", "www.ads.example.com.", "com.", ".", "unrelated.test.",
+]
+
+
+@pytest.fixture
+def compiled(tmp_path):
+    path = str(tmp_path / "records.dnsbl")
+    compile_records(RECORDS, path)
+    index = CompiledRecordIndex(path)
+    yield index
+    index.close()
+
+
+@pytest.mark.parametrize("domain", DOMAINS)
+def test_compiled_index_matches_record_index(compiled, domain):
+    assert compiled.lookup(domain) == RecordIndex(RECORDS).lookup(domain)
+
+
+def test_lookups(compiled):
+    assert len(compiled) == len(RECORDS)
+    assert compiled.lookup("img.cdn.example.org.") == "127.0.0.1"  # the longest suffix rule wins
+    assert compiled.lookup("exact.example.org.") == "10.0.0.1"  # exact names before suffix rules
+    assert compiled.lookup("tracker.example.net.") == "::"
+    assert compiled.lookup("www.ads.example.com.") is None  # exact names do not cover subdomains
+
+
+def test_index_without_suffix_rules(tmp_path):
+    records = {"ads.example.com.": "0.0.0.0"}
+    path = str(tmp_path / "records.dnsbl")
+    compile_records(records, path)
+    index = CompiledRecordIndex(path)
+    try:
+        for domain in DOMAINS:
+            assert index.lookup(domain) == RecordIndex(records).lookup(domain)
+    finally:
+        index.close()
+
+
+def test_not_a_compiled_blocklist(tmp_path):
+    path = tmp_path / "records.dnsbl"
+    path.write_bytes(b'{"ads.example.com.": "0.0.0.0"}')
+    with pytest.raises(ValueError):
+        CompiledRecordIndex(str(path))
+
+
+@pytest.mark.parametrize("rdata", ["not an address", "fe80::1%lo0", "1.2.3.256", ""])
+def test_compile_rejects_bad_rdata(tmp_path, rdata):
+    with pytest.raises(ValueError, match="ads.example.com."):
+        compile_records({"ads.example.com.": rdata}, str(tmp_path / "records.dnsbl"))
+
+
+def test_hosts_file(tmp_path):
+    path = tmp_path / "hosts"
+    path.write_text(
+        "# header\n"
+        "127.0.0.1 localhost localhost.localdomain\n"
+        "255.255.255.255 broadcasthost\n"
+        "::1 localhost ip6-localhost ip6-loopback\n"
+        "fe80::1%lo0 localhost\n"
+        "0.0.0.0 0.0.0.0\n"
+        "\n"
+        "0.0.0.0 ads.example.com Tracker.example.net  # trailing comment\n"
+        "0:0:0:0:0:0:0:0 v6.example.com\n"
+        "ads.example.org\n"
+        "not-an-address bad.example.com\n"
+    )
+    assert load_hosts_file(str(path)) == {
+        "ads.example.com.": "0.0.0.0",
+        "tracker.example.net.": "0.0.0.0",
+        "v6.example.com.": "::",
+    }
@@ -0,0 +1,136 @@
+import base64
+import json
+import os
+import zlib
+
+import pytest
+
+from chunk_writer import RAW_CHUNK_SIZE, ChunkWriter, to_ranges
+
+
+DATA = bytes(range(256)) * 3  # 768 bytes, 6 chunks, the last one shorter
+
+
+def chunks_of(data):
+    return [base64.b64encode(data[offset:offset + RAW_CHUNK_SIZE]) for offset in range(0, len(data), RAW_CHUNK_SIZE)]
+
+
+def test_to_ranges():
+    assert to_ranges([]) == []
+    assert to_ranges([6, 0, 2, 1, 5]) == [[0, 2], [5, 6]]
+    assert to_ranges({3}) == [[3, 3]]
+
+
+def test_chunks_in_any_order(tmp_path):
+    output = str(tmp_path / "out" / "file.bin")
+    chunks = chunks_of(DATA)
+    writer = ChunkWriter(output, total_chunks=len(chunks))
+    assert writer.open() == 0
+    for index in reversed(range(len(chunks))):
+        writer.write(index, chunks[index])
+    writer.write(0, chunks[0])  # duplicates are ignored
+    writer.finish()
+
+    with open(output, 'rb') as file:
+        assert file.read() == DATA
+    assert not os.path.exists(writer.part_path)
+    assert not os.path.exists(writer.manifest_path)
+
+
+def test_resume(tmp_path):
+    output = str(tmp_path / "file.bin")
+    chunks = chunks_of(DATA)
+    writer = ChunkWriter(output, total_chunks=len(chunks))
+    writer.open()
+    for index in (0, 1, 4):
+        writer.write(index, chunks[index])
+    writer.close()
+
+    with open(writer.manifest_path) as file:
+        manifest = json.load(file)
+    assert manifest == {"file": "file.bin", "chunks": 6, "codec": None, "received": [[0, 1], [4, 4]]}
+
+    writer = ChunkWriter(output)  # the chunk count comes from the manifest
+    assert writer.open() == 3
+    assert writer.total_chunks == 6
+    assert writer.has(4) and not writer.has(2)
+    assert writer.first_missing() == 2
+    for index in (2, 3, 5):
+        writer.write(index, chunks[index])
+    writer.finish()
+    with open(output, 'rb') as file:
+        assert file.read() == DATA
+
+
+def test_manifest_of_another_download_is_ignored(tmp_path):
+    output = str(tmp_path / "file.bin")
+    writer = ChunkWriter(output, total_chunks=6)
+    writer.open()
+    writer.write(0, chunks_of(DATA)[0])
+    writer.close()
+
+    writer = ChunkWriter(output, total_chunks=7)
+    assert writer.open() == 0
+    writer.close()
+    writer = ChunkWriter(output, total_chunks=7, codec='zlib')
+    assert writer.open() == 0
+    writer.close()
+
+
+def test_damaged_manifest_restarts(tmp_path):
+    output = str(tmp_path / "file.bin")
+    writer = ChunkWriter(output, total_chunks=6)
+    writer.open()
+    writer.write(0, chunks_of(DATA)[0])
+    writer.close()
+    with open(writer.manifest_path, 'w') as file:
+        file.write('{"received": [[0,')
+
+    writer = ChunkWriter(output, total_chunks=6)
+    assert writer.open() == 0
+    writer.close()
+
+
+def test_close_without_chunks_leaves_nothing(tmp_path):
+    output = str(tmp_path / "file.bin")
+    writer = ChunkWriter(output, total_chunks=6, codec='lzma')
+    writer.open()
+    writer.close()
+    assert os.listdir(tmp_path) == []
+
+
+def test_compressed_resume(tmp_path):
+    output = str(tmp_path / "file.bin")
+    chunks = chunks_of(zlib.compress(DATA * 4))
+    writer = ChunkWriter(output, total_chunks=len(chunks), codec='zlib')
+    writer.open()
+    for index in range(1, len(chunks)):
+        writer.write(index, chunks[index])
+    writer.close()
+
+    writer = ChunkWriter(output, total_chunks=len(chunks), codec='zlib')
+    assert writer.open() == len(chunks) - 1
+    writer.write(0, chunks[0])
+    writer.finish()
+    with open(output, 'rb') as file:
+        assert file.read() == DATA * 4
+    assert os.listdir(tmp_path) == ["file.bin"]
+
+
+def test_damaged_compressed_data(tmp_path):
+    output = str(tmp_path / "file.bin")
+    compressed = bytearray(zlib.compress(DATA * 4))
+    compressed[:2] = b'\x00\x00'  # not a zlib header
+    chunks = chunks_of(bytes(compressed))
+    writer = ChunkWriter(output, total_chunks=len(chunks), codec='zlib')
+    writer.open()
+    for index, chunk in enumerate(chunks):
+        writer.write(index, chunk)
+    with pytest.raises(ValueError):
+        writer.finish()
+    assert os.listdir(tmp_path) == []
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        ChunkWriter("file.bin", codec='gzip')
@@ -0,0 +1,167 @@
+import pytest
+
+import dns_cache
+import dns_wire
+from conftest import make_query, make_response, soa_record
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dns_cache.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def answer_ttls(response):
+    return [ttl for _, ttl in dns_wire.parse_response(response).ttl_offsets]
+
+
+def a_response(name, ttls, query_id=0x1234):
+    answers = b''.join(dns_wire.address_record("1.2.3.4", ttl) for ttl in ttls)
+    return make_response(name, query_id=query_id, answers=answers, ancount=len(ttls))
+
+
+def test_ttls_count_down(clock):
+    cache = dns_cache.DNSAnswerCache()
+    query = dns_wire.parse_query(make_query("example.com."))
+    cache.put(query, a_response("example.com.", [300, 60]))
+
+    clock[0] += 10.5
+    assert answer_ttls(cache.get(query)) == [290, 50]
+    clock[0] += 49
+    assert answer_ttls(cache.get(query)) == [241, 1]
+    clock[0] += 1
+    assert cache.get(query) is None  # the shortest ttl ended the entry
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_answer_takes_id_and_question_of_the_query(clock):
+    cache = dns_cache.DNSAnswerCache()
+    cache.put(dns_wire.parse_query(make_query("example.com.")), a_response("example.com.", [300]))
+
+    query = dns_wire.parse_query(make_query("EXAMPLE.com.", query_id=42))
+    answer = dns_wire.parse_query(cache.get(query))
+    assert answer.id == 42
+    assert answer.qname == "EXAMPLE.com."
+
+
+def test_nxdomain_is_cached_for_the_soa_minimum(clock):
+    cache = dns_cache.DNSAnswerCache()
+    query = dns_wire.parse_query(make_query("missing.example."))
+    cache.put(query, make_response("missing.example.", rcode=dns_wire.NXDOMAIN, authority=soa_record(3600, 120),
+                                   nscount=1))
+
+    clock[0] += 100
+    response = cache.get(query)
+    assert dns_wire.response_rcode(response) == dns_wire.NXDOMAIN
+    assert answer_ttls(response) == [3500]  # every ttl counts down, the entry lives for the soa minimum
+    clock[0] += 20
+    assert cache.get(query) is None
+
+
+def test_negative_ttl_is_capped(clock):
+    cache = dns_cache.DNSAnswerCache(max_negative_ttl=60)
+    query = dns_wire.parse_query(make_query("missing.example."))
+    cache.put(query, make_response("missing.example.", rcode=dns_wire.NXDOMAIN, authority=soa_record(3600, 3600),
+                                   nscount=1))
+    clock[0] += 59
+    assert cache.get(query) is not None
+    clock[0] += 1
+    assert cache.get(query) is None
+
+
+@pytest.mark.parametrize("response", [
+    make_response("example.com.", rcode=dns_wire.SERVFAIL),
+    make_response("example.com.", rcode=dns_wire.NXDOMAIN),  # no soa, no negative ttl
+    make_response("example.com.", answers=dns_wire.address_record("1.2.3.4", 300), ancount=1, tc=True),
+    make_response("example.com.", answers=dns_wire.address_record("1.2.3.4", 0), ancount=1),
+    make_response("other.example.", answers=dns_wire.address_record("1.2.3.4", 300), ancount=1),
+    make_response("example.com.", answers=dns_wire.address_record("1.2.3.4", 300), ancount=1)[:-1],
+])
+def test_responses_that_are_not_cached(clock, response):
+    cache = dns_cache.DNSAnswerCache()
+    cache.put(dns_wire.parse_query(make_query("example.com.")), response)
+    assert len(cache) == 0
+
+
+def test_answers_are_only_shared_between_queries_with_the_same_edns(clock):
+    cache = dns_cache.DNSAnswerCache()
+    plain = dns_wire.parse_query(make_query("example.com."))
+    edns = dns_wire.parse_query(make_query("example.com.", additional=dns_wire.opt_record(4096), arcount=1))
+    smaller = dns_wire.parse_query(make_query("example.com.", additional=dns_wire.opt_record(1232), arcount=1))
+    dnssec_ok = dns_wire.parse_query(make_query(
+        "example.com.", additional=dns_wire.OPT_RECORD.pack(0, dns_wire.TYPE_OPT, 1232, dns_wire.DO, 0), arcount=1))
+
+    response = bytearray(a_response("example.com.", [300]) + dns_wire.opt_record(4096))
+    response[11] = 1  # arcount
+    cache.put(edns, bytes(response))
+    assert cache.get(plain) is None  # would get an OPT record it did not ask for
+    assert cache.get(dnssec_ok) is None
+    assert cache.get(smaller) is not None  # the size is checked when the answer is sent
+    assert len(cache) == 1
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    size = len(a_response("a.example.", [300])) + dns_cache.ENTRY_OVERHEAD
+    cache = dns_cache.DNSAnswerCache(max_bytes=2 * size)
+    queries = {name: dns_wire.parse_query(make_query(name)) for name in ("a.example.", "b.example.", "c.example.")}
+    cache.put(queries["a.example."], a_response("a.example.", [300]))
+    cache.put(queries["b.example."], a_response("b.example.", [300]))
+    cache.get(queries["a.example."])
+    cache.put(queries["c.example."], a_response("c.example.", [300]))
+
+    assert len(cache) == 2
+    assert cache.get(queries["b.example."]) is None
+    assert cache.get(queries["a.example."]) is not None
+    assert cache.size == 2 * size
+
+
+def test_prefetch_is_claimed_once_near_the_end_of_a_popular_entry(clock):
+    cache = dns_cache.DNSAnswerCache(prefetch_hits=3, prefetch_fraction=0.1)
+    query = dns_wire.parse_query(make_query("example.com."))
+    cache.put(query, a_response("example.com.", [100]))
+
+    for _ in range(3):
+        cache.get(query)
+    assert not cache.claim_prefetch(query)  # popular, but 100 seconds left
+    clock[0] += 91
+    assert cache.claim_prefetch(query)
+    assert not cache.claim_prefetch(query)  # already refreshing
+    assert cache.prefetches == 1
+
+    cache.put(query, a_response("example.com.", [100]))  # the refresh keeps the hits
+    clock[0] += 91
+    assert cache.claim_prefetch(query)
+
+
+def test_unpopular_entry_is_not_prefetched(clock):
+    cache = dns_cache.DNSAnswerCache(prefetch_hits=3)
+    query = dns_wire.parse_query(make_query("example.com."))
+    cache.put(query, a_response("example.com.", [100]))
+    cache.get(query)
+    clock[0] += 95
+    assert not cache.claim_prefetch(query)
+
+
+def test_stale_answer(clock):
+    cache = dns_cache.DNSAnswerCache(max_stale=3600, stale_ttl=30)
+    query = dns_wire.parse_query(make_query("example.com."))
+    cache.put(query, a_response("example.com.", [60, 300]))
+    assert cache.get_stale(query) is not None  # not expired yet, the caller only asks when the upstream failed
+
+    clock[0] += 600
+    assert cache.get(query) is None
+    assert answer_ttls(cache.get_stale(query)) == [30, 30]
+    clock[0] += 3600
+    assert cache.get_stale(query) is None
+    assert cache.get(query) is None
+    assert len(cache) == 0  # removed once it is too old to be served
+    assert cache.stale_hits == 2
+
+
+def test_serve_stale_disabled(clock):
+    cache = dns_cache.DNSAnswerCache(max_stale=0)
+    query = dns_wire.parse_query(make_query("example.com."))
+    cache.put(query, a_response("example.com.", [60]))
+    clock[0] += 60
+    assert cache.get_stale(query) is None
@@ -0,0 +1,273 @@
+import asyncio
+import time
+
+import dns_wire
+import metrics
+from conftest import make_query
+from rate_limit import RateLimiter
+
+
+CLIENT = ("192.0.2.1", 40000)
+
+
+def tunnel_query(name, udp_size=1232):
+    additional = dns_wire.opt_record(udp_size) if udp_size else b''
+    return dns_wire.parse_query(make_query(name, dns_wire.TYPE_TXT, additional=additional,
+                                           arcount=1 if udp_size else 0))
+
+
+def test_tunnel_range_is_capped_at_1232_bytes(server):
+    query = tunnel_query("chunk0-999.example.tunnel.broski.software.", udp_size=65535)
+    outcome, response = server.local_response(query, CLIENT)
+    assert outcome == metrics.TUNNEL
+    assert len(response) <= 1232
+    chunks = dns_wire.parse_txt_answers(response)
+    assert len(chunks) == 5
+    assert all(len(chunk) == 200 for chunk in chunks)
+
+
+def test_tunnel_range_without_edns_fits_512_bytes(server):
+    _, response = server.local_response(tunnel_query("chunk0-999.example.tunnel.broski.software.", None), CLIENT)
+    assert len(response) <= dns_wire.MIN_UDP_PAYLOAD
+    assert len(dns_wire.parse_txt_answers(response)) == 2
+
+
+def test_tunnel_range_over_tcp_is_not_capped(server):
+    server.rate_limiter = RateLimiter(tunnel_burst=1)
+    _, response = server.local_response(tunnel_query("chunk0-999.example.tunnel.broski.software."), CLIENT, tcp=True)
+    chunks = dns_wire.parse_txt_answers(response)
+    assert len(chunks) == 36 and chunks[-1] == b''  # 35 chunks and the end of file record
+
+
+def test_tunnel_budget_cuts_ranges_then_truncates(server):
+    server.rate_limiter = RateLimiter(tunnel_rate=1, tunnel_burst=7)
+    query = tunnel_query("chunk0-999.example.tunnel.broski.software.")
+
+    _, response = server.local_response(query, CLIENT)
+    assert len(dns_wire.parse_txt_answers(response)) == 5
+    outcome, response = server.local_response(query, CLIENT)
+    assert outcome == metrics.TUNNEL
+    assert len(dns_wire.parse_txt_answers(response)) == 2  # cut to the rest of the budget
+
+    outcome, response = server.local_response(query, CLIENT)
+    assert outcome == metrics.LIMITED
+    assert dns_wire.parse_query(response).flags & dns_wire.TC
+    assert dns_wire.parse_txt_answers(response) == []
+    assert len(response) <= len(query.data)  # no amplification
+
+    _, response = server.local_response(query, ("192.0.2.2", 40000))  # every client has its own budget
+    assert len(dns_wire.parse_txt_answers(response)) == 5
+    assert server.rate_limiter.chunks_cut == 3 + 5
+
+
+def test_tunnel_info_and_missing_files(server):
+    _, response = server.local_response(tunnel_query("info.example.tunnel.broski.software."), CLIENT)
+    assert dns_wire.parse_txt_answers(response) == [b'chunks=35 size=5120']
+    _, response = server.local_response(tunnel_query("chunk0.missing.tunnel.broski.software."), CLIENT)
+    assert dns_wire.response_rcode(response) == dns_wire.NXDOMAIN
+
+
+class SlowPool:
+    def __init__(self, delay):
+        self.delay = delay
+        self.queries = 0
+
+    async def query(self, query):
+        self.queries += 1
+        await asyncio.sleep(self.delay)
+        return None  # like an upstream that never answers
+
+
+def test_forwards_wait_a_bounded_time_in_a_bounded_queue(server):
+    server.max_inflight_upstream = 2
+    server.max_queued_upstream = 3
+    server.upstream_timeout = 0.2
+    server.upstream_pool = SlowPool(0.3)
+
+    async def flood():
+        server.upstream_slots = asyncio.Semaphore(server.max_inflight_upstream)
+        queries = [dns_wire.parse_query(make_query(f"{index}.flood.example.")) for index in range(10)]
+        started = time.monotonic()
+        results = await asyncio.gather(*(server.dns_upstream_request_async(query) for query in queries))
+        elapsed = time.monotonic() - started
+        # every slot came back
+        assert not server.upstream_slots.locked()
+        for _ in range(server.max_inflight_upstream):
+            await server.upstream_slots.acquire()
+        return results, elapsed
+
+    results, elapsed = asyncio.run(flood())
+    assert results == [None] * 10
+    assert server.upstream_pool.queries == 2  # the queued ones gave up before a slot was free
+    assert server.upstream_shed == 8  # 5 over the queue cap at once, 3 after waiting 0.2s
+    assert server.upstream_waiting == 0
+    assert elapsed < 0.5
+
+
+def test_cancelled_forward_gives_its_slot_back(server):
+    server.max_inflight_upstream = 1
+    server.upstream_timeout = 5
+    server.upstream_pool = SlowPool(0.1)
+
+    async def cancel_waiter():
+        server.upstream_slots = asyncio.Semaphore(1)
+        first = asyncio.ensure_future(server.dns_upstream_request_async(dns_wire.parse_query(make_query("a.example."))))
+        waiter = asyncio.ensure_future(server.dns_upstream_request_async(dns_wire.parse_query(make_query("b.example."))))
+        await asyncio.sleep(0.01)
+        assert server.upstream_waiting == 1
+        waiter.cancel()
+        await first
+        await asyncio.sleep(0)
+        assert server.upstream_waiting == 0
+        assert not server.upstream_slots.locked()
+
+    asyncio.run(cancel_waiter())
+    assert server.upstream_pool.queries == 1
+
+
+class SentPackets:
+    def __init__(self):
+        self.packets = []
+
+    def sendto(self, data, address):
+        self.packets.append(data)
+
+
+def big_answer(query, addresses=40):
+    answers = b''.join(dns_wire.address_record(f"10.0.0.{index}", 300) for index in range(addresses))
+    return dns_wire.build_response(query, answers=answers, ancount=addresses,
+                                   additional=dns_wire.opt_record(4096), arcount=1)
+
+
+def test_udp_answers_too_big_for_the_client_are_truncated(server):
+    edns = dns_wire.parse_query(make_query("big.example.", additional=dns_wire.opt_record(4096), arcount=1))
+    response = big_answer(edns)
+    assert len(response) > 600
+
+    assert server.fit_udp(edns, response) is response
+    smaller = dns_wire.parse_query(make_query("big.example.", additional=dns_wire.opt_record(512), arcount=1))
+    truncated = server.fit_udp(smaller, response)
+    assert dns_wire.parse_query(truncated).flags & dns_wire.TC
+    assert dns_wire.edns_udp_size(dns_wire.parse_query(truncated)) == server.max_udp_payload
+
+    plain = dns_wire.parse_query(make_query("big.example."))
+    transport = SentPackets()
+    server.send_limited(transport, plain, response, CLIENT, metrics.FORWARDED, time.perf_counter())
+    (sent,) = transport.packets
+    assert len(sent) <= dns_wire.MIN_UDP_PAYLOAD
+    assert dns_wire.parse_query(sent).flags & dns_wire.TC
+    assert dns_wire.edns_udp_size(dns_wire.parse_query(sent)) is None  # no OPT record it did not ask for
+
+
+class AnsweringPool:
+    def __init__(self):
+        self.queries = []
+
+    async def query(self, query):
+        self.queries.append(query)
+        await asyncio.sleep(0.05)
+        return big_answer(query) if dns_wire.edns_udp_size(query) else dns_wire.build_response(query)
+
+
+def test_identical_forwards_are_only_shared_with_the_same_edns(server):
+    server.upstream_pool = AnsweringPool()
+    plain = [dns_wire.parse_query(make_query("shared.example.", query_id=index)) for index in range(3)]
+    edns = [dns_wire.parse_query(make_query("shared.example.", query_id=10 + index,
+                                            additional=dns_wire.opt_record(4096), arcount=1)) for index in range(3)]
+
+    async def forward_all():
+        server.upstream_slots = asyncio.Semaphore(server.max_inflight_upstream)
+        return await asyncio.gather(*(server.coalesced_upstream_request(query) for query in plain + edns))
+
+    responses = asyncio.run(forward_all())
+    assert len(server.upstream_pool.queries) == 2
+    for query, response in zip(plain + edns, responses):
+        assert dns_wire.parse_query(response).id == query.id
+        assert (dns_wire.edns_udp_size(dns_wire.parse_query(response)) is None) == (query in plain)
+
+
+class DelayedPool:
+    def __init__(self, delays):
+        self.delays = delays  # qname -> seconds before the answer
+
+    async def query(self, query):
+        await asyncio.sleep(self.delays.get(query.qname, 0))
+        return dns_wire.build_response(query, answers=dns_wire.address_record("1.2.3.4", 60), ancount=1)
+
+
+'''
+sends the queries in one write over a tcp connection to the server, closes the sending side when half_close is
+set and returns the answers in the order they arrived and the seconds until the server closed the connection
+'''
+def tcp_exchange(server, queries, half_close=True):
+    async def exchange():
+        server.upstream_slots = asyncio.Semaphore(server.max_inflight_upstream)
+        listener = await asyncio.start_server(server.serve_tcp_connection, '127.0.0.1', 0)
+        try:
+            reader, writer = await asyncio.open_connection(*listener.sockets[0].getsockname())
+            started = time.monotonic()
+            writer.write(b''.join(dns_wire.TCP_LENGTH.pack(len(query)) + query for query in queries))
+            if half_close:
+                writer.write_eof()
+            answers = []
+            while True:
+                try:
+                    prefix = await asyncio.wait_for(reader.readexactly(dns_wire.TCP_LENGTH.size), 5)
+                except (asyncio.IncompleteReadError, ConnectionResetError):
+                    break  # closed, with a reset if the server did not read what was sent
+                (length,) = dns_wire.TCP_LENGTH.unpack(prefix)
+                answers.append(dns_wire.parse_query(await reader.readexactly(length)))
+            elapsed = time.monotonic() - started
+            writer.close()
+            return answers, elapsed
+        finally:
+            listener.close()
+            await listener.wait_closed()
+
+    return asyncio.run(exchange())
+
+
+def test_tcp_pipelined_answers_are_sent_as_they_are_ready(server):
+    server.upstream_pool = DelayedPool({"slow.example.": 0.2})
+    queries = [make_query("slow.example.", query_id=1), make_query("fast.example.", query_id=2),
+               make_query("ads.example.com.", query_id=3)]
+    answers, elapsed = tcp_exchange(server, queries)
+    # the blocked and the fast names do not wait for the slow forward in front of them
+    assert [answer.id for answer in answers][-1] == 1
+    assert sorted(answer.id for answer in answers) == [1, 2, 3]
+    assert elapsed < 1
+    assert server.tcp_connections == 0
+
+
+def test_tcp_half_close_still_gets_the_answers_in_progress(server):
+    server.upstream_pool = DelayedPool({"a.example.": 0.1, "b.example.": 0.15})
+    answers, _ = tcp_exchange(server, [make_query("a.example.", query_id=1), make_query("b.example.", query_id=2)])
+    assert [answer.id for answer in answers] == [1, 2]
+    assert all(answer.flags & dns_wire.QR for answer in answers)
+
+
+def test_tcp_pipeline_limit_answers_in_turn(server):
+    server.max_tcp_pipeline = 1
+    server.upstream_pool = DelayedPool({"slow.example.": 0.1})
+    answers, _ = tcp_exchange(server, [make_query("slow.example.", query_id=1), make_query("fast.example.", query_id=2)])
+    assert [answer.id for answer in answers] == [1, 2]
+
+
+def test_tcp_idle_connection_is_closed(server):
+    server.tcp_idle_timeout = 0.1
+    answers, elapsed = tcp_exchange(server, [], half_close=False)
+    assert answers == []
+    assert 0.05 < elapsed < 1
+
+
+def test_tcp_malformed_query_is_dropped_and_the_rest_answered(server):
+    server.upstream_pool = DelayedPool({})
+    answers, _ = tcp_exchange(server, [b'\x00\x01garbage', make_query("fast.example.", query_id=2)])
+    assert [answer.id for answer in answers] == [2]
+
+
+def test_tcp_connections_over_the_limit_are_closed(server):
+    server.max_tcp_connections = 0
+    answers, elapsed = tcp_exchange(server, [make_query("ads.example.com.")], half_close=False)
+    assert answers == []
+    assert elapsed < 1
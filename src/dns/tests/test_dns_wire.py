@@ -0,0 +1,162 @@
+import struct
+
+import pytest
+
+import dns_wire
+from conftest import make_query, make_response, soa_record
+
+
+def test_parse_query():
+    query = dns_wire.parse_query(make_query("Ads.Example.com.", dns_wire.TYPE_AAAA))
+    assert query.id == 0x1234
+    assert query.qname == "Ads.Example.com."
+    assert query.qtype == dns_wire.TYPE_AAAA
+    assert query.qclass == dns_wire.CLASS_IN
+    assert query.opcode == 0
+    assert query.question_end == len(make_query("Ads.Example.com."))
+
+
+def test_parse_root_query():
+    data = dns_wire.HEADER.pack(1, 0, 1, 0, 0, 0) + b'\x00' + dns_wire.QUESTION_TAIL.pack(1, 1)
+    assert dns_wire.parse_query(data).qname == '.'
+
+
+@pytest.mark.parametrize("data", [
+    b'',
+    b'\x00' * 5,  # shorter than a header
+    dns_wire.HEADER.pack(1, 0, 0, 0, 0, 0),  # no question
+    dns_wire.HEADER.pack(1, 0, 1, 0, 0, 0) + b'\x07example',  # name without its end
+    dns_wire.HEADER.pack(1, 0, 1, 0, 0, 0) + b'\x3fabc',  # label longer than the packet
+    dns_wire.HEADER.pack(1, 0, 1, 0, 0, 0) + b'\x07example\x00\x00',  # truncated qtype / qclass
+    dns_wire.HEADER.pack(1, 0, 1, 0, 0, 0) + b'\xc0',  # truncated compression pointer
+    dns_wire.HEADER.pack(1, 0, 1, 0, 0, 0) + b'\xc0\x0c',  # pointer to itself
+    dns_wire.HEADER.pack(1, 0, 1, 0, 0, 0) + b'\x80abc\x00' + b'\x00' * 4,  # reserved label type
+])
+def test_parse_query_rejects_malformed_packets(data):
+    with pytest.raises(ValueError):
+        dns_wire.parse_query(data)
+
+
+def test_build_response_copies_id_question_and_rd():
+    query = dns_wire.parse_query(make_query("example.com."))
+    answers = dns_wire.address_record("1.2.3.4", 300)
+    response = dns_wire.build_response(query, aa=True, answers=answers, ancount=1)
+
+    query_id, flags, qdcount, ancount, nscount, arcount = dns_wire.HEADER.unpack_from(response)
+    assert query_id == query.id
+    assert flags & dns_wire.QR and flags & dns_wire.AA and flags & dns_wire.RD
+    assert not flags & dns_wire.TC
+    assert (qdcount, ancount, nscount, arcount) == (1, 1, 0, 0)
+    assert response[dns_wire.HEADER.size:query.question_end] == query.data[dns_wire.HEADER.size:query.question_end]
+    assert response.endswith(bytes([1, 2, 3, 4]))
+    assert dns_wire.response_rcode(response) == dns_wire.NOERROR
+
+
+def test_build_truncated_nxdomain_response():
+    query = dns_wire.parse_query(make_query("missing.example."))
+    response = dns_wire.build_response(query, rcode=dns_wire.NXDOMAIN, tc=True)
+    assert dns_wire.response_rcode(response) == dns_wire.NXDOMAIN
+    assert dns_wire.parse_query(response).flags & dns_wire.TC
+
+
+def test_parse_response_ttls():
+    query = dns_wire.parse_query(make_query("example.com."))
+    answers = dns_wire.address_record("1.2.3.4", 300) + dns_wire.address_record("5.6.7.8", 60)
+    response = dns_wire.parse_response(dns_wire.build_response(query, answers=answers, ancount=2))
+    assert response.rcode == dns_wire.NOERROR
+    assert response.min_answer_ttl == 60
+    assert [ttl for _, ttl in response.ttl_offsets] == [300, 60]
+    assert response.negative_ttl is None
+
+
+def test_parse_response_negative_ttl():
+    response = dns_wire.parse_response(make_response("missing.example.", rcode=dns_wire.NXDOMAIN,
+                                                     authority=soa_record(3600, 300), nscount=1))
+    assert response.rcode == dns_wire.NXDOMAIN
+    assert response.min_answer_ttl is None
+    assert response.negative_ttl == 300
+
+
+def test_parse_response_rejects_truncated_record():
+    query = dns_wire.parse_query(make_query("example.com."))
+    response = dns_wire.build_response(query, answers=dns_wire.address_record("1.2.3.4", 300), ancount=1)
+    with pytest.raises(ValueError):
+        dns_wire.parse_response(response[:-2])
+
+
+def test_edns_udp_size():
+    assert dns_wire.edns_udp_size(dns_wire.parse_query(make_query("example.com."))) is None
+    query = make_query("example.com.", additional=dns_wire.opt_record(1232), arcount=1)
+    assert dns_wire.edns_udp_size(dns_wire.parse_query(query)) == 1232
+    small = make_query("example.com.", additional=dns_wire.opt_record(100), arcount=1)
+    assert dns_wire.edns_udp_size(dns_wire.parse_query(small)) == dns_wire.MIN_UDP_PAYLOAD
+
+
+def test_edns_options():
+    assert dns_wire.edns_options(dns_wire.parse_query(make_query("example.com."))) is None
+    query = make_query("example.com.", additional=dns_wire.opt_record(4096), arcount=1)
+    assert dns_wire.edns_options(dns_wire.parse_query(query)) == (4096, False)
+    dnssec_ok = dns_wire.OPT_RECORD.pack(0, dns_wire.TYPE_OPT, 1232, dns_wire.DO, 0)
+    query = make_query("example.com.", additional=dnssec_ok, arcount=1)
+    assert dns_wire.edns_options(dns_wire.parse_query(query)) == (1232, True)
+
+
+@pytest.mark.parametrize("address, qtype, expected", [
+    ("1.2.3.4", dns_wire.TYPE_A, (dns_wire.TYPE_A, bytes([1, 2, 3, 4]))),
+    ("1.2.3.4", dns_wire.TYPE_AAAA, None),
+    ("0.0.0.0", dns_wire.TYPE_AAAA, (dns_wire.TYPE_AAAA, bytes(16))),
+    ("::", dns_wire.TYPE_A, (dns_wire.TYPE_A, bytes(4))),
+    ("0.0.0.0", dns_wire.TYPE_TXT, None),
+    ("2001:db8::1", dns_wire.TYPE_ANY, (dns_wire.TYPE_AAAA, bytes.fromhex("20010db8000000000000000000000001"))),
+])
+def test_address_answer(address, qtype, expected):
+    answers, count = dns_wire.address_answer(address, qtype, 300)
+    if expected is None:
+        assert (answers, count) == (b'', 0)
+        return
+    assert count == 1
+    record_type, record_class, ttl, rdlength = dns_wire.RR_HEADER.unpack_from(answers, 2)
+    assert answers[:2] == dns_wire.NAME_POINTER
+    assert (record_type, record_class, ttl) == (expected[0], dns_wire.CLASS_IN, 300)
+    assert answers[2 + dns_wire.RR_HEADER.size:] == expected[1]
+    assert rdlength == len(expected[1])
+
+
+def test_txt_records_round_trip():
+    query = dns_wire.parse_query(make_query("chunk0.example.tunnel.broski.software.", dns_wire.TYPE_TXT))
+    answers = dns_wire.txt_record([b'a' * 200], 0) + dns_wire.txt_record([b'x' * 255, b'y'], 0) + \
+        dns_wire.txt_record([b''], 0)
+    response = dns_wire.build_response(query, answers=answers, ancount=3)
+    assert dns_wire.parse_txt_answers(response) == [b'a' * 200, b'x' * 255 + b'y', b'']
+
+
+def test_parse_txt_answers_rejects_truncated_record():
+    query = dns_wire.parse_query(make_query("chunk0.example.tunnel.broski.software.", dns_wire.TYPE_TXT))
+    response = dns_wire.build_response(query, answers=dns_wire.txt_record([b'a' * 200], 0), ancount=1)
+    with pytest.raises(ValueError):
+        dns_wire.parse_txt_answers(response[:-10])
+
+
+def test_set_id_and_copy_question():
+    query = dns_wire.parse_query(make_query("Example.COM.", query_id=7))
+    upstream = dns_wire.build_response(dns_wire.parse_query(make_query("example.com.", query_id=99)))
+    copied = dns_wire.copy_question(upstream, query)
+    assert struct.unpack_from('!H', copied)[0] == 7
+    assert dns_wire.parse_query(copied).qname == "Example.COM."
+    assert struct.unpack_from('!H', dns_wire.set_id(upstream, 500))[0] == 500
+
+
+def test_build_query_round_trip():
+    assert dns_wire.encode_name("example.com.") == b'\x07example\x03com\x00'
+    assert dns_wire.encode_name(".") == b'\x00'
+    query = dns_wire.parse_query(dns_wire.build_query(9, "chunk0.example.tunnel.", dns_wire.TYPE_TXT, udp_size=1232))
+    assert (query.id, query.qname, query.qtype) == (9, "chunk0.example.tunnel.", dns_wire.TYPE_TXT)
+    assert query.flags & dns_wire.RD
+    assert dns_wire.edns_udp_size(query) == 1232
+    assert dns_wire.edns_udp_size(dns_wire.parse_query(dns_wire.build_query(9, "example.com.", dns_wire.TYPE_A))) is None
+
+
+@pytest.mark.parametrize("name", ["a..example.", "x" * 64 + ".example."])
+def test_encode_name_rejects_bad_labels(name):
+    with pytest.raises(ValueError):
+        dns_wire.encode_name(name)
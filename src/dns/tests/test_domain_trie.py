@@ -0,0 +1,77 @@
+import pytest
+
+from domain_trie import DomainTrie, RecordIndex, compact_records, normalize
+
+
+RECORDS = {
+    "ads.example.com.": "0.0.0.0",
+    "Tracker.Example.NET": "::",
+    "*.reporo.net.": "0.0.0.0",
+    "*.cdn.example.org.": "127.0.0.1",
+    "*.example.org.": "0.0.0.0",
+    "exact.example.org.": "10.0.0.1",
+}
+
+
+def test_normalize():
+    assert normalize("Ads.Example.COM") == "ads.example.com."
+    assert normalize("ads.example.com.") == "ads.example.com."
+
+
+def test_trie_returns_the_longest_suffix():
+    trie = DomainTrie()
+    trie.add("example.org.", "a")
+    trie.add("cdn.example.org.", "b")
+    trie.add("cdn.example.org.", "c")  # replaces the value
+    assert len(trie) == 2
+    assert trie.lookup("example.org.") == "a"
+    assert trie.lookup("www.example.org.") == "a"
+    assert trie.lookup("img.cdn.example.org.") == "c"
+    assert trie.lookup("org.") is None
+    assert trie.lookup("notexample.org.") is None
+
+
+@pytest.mark.parametrize("domain, rdata", [
+    ("ads.example.com.", "0.0.0.0"),
+    ("tracker.example.net.", "::"),
+    ("www.ads.example.com.", None),  # exact names do not cover subdomains
+    ("reporo.net.", "0.0.0.0"),  # a suffix rule covers the name itself
+    ("x.y.reporo.net.", "0.0.0.0"),
+    ("notreporo.net.", None),
+    ("img.cdn.example.org.", "127.0.0.1"),
+    ("exact.example.org.", "10.0.0.1"),  # exact names before suffix rules
+    ("www.example.org.", "0.0.0.0"),
+    (".", None),
+])
+def test_record_index_lookup(domain, rdata):
+    assert RecordIndex(RECORDS).lookup(domain) == rdata
+
+
+def test_reload_reuses_unchanged_suffix_trie():
+    previous = RecordIndex(RECORDS)
+    same_rules = RecordIndex({**RECORDS, "new.example.com.": "0.0.0.0"}, previous)
+    assert same_rules.suffixes is previous.suffixes
+    assert same_rules.diff(previous) == (1, 0)
+
+    changed = RecordIndex({name: rdata for name, rdata in RECORDS.items() if name != "*.reporo.net."}, previous)
+    assert changed.suffixes is not previous.suffixes
+    assert changed.lookup("x.reporo.net.") is None
+    assert changed.diff(previous) == (0, 1)
+
+
+def test_compact_records():
+    records = {f"host{index}.ads.example.": "0.0.0.0" for index in range(20)}
+    records["other.example."] = "0.0.0.0"
+    records.update({f"host{index}.mixed.example.": "0.0.0.0" for index in range(19)})
+    records["special.mixed.example."] = "10.0.0.1"
+    records.update({f"host{index}.googleapis.com.": "0.0.0.0" for index in range(20)})
+    compacted = compact_records(records, min_subdomains=20)
+
+    assert compacted["*.ads.example."] == "0.0.0.0"
+    assert "host0.ads.example." not in compacted
+    assert "*.mixed.example." not in compacted  # the children do not share one rdata
+    assert "*.googleapis.com." not in compacted  # never folded
+    assert len(compacted) == len(records) - 20 + 1
+    index = RecordIndex(compacted)
+    for name, rdata in records.items():
+        assert index.lookup(name) == rdata
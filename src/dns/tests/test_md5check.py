@@ -0,0 +1,97 @@
+import os
+import random
+
+import pytest
+
+import md5check
+from chunk_writer import RAW_CHUNK_SIZE, ChunkWriter
+
+
+def random_bytes(generator, size):
+    return generator.getrandbits(8 * size).to_bytes(size, 'little')
+
+
+DATA = random_bytes(random.Random(0), RAW_CHUNK_SIZE * 37 + 20)  # 38 chunks, the last one 20 bytes
+
+
+def write(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def damaged(data, chunk_indexes):
+    data = bytearray(data)
+    for index in chunk_indexes:
+        data[index * RAW_CHUNK_SIZE + 7] ^= 0xFF
+    return bytes(data)
+
+
+def test_chunk_hashes(tmp_path):
+    leaves = md5check.chunk_hashes(write(tmp_path, "a", DATA))
+    assert len(leaves) == 38
+    assert len(set(leaves)) == 38
+    assert md5check.chunk_hashes(write(tmp_path, "empty", b'')) == []
+
+
+@pytest.mark.parametrize("leaf_count", [1, 2, 3, 5, 8, 13])
+def test_merkle_tree_shape(leaf_count):
+    leaves = [bytes([index]) * 16 for index in range(leaf_count)]
+    levels = md5check.merkle_tree(leaves)
+    assert levels[0] == leaves
+    assert len(levels[-1]) == 1
+    for level, parents in zip(levels, levels[1:]):
+        assert len(parents) == (len(level) + 1) // 2
+        if len(level) % 2:
+            assert parents[-1] == level[-1]  # the odd node is carried up unchanged
+
+
+@pytest.mark.parametrize("leaf_count", [1, 2, 7, 16, 33])
+def test_differing_chunks_matches_a_leaf_by_leaf_comparison(leaf_count):
+    generator = random.Random(leaf_count)
+    leaves1 = [random_bytes(generator, 16) for _ in range(leaf_count)]
+    for _ in range(20):
+        leaves2 = [random_bytes(generator, 16) if generator.random() < 0.2 else leaf for leaf in leaves1]
+        expected = [index for index, (first, second) in enumerate(zip(leaves1, leaves2)) if first != second]
+        assert md5check.differing_chunks(md5check.merkle_tree(leaves1), md5check.merkle_tree(leaves2)) == expected
+
+
+@pytest.mark.parametrize("chunk_indexes, expected", [
+    ([], []),
+    ([0], [[0, 0]]),
+    ([37], [[37, 37]]),
+    ([3, 4, 5, 20], [[3, 5], [20, 20]]),
+])
+def test_diff_chunks(tmp_path, chunk_indexes, expected):
+    original = write(tmp_path, "original", DATA)
+    received = write(tmp_path, "received", damaged(DATA, chunk_indexes))
+    assert md5check.diff_chunks(original, received) == expected
+
+
+def test_diff_chunks_of_files_with_different_lengths(tmp_path):
+    original = write(tmp_path, "original", DATA)
+    assert md5check.diff_chunks(original, write(tmp_path, "short", DATA[:RAW_CHUNK_SIZE * 30])) == [[30, 37]]
+    # the short last chunk of the original differs too
+    assert md5check.diff_chunks(original, write(tmp_path, "long", DATA + b'x' * 400)) == [[37, 39]]
+    assert md5check.diff_chunks(original, write(tmp_path, "empty", b'')) == [[0, 37]]
+    assert md5check.diff_chunks(write(tmp_path, "empty2", b''), write(tmp_path, "empty3", b'')) == []
+
+
+def test_format_ranges():
+    assert md5check.format_ranges([[0, 2], [5, 5]]) == "0-2, 5"
+    assert md5check.format_ranges([]) == ""
+
+
+def test_prepare_refetch_keeps_only_the_good_chunks(tmp_path):
+    original = write(tmp_path, "original", DATA)
+    received = write(tmp_path, "received", damaged(DATA, [2, 10]) + b'trailing garbage')
+    ranges = md5check.diff_chunks(original, received)
+    assert ranges == [[2, 2], [10, 10], [37, 37]]  # the garbage extends the short last chunk
+
+    assert md5check.prepare_refetch(original, received, ranges) == 3
+    assert not os.path.exists(received)
+    writer = ChunkWriter(received, total_chunks=38)
+    assert writer.open() == 35
+    assert not writer.has(2) and not writer.has(10) and not writer.has(37) and writer.has(11)
+    assert os.path.getsize(writer.part_path) == len(DATA)
+    writer.file.close()
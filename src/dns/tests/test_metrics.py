@@ -0,0 +1,134 @@
+import random
+
+import pytest
+
+import dns_wire
+import metrics
+from conftest import make_response
+
+
+def test_durations_below_two_to_the_precision_are_exact():
+    histogram = metrics.LatencyHistogram(precision=3)
+    for value in range(2 * histogram.sub_buckets):
+        assert histogram.index(value) == value
+        assert histogram.upper_bound(value) == value + 1
+
+
+@pytest.mark.parametrize("precision", [1, 3, 5])
+def test_buckets_cover_every_duration_once(precision):
+    histogram = metrics.LatencyHistogram(precision=precision)
+    previous = 0
+    for value in range(200000):
+        index = histogram.index(value)
+        assert index in (previous, previous + 1)
+        assert value < histogram.upper_bound(index)
+        if index:
+            assert histogram.upper_bound(index - 1) <= value
+        previous = index
+
+
+@pytest.mark.parametrize("exponent", range(4, 26))
+def test_power_of_two_boundaries(exponent):
+    histogram = metrics.LatencyHistogram(precision=3)
+    value = 1 << exponent
+    # every power of two starts a bucket, split into 2**precision buckets of width 2**(exponent - precision)
+    assert histogram.upper_bound(histogram.index(value) - 1) == value
+    assert histogram.index(value - 1) == histogram.index(value) - 1
+    assert histogram.upper_bound(histogram.index(value)) == value + (value >> 3)
+    assert histogram.index(2 * value) - histogram.index(value) == 8
+
+
+def test_relative_error_is_below_one_over_two_to_the_precision():
+    histogram = metrics.LatencyHistogram(precision=3)
+    for value in random.Random(0).sample(range(16, 60000000), 5000):
+        upper_bound = histogram.upper_bound(histogram.index(value))
+        assert (upper_bound - value) / value < 1 / 8
+
+
+def test_long_durations_are_clamped_to_the_last_bucket():
+    histogram = metrics.LatencyHistogram(max_seconds=60)
+    assert histogram.upper_bound(histogram.last_index) >= 60000000
+    histogram.record(3600)
+    histogram.record(60)
+    assert histogram.counts[histogram.last_index] == 2
+    assert len(histogram.counts) == histogram.last_index + 1
+    assert histogram.percentile(1.0) == histogram.upper_bound(histogram.last_index) / 1000000
+    assert histogram.sum == 3660
+
+
+def test_record_matches_index():
+    histogram = metrics.LatencyHistogram()
+    for value in (0, 7, 8, 15, 16, 17, 1000, 123456, 59999999):
+        histogram.record(value / 1000000)
+        assert histogram.counts[histogram.index(value)] >= 1
+    assert histogram.count == 9
+
+
+def test_percentile():
+    histogram = metrics.LatencyHistogram()
+    assert histogram.percentile(0.99) == 0.0
+    for _ in range(99):
+        histogram.record(0.000005)
+    histogram.record(0.5)
+    assert histogram.percentile(0.5) == 0.000006
+    assert histogram.percentile(0.99) == 0.000006
+    p100 = histogram.percentile(1.0)
+    assert 0.5 < p100 <= 0.5 * 1.125
+
+
+def test_cumulative_counts_against_export_bounds():
+    histogram = metrics.LatencyHistogram()
+    for seconds in (0.00004, 0.0003, 2.0, 100):
+        histogram.record(seconds)
+    counts = dict(histogram.cumulative_counts(metrics.EXPORT_BOUNDS))
+    assert list(counts) == list(metrics.EXPORT_BOUNDS)
+    assert counts[0.00005] == 1  # 40 us is in the bucket [40, 44)
+    assert counts[0.00025] == 1  # 300 us is in [288, 320), it straddles no bound but is above 250 us
+    assert counts[0.0005] == 2
+    assert counts[1] == 2
+    assert counts[2.5] == 3  # 2 s is in a bucket that ends at 2.097152 s
+    assert counts[10] == 3  # 100 s was clamped to the last bucket, it only shows in +Inf
+
+
+def test_cumulative_counts_never_count_a_duration_above_its_bound():
+    histogram = metrics.LatencyHistogram()
+    durations = [random.Random(1).lognormvariate(-7, 2.5) for _ in range(2000)]
+    for seconds in durations:
+        histogram.record(seconds)
+    previous = 0
+    for bound, count in histogram.cumulative_counts(metrics.EXPORT_BOUNDS):
+        assert count >= previous
+        assert count <= sum(1 for seconds in durations if seconds < bound)
+        # a bucket straddling the bound moves to the next bound, so at most 1 / 2**precision is lost
+        assert count >= sum(1 for seconds in durations if seconds < bound / 1.125)
+        previous = count
+
+
+def test_histogram_lines():
+    histogram = metrics.LatencyHistogram()
+    histogram.record(0.002)
+    lines = metrics.histogram_lines("dns_query_duration_seconds", "help", [({"transport": "udp"}, histogram)])
+    assert lines[:2] == ["# HELP dns_query_duration_seconds help", "# TYPE dns_query_duration_seconds histogram"]
+    buckets = [line for line in lines if line.startswith("dns_query_duration_seconds_bucket")]
+    assert len(buckets) == len(metrics.EXPORT_BOUNDS) + 1
+    assert buckets[0] == 'dns_query_duration_seconds_bucket{transport="udp",le="5e-05"} 0'
+    assert 'dns_query_duration_seconds_bucket{transport="udp",le="0.0025"} 1' in buckets
+    assert buckets[-1] == 'dns_query_duration_seconds_bucket{transport="udp",le="+Inf"} 1'
+    assert 'dns_query_duration_seconds_sum{transport="udp"} 0.002000' in lines
+    assert 'dns_query_duration_seconds_count{transport="udp"} 1' in lines
+
+
+def test_observe_counts_nxdomain_answers_and_rcodes():
+    resolver_metrics = metrics.ResolverMetrics()
+    started = metrics.time.perf_counter()
+    resolver_metrics.observe('udp', metrics.FORWARDED, started, make_response("missing.example.",
+                                                                             rcode=dns_wire.NXDOMAIN))
+    resolver_metrics.observe('udp', metrics.LIMITED, started, make_response("missing.example.",
+                                                                           rcode=dns_wire.NXDOMAIN))
+    resolver_metrics.observe('tcp', metrics.ERROR, started)
+    assert set(resolver_metrics.latency) == {('udp', metrics.NXDOMAIN), ('udp', metrics.LIMITED),
+                                             ('tcp', metrics.ERROR)}
+    assert resolver_metrics.rcodes[dns_wire.NXDOMAIN] == 2
+    text = '\n'.join(resolver_metrics.render())
+    assert 'dns_queries_total{transport="udp",outcome="nxdomain"} 1' in text
+    assert 'dns_responses_total{rcode="NXDOMAIN"} 2' in text
@@ -0,0 +1,121 @@
+from rate_limit import ALLOW, DROP, SLIP, RateLimiter, TokenBucketTable, subnet_of
+from dns_wire import NOERROR, parse_query
+from conftest import make_query
+
+
+def test_subnet_of():
+    assert subnet_of("192.0.2.77") == "192.0.2.0/24"
+    assert subnet_of("2001:db8:1:2:3:4:5:6") == "2001:db8:1:2::/64"
+    assert subnet_of("2001:db8::1") == subnet_of("2001:db8::2") == subnet_of("2001:db8:0:0:ffff::1")
+    assert subnet_of("2001:db8::1") != subnet_of("2001:db8:0:1::1")
+    assert subnet_of("fe80::1%eth0") == "fe80::/64"
+
+
+def test_burst_then_refill():
+    table = TokenBucketTable(rate=10, burst=5)
+    assert all(table.allow("a", 0.0) for _ in range(5))
+    assert not table.allow("a", 0.0)
+    assert not table.allow("a", 0.05)  # half a token
+    assert table.allow("a", 0.1)
+    assert not table.allow("a", 0.1)
+    assert table.allow("b", 0.1)  # buckets are independent
+
+
+def test_refill_is_capped_at_the_burst():
+    table = TokenBucketTable(rate=10, burst=3)
+    table.allow("a", 0.0)
+    assert sum(table.allow("a", 100.0) for _ in range(10)) == 3
+
+
+def test_full_table_evicts_the_least_recently_used_bucket():
+    table = TokenBucketTable(rate=1, burst=2, max_entries=3)
+    for key in ("a", "b", "c"):
+        table.allow(key, 0.0)
+    table.allow("a", 0.0)  # a is now the most recently used, b the least
+    table.allow("d", 0.0)
+    assert len(table) == 3
+    assert list(table.buckets) == ["c", "a", "d"]
+    assert not table.allow("a", 0.0)  # a kept its (empty) bucket
+
+
+def test_sweep_removes_refilled_buckets_from_the_front():
+    table = TokenBucketTable(rate=1, burst=2, sweep_batch=2)
+    for index, key in enumerate(("a", "b", "c", "d")):
+        table.allow(key, float(index))
+    table.sweep(3.5)  # refill time is 2 seconds: a and b are full again
+    assert list(table.buckets) == ["c", "d"]
+    table.sweep(3.5)  # c is not full, the sweep stops there
+    assert list(table.buckets) == ["c", "d"]
+
+
+def test_sweep_is_bounded():
+    table = TokenBucketTable(rate=1, burst=2, sweep_batch=2)
+    for key in range(10):
+        table.allow(key, 0.0)
+    table.allow("new", 100.0)  # every bucket is full by now, only sweep_batch are removed per call
+    assert len(table) == 9
+
+
+def test_slip_and_drop():
+    limiter = RateLimiter(client_rate=1, client_burst=1, slip=2)
+    assert limiter.check_query("192.0.2.1", 0.0) == ALLOW
+    assert [limiter.check_query("192.0.2.1", 0.0) for _ in range(4)] == [DROP, SLIP, DROP, SLIP]
+    assert (limiter.limited, limiter.slipped, limiter.dropped) == (4, 2, 2)
+
+
+def test_slip_disabled():
+    limiter = RateLimiter(client_rate=1, client_burst=1, slip=0)
+    limiter.check_query("192.0.2.1", 0.0)
+    assert {limiter.check_query("192.0.2.1", 0.0) for _ in range(4)} == {DROP}
+
+
+def test_subnet_bucket_is_shared():
+    limiter = RateLimiter(client_rate=100, client_burst=100, subnet_rate=1, subnet_burst=2)
+    assert limiter.check_query("192.0.2.1", 0.0) == ALLOW
+    assert limiter.check_query("192.0.2.2", 0.0) == ALLOW
+    assert limiter.check_query("192.0.2.3", 0.0) != ALLOW
+    assert limiter.check_query("198.51.100.1", 0.0) == ALLOW
+
+
+def test_compressed_ipv6_clients_share_their_subnet_bucket():
+    limiter = RateLimiter(client_rate=100, client_burst=100, subnet_rate=1, subnet_burst=2)
+    assert limiter.check_query("2001:db8::1", 0.0) == ALLOW
+    assert limiter.check_query("2001:db8::2", 0.0) == ALLOW
+    assert limiter.check_query("2001:db8:0:0:1::3", 0.0) != ALLOW
+    assert limiter.check_query("2001:db8:0:1::1", 0.0) == ALLOW
+
+
+def test_identical_responses_are_limited():
+    limiter = RateLimiter(response_rate=1, response_burst=2, slip=0)
+    query = parse_query(make_query("Victim.example."))
+    other = parse_query(make_query("victim.example."))
+    assert limiter.check_response("192.0.2.1", query, NOERROR, 0.0) == ALLOW
+    assert limiter.check_response("192.0.2.9", other, NOERROR, 0.0) == ALLOW  # same /24, name and rcode
+    assert limiter.check_response("192.0.2.1", query, NOERROR, 0.0) == DROP
+    assert limiter.check_response("198.51.100.1", query, NOERROR, 0.0) == ALLOW
+
+
+def test_check_client():
+    limiter = RateLimiter(client_rate=1, client_burst=2, subnet_rate=1, subnet_burst=1)
+    assert limiter.check_client("192.0.2.1", 0.0)
+    assert limiter.check_client("192.0.2.1", 0.0)  # the subnet bucket does not apply over tcp
+    assert not limiter.check_client("192.0.2.1", 0.0)
+    assert limiter.refused == 1
+    assert limiter.limited == 0
+
+
+def test_take_grants_what_is_left():
+    table = TokenBucketTable(rate=10, burst=8)
+    assert table.take("a", 0.0, 5) == 5
+    assert table.take("a", 0.0, 5) == 3
+    assert table.take("a", 0.0, 5) == 0
+    assert table.take("a", 0.25, 5) == 2  # 2.5 tokens refilled
+    assert table.take("a", 0.35, 5) == 1  # the half token was kept, 1.5 now
+
+
+def test_check_tunnel():
+    limiter = RateLimiter(tunnel_rate=1, tunnel_burst=6)
+    assert limiter.check_tunnel("192.0.2.1", 5, 0.0) == 5
+    assert limiter.check_tunnel("192.0.2.1", 5, 0.0) == 1
+    assert limiter.check_tunnel("192.0.2.2", 5, 0.0) == 5  # per client ip, not per subnet
+    assert limiter.chunks_cut == 4
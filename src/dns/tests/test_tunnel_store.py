@@ -0,0 +1,110 @@
+import base64
+import lzma
+import os
+import zlib
+
+import pytest
+
+from tunnel_store import CHUNK_SIZE, RAW_CHUNK_SIZE, TunnelFileStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return TunnelFileStore(directory=str(tmp_path), check_interval=0)
+
+
+def write_file(tmp_path, name, data):
+    # replaced with a rename, like the store expects
+    (tmp_path / f"{name}.tmp").write_bytes(data)
+    os.replace(tmp_path / f"{name}.tmp", tmp_path / f"{name}.txt")
+
+
+@pytest.mark.parametrize("size", [0, 1, RAW_CHUNK_SIZE - 1, RAW_CHUNK_SIZE, RAW_CHUNK_SIZE + 1, 5120])
+def test_chunks_are_slices_of_the_whole_file_base64(tmp_path, store, size):
+    data = os.urandom(size)
+    write_file(tmp_path, "example", data)
+    tunnel_file = store.get("example")
+    assert tunnel_file.chunk_count == (size + RAW_CHUNK_SIZE - 1) // RAW_CHUNK_SIZE
+
+    encoded = base64.b64encode(data)
+    chunks = [tunnel_file.chunk(index) for index in range(tunnel_file.chunk_count)]
+    assert b''.join(chunks) == encoded
+    assert all(len(chunk) == CHUNK_SIZE for chunk in chunks[:-1])
+    for index, chunk in enumerate(chunks):
+        assert chunk == encoded[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE]
+
+
+def test_chunks_past_the_end_are_empty(tmp_path, store):
+    write_file(tmp_path, "example", b'x' * 1000)
+    tunnel_file = store.get("example")
+    assert tunnel_file.chunk(tunnel_file.chunk_count) == b''
+    assert tunnel_file.chunk(10 ** 6) == b''
+    assert tunnel_file.chunk(-1) == b''
+
+
+@pytest.mark.parametrize("file_name", ["../secret", "a/b", "a.b", "", "name with spaces", "example\n"])
+def test_only_single_label_names_are_served(tmp_path, store, file_name):
+    (tmp_path / "secret.txt").write_bytes(b'secret')
+    assert store.get(file_name) is None
+
+
+def test_missing_file_and_unknown_codec(tmp_path, store):
+    assert store.get("missing") is None
+    write_file(tmp_path, "example", b'data')
+    assert store.get("example", codec="brotli") is None
+
+
+def test_file_is_cached_until_it_changes(tmp_path):
+    store = TunnelFileStore(directory=str(tmp_path), check_interval=60)
+    write_file(tmp_path, "example", b'old contents')
+    first = store.get("example")
+    write_file(tmp_path, "example", b'new')
+    assert store.get("example") is first  # not checked again within check_interval
+
+    store.check_interval = 0
+    changed = store.get("example")
+    assert changed is not first
+    assert bytes(changed.data) == b'new'
+    assert store.size == 3
+    assert store.get("example") is changed
+
+
+def test_deleted_file_is_forgotten(tmp_path, store):
+    write_file(tmp_path, "example", b'data')
+    store.get("example")
+    os.remove(tmp_path / "example.txt")
+    assert store.get("example") is None
+    assert store.size == 0 and not store.files
+
+
+@pytest.mark.parametrize("codec, decompress", [("zlib", zlib.decompress), ("lzma", lzma.decompress)])
+def test_compressed_files(tmp_path, store, codec, decompress):
+    data = b'the same line again\n' * 500
+    write_file(tmp_path, "example", data)
+    compressed = store.get("example", codec=codec)
+    assert compressed is store.get("example", codec=codec)  # compressed once
+    assert compressed.chunk_count < store.get("example").chunk_count
+    encoded = b''.join(compressed.chunk(index) for index in range(compressed.chunk_count))
+    assert decompress(base64.b64decode(encoded)) == data
+    assert store.size == len(data) + len(compressed.data)
+
+    write_file(tmp_path, "example", b'changed')
+    assert store.get("example", codec=codec) is not compressed
+    assert store.size == len(b'changed') + len(store.get("example", codec=codec).data)
+
+
+def test_least_recently_used_files_are_evicted(tmp_path):
+    store = TunnelFileStore(directory=str(tmp_path), max_bytes=2500, check_interval=0)
+    for name in ("a", "b", "c"):
+        write_file(tmp_path, name, b'x' * 1000)
+    store.get("a")
+    store.get("b")
+    store.get("a")  # b is now the least recently used
+    store.get("c")
+    assert list(store.files) == ["a", "c"]
+    assert store.size == 2000
+
+    # a file bigger than the whole budget is still served, alone
+    write_file(tmp_path, "big", b'x' * 5000)
+    assert store.get("big").chunk_count == 34
+    assert list(store.files) == ["big"]
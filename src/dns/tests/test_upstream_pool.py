@@ -0,0 +1,241 @@
+import asyncio
+import socket
+import time
+
+import pytest
+
+import dns_wire
+from conftest import make_query
+from upstream_pool import TimerWheel, UpstreamPool, UpstreamServer
+
+
+'''
+upstream server on localhost that answers every query with 1.2.3.4 after delay seconds, or not at all when
+drop is set. before the answer it sends the packets returned by spoof(data), if any
+'''
+class FakeUpstream(asyncio.DatagramProtocol):
+    def __init__(self, delay=0, drop=False, spoof=None):
+        self.delay = delay
+        self.drop = drop
+        self.spoof = spoof
+        self.transport = None
+        self.received = []  # (transaction id, client address)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, client_address):
+        query = dns_wire.parse_query(data)
+        self.received.append((query.id, client_address))
+        for packet in self.spoof(data) if self.spoof else []:
+            self.transport.sendto(packet, client_address)
+        if not self.drop:
+            response = dns_wire.build_response(query, answers=dns_wire.address_record("1.2.3.4", 60), ancount=1)
+            asyncio.get_running_loop().call_later(self.delay, self.transport.sendto, response, client_address)
+
+
+async def start_upstream(**kwargs):
+    transport, protocol = await asyncio.get_running_loop().create_datagram_endpoint(
+        lambda: FakeUpstream(**kwargs), local_addr=('127.0.0.1', 0))
+    return protocol, transport.get_extra_info('sockname')
+
+
+'''
+runs forward(pool, upstreams) with a pool over fake upstreams built from upstream_kwargs
+'''
+def run_pool(upstream_kwargs, forward, **pool_kwargs):
+    async def main():
+        upstreams = [await start_upstream(**kwargs) for kwargs in upstream_kwargs]
+        pool = UpstreamPool([address for _, address in upstreams], **{'timeout': 0.5, 'tick': 0.05, **pool_kwargs})
+        pool.open()
+        try:
+            return await forward(pool, [protocol for protocol, _ in upstreams])
+        finally:
+            pool.close()
+            for protocol, _ in upstreams:
+                protocol.transport.close()
+    return asyncio.run(main())
+
+
+def test_timer_wheel_expires_after_the_timeout():
+    wheel = TimerWheel(tick=0.1, slot_count=8)
+    wheel.schedule('a', 0.25)  # 3 ticks
+    wheel.schedule('b', 0)  # never less than one tick
+    assert wheel.advance() == {'b'}
+    assert wheel.advance() == set()
+    assert wheel.advance() == {'a'}
+    assert all(not slot for slot in wheel.slots)
+
+
+def test_timer_wheel_cancel_and_cap():
+    wheel = TimerWheel(tick=0.1, slot_count=8)
+    slot = wheel.schedule('a', 0.1)
+    wheel.cancel('a', slot)
+    wheel.cancel('a', slot)  # cancelling twice is harmless
+    wheel.schedule('b', 60)  # capped at one turn of the wheel
+    expired = [wheel.advance() for _ in range(8)]
+    assert expired[:6] == [set()] * 6
+    assert expired[6] == {'b'}
+
+
+def test_answer_is_matched_and_gets_the_client_id_back():
+    async def forward(pool, upstreams):
+        query = dns_wire.parse_query(make_query("example.com.", query_id=4321))
+        return await pool.query(query), pool
+
+    response, pool = run_pool([{}], forward)
+    assert response[:2] == (4321).to_bytes(2, 'big')
+    assert dns_wire.parse_query(response).qname == "example.com."
+    assert response.endswith(bytes([1, 2, 3, 4]))
+    assert pool.pending == {}
+    assert pool.upstreams[0].srtt is not None
+
+
+def test_forwards_use_random_ids_and_sockets():
+    async def forward(pool, upstreams):
+        await asyncio.gather(*(pool.query(dns_wire.parse_query(make_query(f"host{i}.example.", query_id=1)))
+                               for i in range(40)))
+        return upstreams[0].received
+
+    received = run_pool([{}], forward, size=4)
+    assert len({transaction_id for transaction_id, _ in received}) > 30
+    assert len({address for _, address in received}) > 1
+
+
+@pytest.mark.parametrize("spoof", [
+    lambda data: [data[:2] + b'\x81\x80' + data[4:12] + make_query("evil.example.")[12:]],  # other question
+    lambda data: [data[:5]],  # shorter than a header
+    lambda data: [(int.from_bytes(data[:2], 'big') ^ 1).to_bytes(2, 'big') + data[2:]],  # other id
+])
+def test_mismatched_answers_are_ignored(spoof):
+    async def forward(pool, upstreams):
+        return await pool.query(dns_wire.parse_query(make_query("example.com.")))
+
+    response = run_pool([{'delay': 0.05, 'spoof': spoof}], forward)
+    assert dns_wire.parse_query(response).qname == "example.com."
+    assert response.endswith(bytes([1, 2, 3, 4]))
+
+
+def test_answer_from_another_address_is_ignored():
+    async def forward(pool, upstreams):
+        task = asyncio.ensure_future(pool.query(dns_wire.parse_query(make_query("example.com."))))
+        await asyncio.sleep(0.02)
+        transaction_id, client_address = upstreams[0].received[0]
+        # right id and question, but not from the server that was asked
+        query = dns_wire.parse_query(make_query("example.com.", query_id=transaction_id))
+        forged = dns_wire.build_response(query, answers=dns_wire.address_record("6.6.6.6", 60), ancount=1)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(forged, client_address)
+        return await task
+
+    response = run_pool([{'delay': 0.1}], forward)
+    assert response.endswith(bytes([1, 2, 3, 4]))
+
+
+def test_unanswered_forward_times_out():
+    async def forward(pool, upstreams):
+        started = time.monotonic()
+        response = await pool.query(dns_wire.parse_query(make_query("example.com.")))
+        return response, time.monotonic() - started, pool
+
+    response, elapsed, pool = run_pool([{'drop': True}], forward, timeout=0.2)
+    assert response is None
+    assert 0.15 < elapsed < 1
+    assert pool.pending == {}
+    assert pool.upstreams[0].timeouts == 1
+    assert all(not slot for slot in pool.wheel.slots)
+
+
+def test_slow_server_is_hedged_with_the_next_one():
+    async def forward(pool, upstreams):
+        slow, fast = pool.upstreams
+        slow.srtt, slow.rttvar = 0.01, 0.005  # usually fast, so it is asked first and hedged after 30 ms
+        fast.srtt, fast.rttvar = 0.02, 0.005
+        started = time.monotonic()
+        response = await pool.query(dns_wire.parse_query(make_query("example.com.")))
+        return response, time.monotonic() - started, pool, upstreams
+
+    response, elapsed, pool, upstreams = run_pool([{'delay': 0.4}, {}], forward, timeout=2, explore=0)
+    assert response.endswith(bytes([1, 2, 3, 4]))
+    assert elapsed < 0.3
+    assert len(upstreams[0].received) == len(upstreams[1].received) == 1
+    # the slow server lost the race after at least the hedge delay, its estimate grew
+    assert pool.upstreams[0].srtt > 0.01
+    assert pool.pending == {}
+
+
+def test_without_hedging_the_next_server_waits_for_the_timeout():
+    async def forward(pool, upstreams):
+        started = time.monotonic()
+        response = await pool.query(dns_wire.parse_query(make_query("example.com.")))
+        return response, time.monotonic() - started, upstreams
+
+    response, elapsed, upstreams = run_pool([{'drop': True}, {}], forward, timeout=0.2, hedge=False)
+    assert response.endswith(bytes([1, 2, 3, 4]))
+    assert 0.15 < elapsed < 1
+    assert len(upstreams[1].received) == 1
+
+
+def test_failed_send_fails_over_right_away():
+    async def forward(pool, upstreams):
+        # a broadcast address without SO_BROADCAST, sendto fails at once
+        pool.upstreams.insert(0, UpstreamServer(('255.255.255.255', 53)))
+        started = time.monotonic()
+        response = await pool.query(dns_wire.parse_query(make_query("example.com.")))
+        return response, time.monotonic() - started, pool
+
+    response, elapsed, pool = run_pool([{}], forward, timeout=2)
+    assert response.endswith(bytes([1, 2, 3, 4]))
+    assert elapsed < 0.25  # well under the hedge delay of an unmeasured server (timeout / 4)
+    assert pool.upstreams[0].failures == 1
+
+
+def test_every_server_silent_returns_none():
+    async def forward(pool, upstreams):
+        return await pool.query(dns_wire.parse_query(make_query("example.com."))), pool
+
+    response, pool = run_pool([{'drop': True}, {'drop': True}], forward, timeout=0.2)
+    assert response is None
+    assert [upstream.timeouts for upstream in pool.upstreams] == [1, 1]
+    assert pool.pending == {}
+
+
+def test_server_that_keeps_timing_out_is_skipped_with_backoff():
+    pool = UpstreamPool([('127.0.0.1', 1), ('127.0.0.1', 2)], explore=0)
+    down, up = pool.upstreams
+    now = time.monotonic()
+    for _ in range(3):
+        down.record_timeout(now)
+    assert not down.healthy(now)
+    assert down.down_until == pytest.approx(now + 1)
+    assert pool.ranked() == [up]
+
+    down.record_timeout(now)
+    assert down.down_until == pytest.approx(now + 2)
+    for _ in range(10):
+        down.record_timeout(now)
+    assert down.down_until == pytest.approx(now + down.max_down_time)
+
+    # with every server down, the one that comes back first is tried anyway
+    for _ in range(3):
+        up.record_timeout(now)
+    assert pool.ranked() == [up]
+
+    down.record_answer(0.05)
+    assert down.healthy(now) and down.failures == 0
+    assert pool.ranked() == [down]
+
+
+def test_ranking_and_hedge_delay():
+    pool = UpstreamPool([('127.0.0.1', 1), ('127.0.0.1', 2), ('127.0.0.1', 3)], timeout=3, explore=0)
+    slow, fast, new = pool.upstreams
+    slow.record_rtt(0.2)
+    fast.record_rtt(0.05)
+    assert pool.ranked() == [new, fast, slow]  # never measured goes first
+    new.inflight = 1
+    assert pool.ranked() == [fast, slow, new]  # ... one query at a time
+
+    assert new.hedge_delay(default=0.75) == 0.75
+    assert fast.hedge_delay(default=0.75) == pytest.approx(0.05 + 4 * 0.025)
+    fast.srtt, fast.rttvar = 0.001, 0
+    assert fast.hedge_delay(default=0.75) == 0.01
@@ -0,0 +1,101 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+
+from dns_server import DNSPiHole
+from impairment_proxy import ImpairmentProxy
+from md5check import diff_chunks
+from udp_client import DNSTunnelingClient
+
+
+'''
+client strategies compared by the benchmark: name -> (window, compression). a window of 1 is stop and wait
+'''
+STRATEGIES = {
+    'stop-and-wait': (1, None),
+    'window': (16, None),
+    'window-zlib': (16, 'zlib'),
+    'window-lzma': (16, 'lzma'),
+}
+
+
+def start_tunnel_server(port):
+    server = DNSPiHole(pid_file_path=os.path.join(tempfile.gettempdir(), f"tunnel_benchmark_{port}.pid"),
+                       blocked_log_path=os.devnull)
+    threading.Thread(target=server.start, kwargs={'host': '127.0.0.1', 'port': port}, daemon=True).start()
+    time.sleep(0.5)  # give the server time to bind
+    return server
+
+
+'''
+downloads one file through the proxy into output_directory and returns the measurements
+'''
+def run_download(proxy_address, file_name, strategy, output_directory, timeout):
+    window, compression = STRATEGIES[strategy]
+    client = DNSTunnelingClient(dns_server_ip=proxy_address[0], dns_server_port=proxy_address[1], file_name=file_name,
+                                timeout=timeout, compression=compression)
+    client.output_file = os.path.join(output_directory, f"{file_name}_{strategy}.txt")
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):  # the clients print every chunk
+        if window > 1:
+            success = client.download_file_windowed(window=window)
+        else:
+            success = client.download_file()
+    elapsed = time.perf_counter() - start
+    client.socket.close()
+
+    original = f"tunnel_files/{file_name}.txt"
+    size = os.path.getsize(original)
+    intact = success and not diff_chunks(original, client.output_file)
+    for path in (client.output_file, client.output_file + ".part", client.output_file + ".part.json"):
+        if os.path.exists(path):
+            os.remove(path)
+    return {"file": file_name, "strategy": strategy, "completed": success, "intact": intact, "bytes": size,
+            "seconds": round(elapsed, 3), "goodput_kib_s": round(size / elapsed / 1024, 1) if intact else 0.0,
+            "queries": client.queries_sent, "retransmissions": client.retransmissions}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="tunnel goodput per file and client strategy over an impaired path")
+    parser.add_argument("--files", nargs="+", default=["example", "luceafarul"])
+    parser.add_argument("--strategies", nargs="+", default=list(STRATEGIES), choices=list(STRATEGIES))
+    parser.add_argument("--delay", type=float, default=0.02, help="seconds, each direction")
+    parser.add_argument("--jitter", type=float, default=0.005, help="seconds")
+    parser.add_argument("--loss", type=float, default=0.05, help="each direction")
+    parser.add_argument("--corrupt", type=float, default=0.0)
+    parser.add_argument("--reorder", type=float, default=0.25)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=2, help="upper bound of the client retransmission timeout")
+    parser.add_argument("--port", type=int, default=15360)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    start_tunnel_server(args.port)
+    results = []
+    with tempfile.TemporaryDirectory() as output_directory:
+        for file_name in args.files:
+            for strategy in args.strategies:
+                # a fresh proxy with the same seed, so every strategy meets the same impairments
+                proxy = ImpairmentProxy(('127.0.0.1', args.port), delay=args.delay, jitter=args.jitter, loss=args.loss,
+                                        corrupt=args.corrupt, reorder=args.reorder, seed=args.seed).start()
+                result = run_download(proxy.address, file_name, strategy, output_directory, args.timeout)
+                proxy.close()
+                result["impairments"] = proxy.stats
+                results.append(result)
+
+                status = "ok" if result["intact"] else ("CORRUPT" if result["completed"] else "FAILED")
+                print(f"{file_name:<16} {strategy:<14} {status:<8} {result['seconds']:7.2f}s "
+                      f"{result['goodput_kib_s']:8.1f} KiB/s {result['queries']:6} queries "
+                      f"{result['retransmissions']:5} retransmissions")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({"impairments": {"delay": args.delay, "jitter": args.jitter, "loss": args.loss,
+                                       "corrupt": args.corrupt, "reorder": args.reorder, "seed": args.seed},
+                       "results": results}, file, indent=2)
@@ -0,0 +1,118 @@
+'''
+chunk index for the dns tunnel. every tunnel file is mmapped once and kept in a size-bounded lru cache; a chunk is
+the base64 encoding of a fixed 150 byte slice, which is exactly the matching 200 character slice of the base64
+of the whole file, so serving a chunk costs O(chunk) instead of re-encoding the whole file. the mapped pages come
+from the page cache, so worker processes serving the same files share them. files are mapped again when their
+mtime, size or inode change (replace them with a rename, a file truncated in place would break the mapping).
+a client can ask for a compressed form of the file instead, it is compressed once per codec and kept next to
+the original until the file changes
+'''
+import base64
+import lzma
+import mmap
+import os
+import re
+import time
+import zlib
+from collections import OrderedDict
+
+
+CHUNK_SIZE = 200  # base64 characters per chunk - leaving space for overhead
+RAW_CHUNK_SIZE = CHUNK_SIZE // 4 * 3  # 150 bytes, a multiple of 3 so every chunk encodes on its own
+FILE_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')  # a single dns label, no path separators
+CODECS = {
+    'zlib': lambda data: zlib.compress(data, 9),
+    'lzma': lambda data: lzma.compress(data, preset=9),
+}
+
+
+class TunnelFile:
+    def __init__(self, data, signature):
+        self.data = data
+        self.signature = signature
+        self.checked_at = time.monotonic()
+        self.chunk_count = (len(data) + RAW_CHUNK_SIZE - 1) // RAW_CHUNK_SIZE
+        self.compressed = {}  # codec -> TunnelFile with the compressed data
+
+    '''
+    base64 chunk chunk_index of the file, empty past the end of the file
+    '''
+    def chunk(self, chunk_index):
+        if chunk_index < 0 or chunk_index >= self.chunk_count:
+            return b""
+        start = chunk_index * RAW_CHUNK_SIZE
+        return base64.b64encode(self.data[start:start + RAW_CHUNK_SIZE])
+
+
+class TunnelFileStore:
+    def __init__(self, directory="tunnel_files", max_bytes=64 * 1024 * 1024, check_interval=1.0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval  # seconds between stat calls for the same file
+        self.files = OrderedDict()  # file name -> TunnelFile, least recently used first
+        self.size = 0
+
+    def path_of(self, file_name):
+        return os.path.join(self.directory, f"{file_name}.txt")
+
+    '''
+    returns the TunnelFile for file_name, compressed with codec if one is given, or None if there is no such
+    tunnel file or codec
+    '''
+    def get(self, file_name, codec=None):
+        if codec is not None and codec not in CODECS:
+            return None
+        tunnel_file = self.get_original(file_name)
+        if tunnel_file is None or codec is None:
+            return tunnel_file
+
+        compressed = tunnel_file.compressed.get(codec)
+        if compressed is None:
+            compressed = TunnelFile(CODECS[codec](tunnel_file.data), tunnel_file.signature)
+            tunnel_file.compressed[codec] = compressed
+            self.size += len(compressed.data)
+            self.evict()
+        return compressed
+
+    def get_original(self, file_name):
+        if not FILE_NAME_PATTERN.match(file_name):
+            return None
+
+        tunnel_file = self.files.get(file_name)
+        now = time.monotonic()
+        if tunnel_file is not None and now - tunnel_file.checked_at < self.check_interval:
+            self.files.move_to_end(file_name)
+            return tunnel_file
+
+        try:
+            stat = os.stat(self.path_of(file_name))
+        except OSError:
+            self.forget(file_name)
+            return None
+
+        signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if tunnel_file is not None and tunnel_file.signature == signature:
+            tunnel_file.checked_at = now
+            self.files.move_to_end(file_name)
+            return tunnel_file
+
+        # new or changed file
+        self.forget(file_name)
+        with open(self.path_of(file_name), 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+            tunnel_file = TunnelFile(data, signature)
+        self.files[file_name] = tunnel_file
+        self.size += len(tunnel_file.data)
+        self.evict()
+        return tunnel_file
+
+    def evict(self):
+        while self.size > self.max_bytes and len(self.files) > 1:
+            self.forget(next(iter(self.files)))
+
+    def forget(self, file_name):
+        tunnel_file = self.files.pop(file_name, None)
+        if tunnel_file is not None:
+            self.size -= len(tunnel_file.data)
+            self.size -= sum(len(compressed.data) for compressed in tunnel_file.compressed.values())
@@ -1,135 +1,540 @@
+import argparse
+import os
 import socket
+import threading
 import time
 import base64
-import sys
-from scapy.layers.dns import DNS, DNSQR
+import random
+import select
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from scapy.layers.dns import DNS, DNSQR, DNSRROPT
+
+import dns_wire
+from chunk_writer import ChunkWriter
+
+RECORD_OVERHEAD = 13  # name pointer, type, class, ttl, rdlength and the string length byte of one TXT record
+CHUNK_SIZE = 200  # base64 characters per chunk
+
+
+class TunnelError(Exception):
+    """The server refused the download, ex: NXDOMAIN for a file it does not have"""
+
+
+class RTTEstimator:
+    """Smoothed RTT and RTT variance (RFC 6298), the retransmission timeout follows the real path RTT"""
+    def __init__(self, initial_rto=1.0, min_rto=0.05, max_rto=5.0):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.min_rto = min_rto  # lower than the 1 s of RFC 6298, tunnel queries are cheap to repeat
+        self.max_rto = max_rto
+
+    def sample(self, rtt):
+        """Only feed RTTs of queries that were sent once (Karn's algorithm)"""
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto), self.max_rto)
+
+    def timeout(self, attempt):
+        """Timeout for the attempt-th send of a query, doubled on every retransmission"""
+        return min(self.rto * 2 ** (attempt - 1), self.max_rto)
+
+
+class Resolver:
+    """A dns server that answers tunnel queries, with its own RTT estimate. Shared by the clients of a batch"""
+    def __init__(self, address, timeout=5):
+        self.address = address
+        self.rtt = RTTEstimator(initial_rto=min(1.0, timeout), max_rto=timeout)
+        self.inflight = 0
+        self.queries = 0
+        self.lock = threading.Lock()
+
+    def score(self):
+        """Expected wait for one more query: smoothed RTT scaled by the queries already waiting on it"""
+        if self.rtt.srtt is None:
+            return 0  # not measured yet, try it first
+        return self.rtt.srtt * (1 + self.inflight)
+
+    def sent(self):
+        with self.lock:
+            self.inflight += 1
+            self.queries += 1
+
+    def done(self):
+        with self.lock:
+            self.inflight -= 1
+
+
+def parse_resolver(text, default_port=53):
+    """"1.2.3.4" or "1.2.3.4:5353" -> ("1.2.3.4", port)"""
+    host, _, port = text.partition(':')
+    return host, int(port) if port else default_port
+
+
+class ChunkRequest:
+    def __init__(self, query_id, first_index, chunk_count, domain):
+        self.query_id = query_id
+        self.first_index = first_index
+        self.chunk_count = chunk_count
+        self.domain = domain
+        self.sent_at = 0
+        self.timeout = 0
+        self.attempts = 0
+        self.resolver = None
+
 
 class DNSTunnelingClient:
-    def __init__(self, dns_server_ip="64.226.94.247", file_name="example", timeout=5):
+    def __init__(self, dns_server_ip="64.226.94.247", file_name="example", timeout=5, chunks_per_query=8,
+                 edns_size=1232, dns_server_port=53, resolvers=None, compression=None):
         self.dns_server_ip = dns_server_ip
-        self.dns_server_port = 53
+        self.dns_server_port = dns_server_port
         self.file_name = file_name
-        self.timeout = timeout
+        self.timeout = timeout  # upper bound of the adaptive retransmission timeout
+        # chunk requests are spread over the resolvers by observed latency
+        self.resolvers = resolvers or [Resolver((dns_server_ip, dns_server_port), timeout)]
+        self.chunks_per_query = chunks_per_query  # chunks asked for in one query (chunkN-M)
+        self.edns_size = edns_size  # EDNS0 udp payload size, None to send plain queries
+        self.compression = compression  # 'zlib' or 'lzma' to download the compressed file, None for the raw file
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.settimeout(timeout)
+        self.output_file = f"received_files/{file_name}_received.txt"
+        self.queries_sent = 0
+        self.retransmissions = 0
+
+    def pick_resolver(self):
+        return min(self.resolvers, key=Resolver.score)
+
+    def file_domain(self):
+        """example.tunnel.broski.software., or example.zlib.tunnel.broski.software. for the compressed file"""
+        if self.compression is not None:
+            return f"{self.file_name}.{self.compression}.tunnel.broski.software."
+        return f"{self.file_name}.tunnel.broski.software."
+
+    def chunk_domain(self, chunk_index, chunk_count=1):
+        if chunk_count > 1:
+            return f"chunk{chunk_index}-{chunk_index + chunk_count - 1}.{self.file_domain()}"
+        return f"chunk{chunk_index}.{self.file_domain()}"
         
-    def create_dns_query(self, chunk_index):
-        """Creating request for chunk chunk_index"""
-        domain = f"chunk{chunk_index}.{self.file_name}.tunnel.broski.software."
+    def create_dns_query(self, chunk_index, chunk_count=1, query_id=0, domain=None):
+        """Creating request for chunks chunk_index .. chunk_index + chunk_count - 1"""
+        if domain is None:
+            domain = self.chunk_domain(chunk_index, chunk_count)
         
         # Build DNS packet
         dns_request = DNS(
+            id=query_id,
             rd=1,  # Recursion Desired
             qd=DNSQR(
                 qname=domain,
                 qtype='TXT' 
             )
         )
+
+        # Advertise how big a response we can receive, so the server can pack several chunks
+        if self.edns_size is not None:
+            dns_request.ar = DNSRROPT(rclass=self.edns_size)
         
         return bytes(dns_request)
     
-    def parse_dns_response(self, response_data):
-        """Extract DNS data"""
+    def parse_dns_response(self, response_data, chunks=True):
+        """Extract the chunks (one per TXT record, in order). None if the response is damaged, it is asked for
+        again like a lost one. Raises TunnelError if the server answered with an error.
+        chunks=False returns the TXT strings of an info answer without checking them as chunks"""
+        rcode = dns_wire.response_rcode(response_data)
+        if rcode != dns_wire.NOERROR:
+            reason = " (no such file)" if rcode == dns_wire.NXDOMAIN else ""
+            raise TunnelError(f"the server answered with rcode {rcode}{reason} for \"{self.file_name}\"")
         try:
-            dns_response = DNS(response_data)
-            
-            # Check if the response is valid
-            if dns_response.ancount > 0 and hasattr(dns_response.an, 'type') and dns_response.an.type == 16:  # TXT
-                # Extract data from TXT response
-                txt_data = dns_response.an.rdata
-                
-                # If data is a list (format normal TXT)
-                if isinstance(txt_data, list):
-                    # Combine elements
-                    result = ""
-                    for item in txt_data:
-                        if isinstance(item, bytes):
-                            result += item.decode('utf-8')
-                        else:
-                            result += str(item)
-                    return result
-                
-                # If data is string or bytes
-                elif isinstance(txt_data, bytes):
-                    return txt_data.decode('utf-8')
-                else:
-                    return str(txt_data)
-            return ""
-        
-        except Exception as e:
+            strings = [string.decode('utf-8') for string in dns_wire.parse_txt_answers(response_data)]
+        except (ValueError, IndexError, struct.error) as e:  # UnicodeDecodeError is a ValueError
             print(f"Error parsing DNS: {e}")
-            return ""
+            return None
+        if not chunks:
+            return strings
+
+        # the server only sends TXT records: full chunks, then maybe the shorter last chunk of the file and the
+        # empty end of file record. anything else was damaged on the way
+        if len(strings) != dns_wire.HEADER.unpack_from(response_data)[3]:
+            print("Error parsing DNS: answer records that are not TXT")
+            return None
+        for index, chunk in enumerate(strings):
+            last = index == len(strings) - 1
+            if (not chunk and not last) or len(chunk) > CHUNK_SIZE or \
+                    (0 < len(chunk) < CHUNK_SIZE and not last and strings[index + 1]):
+                print(f"Error parsing DNS: chunk of {len(chunk)} characters at position {index}")
+                return None
+        return strings
     
-    def download_file(self):
-        """Download using stop and wait"""
-        chunk_index = 0
-        chunks = []
-        timeout = 0
-        max_timeout = 3
+    def download_file(self, max_attempts=8):
+        """Download using stop and wait, several chunks per round trip"""
+        # Chunks are written to disk as they arrive, an interrupted download continues where it stopped
+        writer = ChunkWriter(self.output_file, codec=self.compression)
+        if writer.open():
+            print(f"Resuming download, {len(writer.received)} chunks already on disk")
+        chunk_index = writer.first_missing()
+        attempts = 0  # sends of the current query, the retry budget is per chunk
         
-        while timeout < max_timeout:
+        while attempts < max_attempts:
             try:
                 # Create and request DNS query
-                query = self.create_dns_query(chunk_index)
-                
-                self.socket.sendto(query, (self.dns_server_ip, self.dns_server_port))
-                
-                # Waiting for response
-                response, _ = self.socket.recvfrom(4096)
+                domain = self.chunk_domain(chunk_index, self.chunks_per_query)
+                query_id = random.getrandbits(16)
+                query = self.create_dns_query(chunk_index, query_id=query_id, domain=domain)
+                attempts += 1
+                if attempts > 1:
+                    self.retransmissions += 1
                 
-                # Extracting data
-                chunk_data = self.parse_dns_response(response)
-                
-                # If we get an empty chunk(end of the file)
-                if not chunk_data:
-                    print(f"Downloaded file at \"received_files/{self.file_name}_received.txt\".")
-                    break
+                resolver = self.pick_resolver()
+                sent_at = time.monotonic()
+                self.socket.sendto(query, resolver.address)
+                resolver.sent()
+                self.queries_sent += 1
                 
-                # Adding chunk to chunks list
-                chunks.append(chunk_data)
+                # Waiting for response, the timeout follows the measured RTT and backs off exponentially
+                try:
+                    response = self.receive_response(query_id, domain, resolver, sent_at + resolver.rtt.timeout(attempts))
+                finally:
+                    resolver.done()
+                if attempts == 1:
+                    resolver.rtt.sample(time.monotonic() - sent_at)
                 
-                # Next chunk
-                chunk_index += 1
-                timeout = 0  # Timeout reset
+                # Extracting data, a damaged response is asked for again like a lost one
+                received_chunks = self.parse_dns_response(response)
+                if not received_chunks:
+                    print(f"No usable chunks in the answer for chunk {chunk_index}, asking again")
+                    continue
 
-                # Printing received chunk for debugging
-                decoded_chunk = base64.b64decode(chunk_data)
-                print(f"Received chunk {chunk_index}: {decoded_chunk[:25]}...")
+                first_chunk = chunk_index
+                for chunk_data in received_chunks:
+                    if not chunk_data:
+                        break
+
+                    # Writing the chunk at its offset
+                    try:
+                        writer.write(chunk_index, chunk_data)
+                    except ValueError:
+                        break  # damaged chunk, asked for again with the rest of the range
+
+                    # Next chunk
+                    chunk_index += 1
+
+                    # Printing received chunk for debugging
+                    decoded_chunk = base64.b64decode(chunk_data)
+                    print(f"Received chunk {chunk_index}: {decoded_chunk[:25]}...")
+
+                # Only an empty TXT record ends the file, the server appends one when the range went past the end.
+                # Every chunk before it has to be on disk
+                if '' in received_chunks and chunk_index - first_chunk == received_chunks.index(''):
+                    return self.finish_download(writer)
+                if chunk_index > first_chunk:
+                    attempts = 0  # Retry budget reset for the next chunk
                 
             except socket.timeout:
-                timeout += 1
-                print(f"Timeout {timeout}")
+                print(f"Timeout {attempts} for chunk {chunk_index} (rto {resolver.rtt.rto:.3f}s)")
+
+            except TunnelError as e:
+                print(f"Error: {e}")
+                writer.close()
+                return False
             
             except Exception as e:
                 print(f"Error: {e}")
-                timeout += 1
-                if timeout >= max_timeout:
-                    break
         
-        if chunks:
-            # Decode and append data
-            complete_data = ''.join(chunks)
+        writer.close()
+        print(f"Download interrupted after {len(writer.received)} chunks, run again to resume.")
+        return False
+
+    def finish_download(self, writer):
+        """Move the finished download in place, False if the compressed data arrived damaged"""
+        try:
+            writer.finish()
+        except ValueError as e:
+            print(f"Error: {e}")
+            return False
+        print(f"Downloaded file at \"{self.output_file}\".")
+        return True
+
+    def receive_response(self, query_id, domain, resolver, deadline):
+        """Wait until deadline for the answer to one query, late answers to earlier queries are dropped"""
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout()
+            self.socket.settimeout(remaining)
+            response, address = self.socket.recvfrom(65535)
+            if address != resolver.address:
+                continue
             try:
-                decoded_data = base64.b64decode(complete_data)
-                
-                # Saving the data
-                output_file = f"received_files/{self.file_name}_received.txt"
-                with open(output_file, 'wb') as f:
-                    f.write(decoded_data)
-                
-                return True
-            
-            except Exception as e:
-                print(f"Error: {e}")
-                return False
-        else:
-            print("No data received.")
+                question = dns_wire.parse_query(response)
+            except (ValueError, IndexError):
+                continue
+            if question.flags & dns_wire.TC:
+                continue  # rate limited by the server, retransmitted after the timeout
+            if question.id == query_id and question.qname.lower() == domain.lower():
+                return response
+
+    def chunks_per_response(self):
+        """How many chunks fit in one response with our EDNS0 size"""
+        payload = self.edns_size or 512
+        question = len(self.chunk_domain(0, self.chunks_per_query)) + 1 + 4
+        fitting = (payload - 12 - question - 11) // (CHUNK_SIZE + RECORD_OVERHEAD)
+        return max(1, min(self.chunks_per_query, fitting))
+
+    def query_file_info(self):
+        """Ask the server how many chunks the file has, None if it does not support info queries.
+        Raises TunnelError if the server does not have the file"""
+        domain = f"info.{self.file_domain()}"
+        for attempt in range(1, 4):
+            try:
+                query_id = random.getrandbits(16)
+                sent_at = time.monotonic()
+                query = self.create_dns_query(0, query_id=query_id, domain=domain)
+                resolver = self.pick_resolver()
+                self.socket.sendto(query, resolver.address)
+                resolver.sent()
+                try:
+                    response = self.receive_response(query_id, domain, resolver, sent_at + resolver.rtt.timeout(attempt))
+                finally:
+                    resolver.done()
+                if attempt == 1:
+                    resolver.rtt.sample(time.monotonic() - sent_at)
+                answers = self.parse_dns_response(response, chunks=False)
+                if answers is None:
+                    continue  # damaged, asked again
+                if answers:
+                    info = dict(field.split('=', 1) for field in answers[0].split())
+                    return int(info['chunks'])
+                return None
+            except socket.timeout:
+                continue
+            except (ValueError, KeyError):
+                return None
+        return None
+
+    def download_file_windowed(self, window=16, max_attempts=10):
+        """Download with up to window queries in flight, lost ranges are retransmitted on their own.
+        Every chunk may be sent at most max_attempts times, in whichever ranges it ends up in"""
+        per_query = self.chunks_per_response()
+        try:
+            total_chunks = self.query_file_info()  # None: find the end from the empty end of file record
+        except TunnelError as e:
+            print(f"Error: {e}")
+            return False
+        writer = ChunkWriter(self.output_file, total_chunks, codec=self.compression)
+        to_retry = set()  # chunk indexes that have to be asked for again
+        next_new = 0  # lowest chunk index never asked for
+        if writer.open():
+            print(f"Resuming download, {len(writer.received)} chunks already on disk")
+            total_chunks = writer.total_chunks
+            next_new = writer.first_missing()
+            if total_chunks is not None:
+                # only the missing chunks are asked for
+                to_retry = set(range(next_new, total_chunks)) - writer.received
+                next_new = total_chunks
+        inflight = {}  # query id -> ChunkRequest
+        chunk_attempts = {}  # chunk index -> times it was asked for
+        start_time = time.perf_counter()
+
+        def give_up(message):
+            print(message)
+            for pending in inflight.values():
+                pending.resolver.done()
+            writer.close()
+            print(f"Download interrupted after {len(writer.received)} chunks, run again to resume.")
             return False
 
+        self.socket.setblocking(False)
+        try:
+            while total_chunks is None or len(writer.received) < total_chunks:
+                # fill the window, retransmissions first
+                while len(inflight) < window:
+                    request = self.next_request(to_retry, next_new, total_chunks, per_query, inflight)
+                    if request is None:
+                        break
+                    if request.first_index == next_new:
+                        next_new += request.chunk_count
+                    to_retry.difference_update(range(request.first_index, request.first_index + request.chunk_count))
+                    self.send_request(request, chunk_attempts)
+
+                if not inflight:
+                    break
+
+                next_deadline = min(request.sent_at + request.timeout for request in inflight.values())
+                timeout = max(next_deadline - time.monotonic(), 0)
+                readable, _, _ = select.select([self.socket], [], [], timeout)
+                if readable:
+                    for response, address in self.read_responses():
+                        request = self.match_response(response, address, inflight)
+                        if request is None:
+                            continue
+                        del inflight[request.query_id]
+                        request.resolver.done()
+                        if request.attempts == 1:
+                            request.resolver.rtt.sample(time.monotonic() - request.sent_at)
+                        request_chunks = range(request.first_index, request.first_index + request.chunk_count)
+                        try:
+                            received_chunks = self.parse_dns_response(response)
+                        except TunnelError as e:
+                            return give_up(f"Error: {e}")
+                        delivered = 0
+                        for offset, chunk_data in enumerate(received_chunks or []):
+                            chunk_index = request.first_index + offset
+                            if not chunk_data:  # end of file
+                                total_chunks = chunk_index if total_chunks is None else min(total_chunks, chunk_index)
+                                to_retry.difference_update([index for index in to_retry if index >= total_chunks])
+                                break
+                            try:
+                                writer.write(chunk_index, chunk_data)
+                            except ValueError:
+                                break  # damaged response, the rest of the range is asked for again
+                            delivered += 1
+                        # chunks that did not fit in the response (or that were damaged) are asked for again,
+                        # within the same budget as the lost ones
+                        missing = [index for index in request_chunks
+                                   if not writer.has(index) and (total_chunks is None or index < total_chunks)]
+                        if delivered:
+                            # the server cut the range (its per client budget), the chunks after the cut were not
+                            # lost and this send does not count against them
+                            for index in missing:
+                                chunk_attempts[index] -= 1
+                        if missing and max(chunk_attempts[index] for index in missing) >= max_attempts:
+                            return give_up(f"Giving up on chunks {missing[0]}-{missing[-1]}, "
+                                           f"answered {max_attempts} times without them")
+                        to_retry.update(missing)
+
+                # selective retransmission of the requests that timed out
+                now = time.monotonic()
+                for request in [request for request in inflight.values() if now - request.sent_at >= request.timeout]:
+                    request_chunks = range(request.first_index, request.first_index + request.chunk_count)
+                    if max(chunk_attempts[index] for index in request_chunks) >= max_attempts:
+                        return give_up(f"Giving up on chunks {request.first_index}-"
+                                       f"{request.first_index + request.chunk_count - 1}")
+                    self.retransmissions += 1
+                    request.resolver.done()
+                    self.send_request(request, chunk_attempts)
+        finally:
+            self.socket.setblocking(True)
+            self.socket.settimeout(self.timeout)
+
+        elapsed = time.perf_counter() - start_time
+        print(f"Received {len(writer.received)} chunks in {elapsed:.2f}s ({self.queries_sent} queries, "
+              f"{self.retransmissions} retransmissions)")
+        return self.finish_download(writer)
+
+    def next_request(self, to_retry, next_new, total_chunks, per_query, inflight):
+        """Next contiguous range to ask for: missing chunks first, then new ones"""
+        if to_retry:
+            first_index = min(to_retry)
+            chunk_count = 1
+            while chunk_count < per_query and first_index + chunk_count in to_retry:
+                chunk_count += 1
+        else:
+            first_index = next_new
+            chunk_count = per_query
+            if total_chunks is not None:
+                chunk_count = min(chunk_count, total_chunks - first_index)
+            if chunk_count <= 0:
+                return None
+
+        query_id = random.getrandbits(16)
+        while query_id in inflight:
+            query_id = random.getrandbits(16)
+        request = ChunkRequest(query_id, first_index, chunk_count, self.chunk_domain(first_index, chunk_count))
+        inflight[query_id] = request
+        return request
+
+    def send_request(self, request, chunk_attempts):
+        """Send (or resend) a request to the resolver expected to answer first"""
+        query = self.create_dns_query(request.first_index, request.chunk_count, query_id=request.query_id,
+                                      domain=request.domain)
+        request.resolver = self.pick_resolver()
+        self.socket.sendto(query, request.resolver.address)
+        request.resolver.sent()
+        request.sent_at = time.monotonic()
+        request.attempts += 1
+        request.timeout = request.resolver.rtt.timeout(request.attempts)
+        self.queries_sent += 1
+        for index in range(request.first_index, request.first_index + request.chunk_count):
+            chunk_attempts[index] = chunk_attempts.get(index, 0) + 1
+
+    def read_responses(self):
+        while True:
+            try:
+                response, address = self.socket.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            yield response, address
+
+    def match_response(self, response, address, inflight):
+        """The in-flight request a response answers, matched by transaction id and question name"""
+        try:
+            question = dns_wire.parse_query(response)
+        except (ValueError, IndexError):
+            return None
+        request = inflight.get(question.id)
+        if question.flags & dns_wire.TC:
+            return None  # rate limited by the server, retransmitted after the timeout
+        if request is None or address != request.resolver.address or question.qname.lower() != request.domain.lower():
+            return None  # late duplicate or unrelated packet
+        return request
+
+
+def download_batch(file_names, resolver_addresses, window=16, workers=4, timeout=5, compression=None):
+    """Download several files at once over several resolvers and report the throughput"""
+    resolvers = [Resolver(address, timeout) for address in resolver_addresses]
+
+    def download(file_name):
+        client = DNSTunnelingClient(file_name=file_name, timeout=timeout, resolvers=resolvers, compression=compression)
+        start_time = time.perf_counter()
+        if window > 1:
+            success = client.download_file_windowed(window=window)
+        else:
+            success = client.download_file()
+        elapsed = time.perf_counter() - start_time
+        size = os.path.getsize(client.output_file) if success else 0
+        client.socket.close()
+        return file_name, success, size, elapsed
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(download, file_names))
+    total_elapsed = time.perf_counter() - start_time
+
+    print()
+    for file_name, success, size, elapsed in results:
+        status = "ok" if success else "FAILED"
+        print(f"{file_name:<24} {status:<6} {size:>10} bytes in {elapsed:6.2f}s  {size / elapsed / 1024:8.1f} KiB/s")
+    total_size = sum(size for _, _, size, _ in results)
+    print(f"{'total':<24} {'':<6} {total_size:>10} bytes in {total_elapsed:6.2f}s  "
+          f"{total_size / total_elapsed / 1024:8.1f} KiB/s")
+    for resolver in resolvers:
+        srtt = f"{resolver.rtt.srtt * 1000:.1f} ms" if resolver.rtt.srtt is not None else "n/a"
+        print(f"resolver {resolver.address[0]}:{resolver.address[1]}: {resolver.queries} queries, srtt {srtt}")
+    return all(success for _, success, _, _ in results)
+
+
 if __name__ == "__main__":
-    # Get filename or use "example" as default
-    file_name = sys.argv[1] if len(sys.argv) > 1 else "example"
-    
-    client = DNSTunnelingClient(file_name=file_name)
-    client.download_file()
-    
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="download files through the dns tunnel")
+    parser.add_argument("files", nargs="*", default=["example"], help="tunnel file names, ex: example luceafarul")
+    parser.add_argument("--server", action="append", dest="servers",
+                        help="resolver address, ip or ip:port, repeat for several (default 64.226.94.247)")
+    parser.add_argument("--window", type=int, default=16, help="queries in flight per file, 1 means stop and wait")
+    parser.add_argument("--workers", type=int, default=4, help="files downloaded at the same time")
+    parser.add_argument("--compress", choices=["zlib", "lzma"], help="download the compressed file and decompress it")
+    args = parser.parse_args()
+
+    servers = [parse_resolver(server) for server in (args.servers or ["64.226.94.247"])]
+    if len(args.files) == 1 and len(servers) == 1:
+        client = DNSTunnelingClient(dns_server_ip=servers[0][0], dns_server_port=servers[0][1], file_name=args.files[0],
+                                    compression=args.compress)
+        if args.window > 1:
+            client.download_file_windowed(window=args.window)
+        else:
+            client.download_file()
+    else:
+        download_batch(args.files, servers, window=args.window, workers=args.workers, compression=args.compress)
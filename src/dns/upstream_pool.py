@@ -0,0 +1,293 @@
+'''
+small pool of long-lived udp sockets used to forward queries upstream. every forward gets a random
+transaction id on a randomly chosen socket (so a random source port), responses are matched back to the
+waiting query by (socket, id, question) and timeouts are reaped by a timer wheel instead of per-socket timeouts
+
+with several upstream servers, every forward goes to the fastest healthy one (ewma of its response times). if it
+has not answered after its usual response time plus a margin (the hedge delay), the next one is raced against
+it, and a failed attempt moves on to the next server right away. servers that keep timing out are skipped for
+a while
+'''
+import asyncio
+import math
+import random
+import socket
+import time
+
+import dns_wire
+from metrics import LatencyHistogram
+
+
+'''
+hashed timer wheel: a ring of slots advanced every tick. scheduling and cancelling are O(1), and every tick
+only looks at the entries that expire in that slot
+'''
+class TimerWheel:
+    def __init__(self, tick=0.1, slot_count=128):
+        self.tick = tick
+        self.slots = [set() for _ in range(slot_count)]
+        self.current = 0
+
+    '''
+    schedules key to expire after timeout seconds (capped at one turn of the wheel) and returns its slot
+    '''
+    def schedule(self, key, timeout):
+        ticks = min(max(1, math.ceil(timeout / self.tick)), len(self.slots) - 1)
+        slot = (self.current + ticks) % len(self.slots)
+        self.slots[slot].add(key)
+        return slot
+
+    def cancel(self, key, slot):
+        self.slots[slot].discard(key)
+
+    '''
+    moves the wheel one tick forward and returns the keys that expired
+    '''
+    def advance(self):
+        self.current = (self.current + 1) % len(self.slots)
+        expired = self.slots[self.current]
+        self.slots[self.current] = set()
+        return expired
+
+
+'''
+response time and health of one upstream server
+'''
+class UpstreamServer:
+    def __init__(self, address, failure_threshold=3, max_down_time=30):
+        self.address = address
+        self.srtt = None  # ewma of the response time
+        self.rttvar = None
+        self.failures = 0  # consecutive timeouts
+        self.failure_threshold = failure_threshold
+        self.max_down_time = max_down_time  # seconds
+        self.down_until = 0
+        self.inflight = 0
+        self.queries = 0
+        self.timeouts = 0
+        self.latency = LatencyHistogram()  # response times of the answered queries
+
+    def healthy(self, now):
+        return now >= self.down_until
+
+    def record_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def record_answer(self, rtt):
+        self.record_rtt(rtt)
+        self.latency.record(rtt)
+        if self.failures >= self.failure_threshold:
+            print(f"Upstream DNS server {self.address[0]}:{self.address[1]} is answering again")
+        self.failures = 0
+        self.down_until = 0
+
+    def record_timeout(self, now):
+        self.timeouts += 1
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            # skipped for 1, 2, 4 ... seconds, then a single query checks it again
+            down_time = min(2 ** (self.failures - self.failure_threshold), self.max_down_time)
+            if self.healthy(now):
+                print(f"Upstream DNS server {self.address[0]}:{self.address[1]} timed out {self.failures} times "
+                      f"in a row, skipping it for {down_time} seconds")
+            self.down_until = max(self.down_until, now + down_time)
+
+    '''
+    how long to wait for this server before racing the next one
+    '''
+    def hedge_delay(self, default, min_delay=0.01):
+        if self.srtt is None:
+            return default
+        return max(self.srtt + 4 * self.rttvar, min_delay)
+
+
+class PendingQuery:
+    def __init__(self, future, original_id, question, slot, upstream):
+        self.future = future
+        self.original_id = original_id
+        self.question = question  # question bytes, the response must echo them
+        self.slot = slot
+        self.upstream = upstream
+        self.sent_at = time.monotonic()
+
+
+class UpstreamPool:
+    '''
+    upstream_addresses: one (ip, port) or a list of them
+    '''
+    def __init__(self, upstream_addresses, size=4, timeout=3, tick=0.1, hedge=True, explore=0.02):
+        if isinstance(upstream_addresses[0], str):
+            upstream_addresses = [upstream_addresses]
+        self.upstreams = [UpstreamServer(tuple(address)) for address in upstream_addresses]
+        self.size = size
+        self.timeout = timeout
+        self.hedge = hedge  # race the next server once the current one is slower than usual
+        self.explore = explore  # share of hedged forwards sent to a random server first, so estimates stay current
+        self.wheel = TimerWheel(tick=tick)
+        self.sockets = []
+        self.pending = {}  # (socket index, transaction id) -> PendingQuery
+        self.loop = None
+        self.tick_handle = None
+
+    def open(self):
+        self.loop = asyncio.get_running_loop()
+        for index in range(self.size):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            sock.bind(('', 0))  # the kernel picks a random ephemeral source port
+            self.loop.add_reader(sock.fileno(), self.read_responses, index)
+            self.sockets.append(sock)
+        self.tick_handle = self.loop.call_later(self.wheel.tick, self.on_tick)
+
+    def close(self):
+        if self.tick_handle is not None:
+            self.tick_handle.cancel()
+        for sock in self.sockets:
+            self.loop.remove_reader(sock.fileno())
+            sock.close()
+        self.sockets = []
+        for pending in self.pending.values():
+            if not pending.future.done():
+                pending.future.set_result(None)
+        self.pending.clear()
+
+    '''
+    healthy servers, fastest first. a server never measured goes first, one query at a time, so it gets
+    measured. if every server is down, the one that comes back first is tried anyway
+    '''
+    def ranked(self):
+        now = time.monotonic()
+        healthy = [upstream for upstream in self.upstreams if upstream.healthy(now)]
+        if not healthy:
+            return [min(self.upstreams, key=lambda upstream: upstream.down_until)]
+
+        def expected_rtt(upstream):
+            if upstream.srtt is not None:
+                return upstream.srtt
+            return self.timeout if upstream.inflight else 0
+
+        ranked = sorted(healthy, key=expected_rtt)
+        if self.hedge and len(ranked) > 1 and random.random() < self.explore:
+            ranked.insert(0, ranked.pop(random.randrange(1, len(ranked))))
+        return ranked
+
+    '''
+    forwards query upstream and returns the response with the client's transaction id, or None if no server
+    answered in time
+    '''
+    async def query(self, query):
+        upstreams = self.ranked()
+        # never wait longer than the fastest server usually needs before racing the next one
+        hedge_delay = min(upstream.hedge_delay(default=self.timeout / 4) for upstream in upstreams)
+        attempts = set()
+        try:
+            for position, upstream in enumerate(upstreams):
+                attempts.add(asyncio.ensure_future(self.query_upstream(query, upstream)))
+                if position == len(upstreams) - 1:
+                    delay = None  # last server, wait for every attempt still running
+                elif self.hedge:
+                    delay = hedge_delay
+                else:
+                    delay = self.timeout
+                response = await self.first_response(attempts, delay)
+                if response is not None:
+                    return response
+            return None
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    '''
+    waits up to delay seconds (None: no limit) for one of the attempts to return a response. failed attempts
+    are removed from the set. None if all of them failed or the delay passed
+    '''
+    async def first_response(self, attempts, delay):
+        deadline = None if delay is None else self.loop.time() + delay
+        while attempts:
+            timeout = None if deadline is None else max(deadline - self.loop.time(), 0)
+            done, _ = await asyncio.wait(attempts, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                return None
+            for attempt in done:
+                attempts.discard(attempt)
+                if attempt.result() is not None:
+                    return attempt.result()
+        return None
+
+    async def query_upstream(self, query, upstream):
+        index = random.randrange(len(self.sockets))
+        transaction_id = random.getrandbits(16)
+        while (index, transaction_id) in self.pending:
+            transaction_id = random.getrandbits(16)
+
+        key = (index, transaction_id)
+        future = self.loop.create_future()
+        slot = self.wheel.schedule(key, self.timeout)
+        question = query.data[dns_wire.HEADER.size:query.question_end]
+        pending = PendingQuery(future, query.id, question, slot, upstream)
+        self.pending[key] = pending
+        upstream.queries += 1
+        upstream.inflight += 1
+
+        try:
+            self.sockets[index].sendto(dns_wire.set_id(query.data, transaction_id), upstream.address)
+        except OSError as e:
+            self.forget(key)
+            upstream.inflight -= 1
+            upstream.record_timeout(time.monotonic())
+            print(f"Error sending request to upstream DNS server {upstream.address[0]}: {e}")
+            return None
+
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # lost the race: it takes at least this long, so a slow server does not keep a fast estimate
+            elapsed = time.monotonic() - pending.sent_at
+            if upstream.srtt is None or elapsed > upstream.srtt:
+                upstream.record_rtt(elapsed)
+            raise
+        finally:
+            self.forget(key)
+            upstream.inflight -= 1
+
+    def forget(self, key):
+        pending = self.pending.pop(key, None)
+        if pending is not None:
+            self.wheel.cancel(key, pending.slot)
+
+    def read_responses(self, index):
+        sock = self.sockets[index]
+        while True:
+            try:
+                data, address = sock.recvfrom(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:  # ex: icmp port unreachable reported on the socket
+                continue
+
+            if len(data) < dns_wire.HEADER.size:
+                continue
+            key = (index, int.from_bytes(data[0:2], 'big'))
+            pending = self.pending.get(key)
+            # the response has to come from the server asked and echo the question, the id alone is only 16 bits
+            if pending is None or pending.future.done() or address != pending.upstream.address or \
+                    data[dns_wire.HEADER.size:dns_wire.HEADER.size + len(pending.question)] != pending.question:
+                continue
+            self.forget(key)
+            pending.upstream.record_answer(time.monotonic() - pending.sent_at)
+            pending.future.set_result(dns_wire.set_id(data, pending.original_id))
+
+    def on_tick(self):
+        for key in self.wheel.advance():
+            pending = self.pending.pop(key, None)
+            if pending is not None and not pending.future.done():
+                print(f"Sent request to upstream DNS server {pending.upstream.address[0]} but no response received "
+                      f"within {self.timeout} seconds.")
+                pending.upstream.record_timeout(time.monotonic())
+                pending.future.set_result(None)
+        self.tick_handle = self.loop.call_later(self.wheel.tick, self.on_tick)